@@ -0,0 +1,122 @@
+"""Synthetic datasets and helpers shared by all benchmarks
+
+Building a dataset with many files takes much longer than any benchmark
+run on it, hence datasets are built once, and kept in a cache directory
+(`DATALAD_HTC_BENCHMARK_CACHE`, or a directory in the system's temporary
+directory) across benchmark runs. Benchmarks that modify a dataset work
+on a copy.
+"""
+
+import io
+import os
+import os.path as op
+import shutil
+import tarfile
+import tempfile
+
+from datalad.utils import rmtree
+
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+
+
+cache_dir = os.environ.get(
+    'DATALAD_HTC_BENCHMARK_CACHE',
+    op.join(tempfile.gettempdir(), 'datalad_htcondor_benchmarks'))
+
+# number of files in a synthetic dataset
+file_counts = [10, 1000, 100000]
+
+# how the files of a dataset are stored: all in git, all annexed, or
+# half and half
+storage_mixes = ['git', 'mixed', 'annex']
+
+# files per directory of a synthetic dataset
+files_per_dir = 100
+
+# size of a single file in bytes
+file_size = 1024
+
+
+def file_content(i):
+    """Return the (unique) content of the i-th file of a dataset"""
+    line = u'file {:d}\n'.format(i).encode()
+    return (line * (file_size // len(line) + 1))[:file_size]
+
+
+def is_annexed(i, mix):
+    """Return whether the i-th file of a dataset is annexed"""
+    return mix == 'annex' or (mix == 'mixed' and i % 2 == 1)
+
+
+def file_path(i, mix='git'):
+    """Return the path of the i-th file of a dataset, relative to its root
+
+    The extension of a file determines whether it is annexed.
+    """
+    return op.join(
+        'files', 'dir{:d}'.format(i // files_per_dir),
+        'f{:d}.{}'.format(i, 'dat' if is_annexed(i, mix) else 'txt'))
+
+
+def _build_dataset(path, nfiles, mix):
+    ds = Dataset(path).rev_create()
+    ndirs = (nfiles + files_per_dir - 1) // files_per_dir
+    for d in range(ndirs):
+        os.makedirs(op.join(path, 'files', 'dir{:d}'.format(d)))
+    for i in range(nfiles):
+        with open(op.join(path, file_path(i, mix)), 'wb') as f:
+            f.write(file_content(i))
+    # applies to job outputs too
+    with open(op.join(path, '.gitattributes'), 'a') as f:
+        f.write('*.txt annex.largefiles=nothing\n'
+                '*.dat annex.largefiles=anything\n')
+    ds.rev_save()
+    return ds
+
+
+def get_dataset(nfiles, mix):
+    """Return a synthetic dataset, built on first use
+
+    Parameters
+    ----------
+    nfiles : int
+      Number of files, of `file_size` bytes each, in the 'files' directory.
+    mix : {'git', 'mixed', 'annex'}
+      How the files are stored.
+
+    Returns
+    -------
+    Dataset
+    """
+    path = op.join(cache_dir, 'ds_{}_{:d}'.format(mix, nfiles))
+    # marks a complete build
+    done = path + '.done'
+    if not op.exists(done):
+        if op.exists(path):
+            # left behind by an interrupted build
+            rmtree(path)
+        _build_dataset(path, nfiles, mix)
+        open(done, 'w').close()
+    return Dataset(path)
+
+
+def copy_dataset(ds, dest):
+    """Copy a dataset, including its annexed content"""
+    shutil.copytree(ds.path, dest, symlinks=True)
+    return Dataset(dest)
+
+
+def make_output_archive(path, nfiles, mix):
+    """Write a job output archive with `nfiles` new files, in 'out/'"""
+    with tarfile.open(path, 'w:gz') as tar:
+        for i in range(nfiles):
+            content = file_content(i)
+            info = tarfile.TarInfo('./' + op.join('out', file_path(i, mix)))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def make_tempdir():
+    """Return a new temporary directory"""
+    return ut.Path(tempfile.mkdtemp(prefix='datalad_htc_bm_'))
@@ -0,0 +1,133 @@
+"""Throughput of the execute-side scripts
+
+Input files are fetched with the condor_chirp stand-in of the local
+backend, i.e. plain copies, hence this measures the overhead of the
+scripts, not that of a network transfer.
+"""
+
+import os
+import os.path as op
+import shutil
+import subprocess
+import sys
+import time
+from distutils.spawn import find_executable
+
+from pkg_resources import resource_filename
+
+from datalad.utils import rmtree
+
+from datalad_htcondor.htcprepare import (
+    _get_input_records,
+    _write_input_manifest,
+)
+from datalad_htcondor.local import install_stand_ins
+
+from .common import (
+    file_content,
+    file_counts,
+    file_path,
+    file_size,
+    get_dataset,
+    make_tempdir,
+    storage_mixes,
+)
+
+
+scripts = resource_filename('datalad_htcondor', 'resources/scripts')
+helper = op.join(scripts, 'htchelper.py')
+
+
+def _helper(*args):
+    subprocess.check_call([sys.executable, helper] + list(args))
+
+
+class Fetch(object):
+    """Preflight fetch of all files of a dataset"""
+    params = [file_counts, storage_mixes]
+    param_names = ['files', 'storage']
+    timeout = 3600
+
+    def setup(self, nfiles, mix):
+        ds = get_dataset(nfiles, mix)
+        self.tmp = make_tempdir()
+        install_stand_ins(str(self.tmp))
+        self.chirp = str(self.tmp / 'condor_chirp')
+        self.manifest = str(self.tmp / 'input_files')
+        _write_input_manifest(
+            ds, self.tmp / 'input_files',
+            _get_input_records(ds, [str(ds.pathobj / 'files')]))
+        self.source = ds.path + os.sep
+
+    def teardown(self, nfiles, mix):
+        rmtree(str(self.tmp))
+
+    def _fetch(self):
+        dest = str(make_tempdir())
+        try:
+            _helper('fetch', '--chirp', self.chirp, '--source', self.source,
+                    self.manifest, dest)
+        finally:
+            rmtree(dest)
+
+    def time_fetch(self, nfiles, mix):
+        self._fetch()
+
+    def track_fetch_throughput(self, nfiles, mix):
+        start = time.time()
+        self._fetch()
+        return nfiles * file_size / 1024. ** 2 / (time.time() - start)
+    track_fetch_throughput.unit = 'MB/s'
+
+
+class Postflight(object):
+    """Finding, checksumming and packing the outputs of a job"""
+    params = [file_counts, ['gzip', 'zstd', 'none']]
+    param_names = ['files', 'compression']
+    timeout = 3600
+
+    def setup(self, nfiles, compression):
+        if compression == 'zstd' and not find_executable('zstd'):
+            # skipped
+            raise NotImplementedError
+        self.wdir = make_tempdir()
+        for src, name in (('post_posix.sh', 'post.sh'),
+                          ('htchelper.py', 'htchelper.py')):
+            shutil.copy(op.join(scripts, src), str(self.wdir / name))
+        (self.wdir / 'stamps').mkdir()
+        (self.wdir / 'stamps' / 'prep_complete').touch()
+        # the outputs must be newer than the stamp
+        time.sleep(0.01)
+        for i in range(nfiles):
+            path = self.wdir / 'dataset' / file_path(i)
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True)
+            path.write_bytes(file_content(i))
+        self.togethome = str(self.wdir / 'stamps' / 'togethome')
+        self.dataset = str(self.wdir / 'dataset')
+        _helper('collect', self.dataset, self.togethome)
+        self.env = dict(
+            os.environ,
+            DATALAD_HTC_OUTPUT_COMPRESSION=compression,
+        )
+
+    def teardown(self, nfiles, compression):
+        rmtree(str(self.wdir))
+
+    def time_collect(self, nfiles, compression):
+        _helper('collect', '--newer', str(self.wdir / 'stamps' /
+                                          'prep_complete'),
+                self.dataset, str(self.wdir / 'collected'))
+
+    def time_checksum(self, nfiles, compression):
+        _helper('checksum', self.togethome, self.dataset,
+                str(self.wdir / 'output_files'))
+
+    def time_pack(self, nfiles, compression):
+        _helper('pack', '--compression', compression, self.togethome,
+                self.dataset, str(self.wdir / 'output'))
+
+    def time_postflight(self, nfiles, compression):
+        subprocess.check_call(
+            [op.join(str(self.wdir), 'post.sh')],
+            cwd=str(self.wdir), env=self.env)
@@ -0,0 +1,82 @@
+"""Latency of htc-prepare, as a whole and by phase"""
+
+from datalad.utils import rmtree
+
+from datalad_htcondor.htcprepare import (
+    _assign_to_jobs,
+    _get_input_records,
+    _write_input_manifest,
+    get_git_bundles,
+    get_submissions_dir,
+    shard_by_size,
+    _get_bytesize,
+)
+
+from .common import (
+    file_counts,
+    get_dataset,
+    make_tempdir,
+    storage_mixes,
+)
+
+
+class Prepare(object):
+    """A single job with all files of a dataset as inputs"""
+    params = [file_counts, storage_mixes]
+    param_names = ['files', 'storage']
+    timeout = 3600
+
+    def setup(self, nfiles, mix):
+        self.ds = get_dataset(nfiles, mix)
+        self.inputs = [str(self.ds.pathobj / 'files')]
+        self.records = _get_input_records(self.ds, self.inputs)
+        self.tmp = make_tempdir()
+
+    def teardown(self, nfiles, mix):
+        rmtree(str(self.tmp))
+        rmtree(str(get_submissions_dir(self.ds)))
+
+    def time_prepare(self, nfiles, mix):
+        self.ds.htc_prepare(
+            cmd='true', inputs=['files'], result_renderer=None)
+
+    # the phases of a preparation
+
+    def time_input_status(self, nfiles, mix):
+        _get_input_records(self.ds, self.inputs)
+
+    def time_assign_to_jobs(self, nfiles, mix):
+        _assign_to_jobs(self.records, [self.inputs])
+
+    def time_write_manifest(self, nfiles, mix):
+        _write_input_manifest(
+            self.ds, self.tmp / 'input_files', self.records)
+
+    def time_git_bundles(self, nfiles, mix):
+        # a new cache each time, i.e. complete bundles
+        get_git_bundles(self.ds.repo, make_tempdir() / 'bundles')
+
+
+class PrepareSharded(object):
+    """Inputs distributed across many jobs"""
+    params = [[10, 100, 1000], storage_mixes]
+    param_names = ['jobs', 'storage']
+    timeout = 3600
+
+    def setup(self, njobs, mix):
+        self.ds = get_dataset(file_counts[-1], mix)
+        self.items = [
+            (_get_bytesize(r), r)
+            for r in _get_input_records(
+                self.ds, [str(self.ds.pathobj / 'files')])]
+
+    def teardown(self, njobs, mix):
+        rmtree(str(get_submissions_dir(self.ds)))
+
+    def time_prepare(self, njobs, mix):
+        self.ds.htc_prepare(
+            cmd='true', inputs=['files'], shards=njobs,
+            result_renderer=None)
+
+    def time_shard_by_size(self, njobs, mix):
+        shard_by_size(self.items, nshards=njobs)
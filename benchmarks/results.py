@@ -0,0 +1,111 @@
+"""Latency of htc-results list, and merge throughput"""
+
+import json
+import os.path as op
+import time
+from six import text_type
+
+from datalad.utils import rmtree
+
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+
+from datalad_htcondor.htcprepare import get_submissions_dir
+
+from .common import (
+    cache_dir,
+    copy_dataset,
+    get_dataset,
+    make_output_archive,
+    make_tempdir,
+)
+
+
+# jobs per submission, for listing
+jobs_per_submission = 10
+
+
+def get_submissions_dataset(nsubmissions):
+    """Return a dataset with many submissions, built on first use
+
+    Submissions are made up on disk, as if they were prepared, and half of
+    their jobs completed already.
+    """
+    path = op.join(cache_dir, 'ds_submissions_{:d}'.format(nsubmissions))
+    done = path + '.done'
+    if op.exists(done):
+        return Dataset(path)
+    if op.exists(path):
+        rmtree(path)
+    ds = Dataset(path).rev_create()
+    subroot = get_submissions_dir(ds)
+    for s in range(nsubmissions):
+        sdir = subroot / 'submit_bm{:06d}'.format(s)
+        sdir.mkdir(parents=True)
+        (sdir / 'status').write_text(u'submitted')
+        (sdir / 'runargs.json').write_text(
+            text_type(json.dumps(dict(cmd='cmd {}'.format(s)))))
+        for j in range(jobs_per_submission):
+            jdir = sdir / 'job_{:d}'.format(j)
+            (jdir / 'logs').mkdir(parents=True)
+            (jdir / 'runargs.json').write_text(
+                text_type(json.dumps(dict(cmd='cmd {} {}'.format(s, j)))))
+            if j % 2:
+                (jdir / 'status').write_text(u'completed')
+                (jdir / 'output').write_bytes(b'')
+    # build the catalog
+    ds.htc_results('list', result_renderer=None)
+    open(done, 'w').close()
+    return ds
+
+
+class List(object):
+    """Listing jobs across many submissions, with an up-to-date catalog"""
+    params = [[10, 100, 1000]]
+    param_names = ['submissions']
+    timeout = 3600
+
+    def setup(self, nsubmissions):
+        self.ds = get_submissions_dataset(nsubmissions)
+
+    def time_list(self, nsubmissions):
+        self.ds.htc_results('list', result_renderer=None)
+
+    def time_list_state(self, nsubmissions):
+        self.ds.htc_results('list', state='completed', result_renderer=None)
+
+    def time_rebuild(self, nsubmissions):
+        self.ds.htc_results('rebuild', result_renderer=None)
+
+
+class Merge(object):
+    """Merging the outputs of a single job into a dataset"""
+    params = [[10, 1000, 10000], ['git', 'annex']]
+    param_names = ['files', 'storage']
+    timeout = 3600
+    # each merge needs a fresh job
+    number = 1
+    repeat = 3
+    warmup_time = 0
+
+    def setup(self, nfiles, mix):
+        self.tmp = make_tempdir()
+        self.ds = copy_dataset(get_dataset(0, mix), str(self.tmp / 'ds'))
+        res = self.ds.htc_prepare(
+            cmd='true', outputs=['out'], result_renderer=None,
+            return_type='list')
+        jdir = ut.Path(res[-1]['path']) / 'job_0'
+        make_output_archive(str(jdir / 'output'), nfiles, mix)
+        (jdir / 'status').write_text(u'completed')
+
+    def teardown(self, nfiles, mix):
+        rmtree(str(self.tmp))
+
+    def time_merge(self, nfiles, mix):
+        self.ds.htc_results('merge', result_renderer=None)
+
+    def track_merge_rate(self, nfiles, mix):
+        start = time.time()
+        self.ds.htc_results('merge', result_renderer=None)
+        return nfiles / (time.time() - start)
+    track_merge_rate.unit = 'files/s'
@@ -0,0 +1,441 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Persistent catalog of submissions and their jobs"""
+
+__docformat__ = 'restructuredtext'
+
+
+import json
+import logging
+import os
+import os.path as op
+import sqlite3
+import time
+from six import text_type
+
+from datalad.support import json_py
+from datalad.dochelpers import exc_str
+
+from datalad_htcondor.stats import (
+    StatsStore,
+    get_signature,
+)
+from datalad_htcondor.timing import read_timing
+from datalad_htcondor.userlog import (
+    apply_events,
+    get_usage,
+    read_events,
+)
+
+
+lgr = logging.getLogger('datalad.htcondor.catalog')
+
+
+# bump whenever the schema changes, the catalog is rebuilt from disk then
+schema_version = 2
+
+_schema = """\
+CREATE TABLE submissions (
+    submission TEXT PRIMARY KEY,
+    state TEXT,
+    cmd TEXT,
+    created REAL,
+    updated REAL,
+    status_mtime REAL
+);
+CREATE TABLE jobs (
+    submission TEXT NOT NULL
+        REFERENCES submissions(submission) ON DELETE CASCADE,
+    job INTEGER NOT NULL,
+    state TEXT,
+    cmd TEXT,
+    created REAL,
+    updated REAL,
+    status_mtime REAL,
+    input_bytes INTEGER,
+    output_bytes INTEGER,
+    condor_state TEXT,
+    exit_code INTEGER,
+    log_offset INTEGER DEFAULT 0,
+    PRIMARY KEY (submission, job)
+);
+CREATE INDEX jobs_state ON jobs(state);
+CREATE INDEX jobs_created ON jobs(created);
+"""
+
+
+def _load_cmd(args_path):
+    if not args_path.exists():
+        return None
+    try:
+        return json_py.load(text_type(args_path))['cmd']
+    except Exception:
+        return None
+
+
+def _read_status(path):
+    """Return (state, mtime) of a status file, or (None, None)"""
+    try:
+        mtime = path.stat().st_mtime
+    except OSError:
+        return None, None
+    return path.read_text().strip() or None, mtime
+
+
+def _get_input_bytes(jdir):
+    manifest = jdir / 'input_files'
+    if not manifest.exists():
+        return 0
+    with manifest.open() as f:
+        return sum(json.loads(l).get('size', 0) for l in f if l.strip())
+
+
+def _get_output_bytes(jdir):
+    output = jdir / 'output'
+    if output.is_dir():
+        return sum(
+            op.getsize(op.join(root, f))
+            for root, dirs, files in os.walk(text_type(output))
+            for f in files)
+    elif output.exists():
+        return output.stat().st_size
+    return None
+
+
+class Catalog(object):
+    """Index of all submissions of a dataset, and the state of their jobs
+
+    The catalog lives in an SQLite database in the submissions directory.
+    It mirrors what is on disk, which remains the authoritative source.
+    Commands that change a submission update the catalog right away, while
+    the state of jobs (reported by the execute side via `status` files,
+    and by HTCondor in each job's log) is picked up by `refresh()`,
+    reading only what changed.
+    A catalog can be rebuilt from disk at any time. The resource usage of
+    jobs that terminated is added to the job statistics (see
+    `datalad_htcondor.stats`) along the way.
+
+    Parameters
+    ----------
+    submissions_dir : Path
+      Directory with all submissions of a dataset.
+    """
+    filename = 'catalog.sqlite'
+
+    def __init__(self, submissions_dir):
+        self.dir = submissions_dir
+        submissions_dir.mkdir(parents=True, exist_ok=True)
+        path = submissions_dir / self.filename
+        new = not path.exists()
+        self._db = sqlite3.connect(text_type(path), timeout=60)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA foreign_keys = ON')
+        # opened on first use
+        self._stats = None
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != schema_version:
+            lgr.debug('Initializing submission catalog at %s', path)
+            self._db.executescript(
+                'DROP TABLE IF EXISTS jobs;\n'
+                'DROP TABLE IF EXISTS submissions;\n' +
+                _schema +
+                'PRAGMA user_version = {:d};\n'.format(schema_version))
+            new = True
+        if new:
+            self.rebuild()
+
+    def close(self):
+        self._db.close()
+        if self._stats is not None:
+            self._stats.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _sdir(self, submission):
+        return self.dir / 'submit_{}'.format(submission)
+
+    def _read_job(self, submission, job):
+        jdir = self._sdir(submission) / 'job_{0:d}'.format(job)
+        state, mtime = _read_status(jdir / 'status')
+        return dict(
+            submission=submission,
+            job=job,
+            state=state,
+            status_mtime=mtime,
+            cmd=_load_cmd(jdir / 'runargs.json'),
+            input_bytes=_get_input_bytes(jdir),
+            output_bytes=_get_output_bytes(jdir),
+        )
+
+    def _insert(self, table, props):
+        self._db.execute(
+            'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                table,
+                ', '.join(props),
+                ', '.join('?' for p in props)),
+            list(props.values()))
+
+    def add_submission(self, submission, state, cmd, jobs):
+        """Record a new submission
+
+        Parameters
+        ----------
+        submission : str
+        state : str
+        cmd : str
+        jobs : list
+          For each job a dict with the properties `job` (index), `cmd`,
+          and `input_bytes`.
+        """
+        now = time.time()
+        with self._db:
+            self._insert('submissions', dict(
+                submission=submission, state=state, cmd=cmd,
+                created=now, updated=now))
+            for j in jobs:
+                self._insert('jobs', dict(
+                    j, submission=submission, created=now, updated=now))
+
+    def set_state(self, submission, state):
+        """Update the state of a submission"""
+        with self._db:
+            self._db.execute(
+                'UPDATE submissions SET state = ?, updated = ?, '
+                'status_mtime = NULL WHERE submission = ?',
+                (state, time.time(), submission))
+
+    def remove(self, submission, job=None):
+        """Remove a submission (with all its jobs), or a single job"""
+        with self._db:
+            if job is None:
+                self._db.execute(
+                    'DELETE FROM submissions WHERE submission = ?',
+                    (submission,))
+            else:
+                self._db.execute(
+                    'DELETE FROM jobs WHERE submission = ? AND job = ?',
+                    (submission, job))
+
+    def reset_job(self, submission, job):
+        """Forget the state of a job, e.g. when it is submitted again
+
+        Its state is picked up from the new status file and log by the
+        next `refresh()`.
+        """
+        with self._db:
+            self._db.execute(
+                'UPDATE jobs SET state = NULL, updated = ?, '
+                'status_mtime = NULL, output_bytes = NULL, '
+                'condor_state = NULL, exit_code = NULL, log_offset = 0 '
+                'WHERE submission = ? AND job = ?',
+                (time.time(), submission, job))
+
+    def refresh(self, submission=None):
+        """Update the state of submissions and jobs from disk
+
+        Only status files that changed since the last refresh are read,
+        and only the events that were added to a job's HTCondor log.
+        Anything that has disappeared from disk is removed from the catalog.
+        """
+        where, args = ('WHERE submission = ?', (submission,)) \
+            if submission else ('', ())
+        with self._db:
+            for r in self._db.execute(
+                    'SELECT submission, status_mtime FROM submissions '
+                    '{}'.format(where), args).fetchall():
+                sdir = self._sdir(r['submission'])
+                if not sdir.is_dir():
+                    self.remove(r['submission'])
+                    continue
+                updates = self._check_status(sdir, r['status_mtime'])
+                if updates:
+                    self._update(
+                        'submissions', updates, submission=r['submission'])
+            for r in self._db.execute(
+                    'SELECT submission, job, status_mtime, condor_state, '
+                    'exit_code, log_offset FROM jobs {}'.format(where),
+                    args).fetchall():
+                jdir = self._sdir(r['submission']) / 'job_{0:d}'.format(
+                    r['job'])
+                if not jdir.is_dir():
+                    self.remove(r['submission'], r['job'])
+                    continue
+                updates = self._check_status(jdir, r['status_mtime'])
+                if updates:
+                    updates['output_bytes'] = _get_output_bytes(jdir)
+                updates.update(self._check_log(jdir, r))
+                if updates.get('condor_state', None) == 'terminated' and \
+                        r['condor_state'] != 'terminated':
+                    self._record_usage(r['submission'], r['job'], jdir)
+                if updates:
+                    self._update(
+                        'jobs', updates,
+                        submission=r['submission'], job=r['job'])
+
+    def _check_status(self, path, known_mtime):
+        try:
+            mtime = (path / 'status').stat().st_mtime
+        except OSError:
+            return {}
+        if mtime == known_mtime:
+            return {}
+        state, mtime = _read_status(path / 'status')
+        return dict(state=state, status_mtime=mtime, updated=mtime)
+
+    def _check_log(self, jdir, rec):
+        log = jdir / 'logs' / 'log'
+        try:
+            size = log.stat().st_size
+        except OSError:
+            return {}
+        offset = rec['log_offset'] or 0
+        state = rec['condor_state']
+        exit_code = rec['exit_code']
+        if size == offset:
+            return {}
+        elif size < offset:
+            # a new log, e.g. after a resubmission
+            offset = 0
+            state = exit_code = None
+        events, offset = read_events(log, offset)
+        state, exit_code = apply_events(events, state, exit_code)
+        return dict(condor_state=state, exit_code=exit_code,
+                    log_offset=offset)
+
+    def _record_usage(self, submission, job, jdir):
+        """Add the resource usage of a terminated job to the statistics"""
+        try:
+            # the peak usage may have been reported by earlier events
+            events, _ = read_events(jdir / 'logs' / 'log')
+            timing = read_timing(jdir / 'stamps' / 'timing')
+            cmd = self._db.execute(
+                'SELECT cmd FROM submissions WHERE submission = ?',
+                (submission,)).fetchone()
+            if self._stats is None:
+                self._stats = StatsStore(self.dir)
+            self._stats.record(
+                get_signature(cmd['cmd'] if cmd else None),
+                submission,
+                job,
+                events[-1]['cluster'],
+                runtime=timing[-1]['time'] - timing[0]['time']
+                if timing else None,
+                input_bytes=_get_input_bytes(jdir),
+                output_bytes=_get_output_bytes(jdir),
+                **get_usage(events))
+        except Exception as e:
+            lgr.debug('Could not record the resource usage of %s: %s',
+                      jdir, exc_str(e))
+
+    def _update(self, table, props, **key):
+        self._db.execute(
+            'UPDATE {} SET {} WHERE {}'.format(
+                table,
+                ', '.join('{} = ?'.format(k) for k in props),
+                ' AND '.join('{} = ?'.format(k) for k in key)),
+            list(props.values()) + list(key.values()))
+
+    def rebuild(self):
+        """Replace the catalog content with what is found on disk"""
+        with self._db:
+            self._db.execute('DELETE FROM submissions')
+            for sdir in self.dir.glob('submit_*'):
+                if not sdir.is_dir():
+                    continue
+                submission = sdir.name[7:]
+                state, mtime = _read_status(sdir / 'status')
+                # best guess, the submission dir is created first
+                created = sdir.stat().st_mtime
+                self._insert('submissions', dict(
+                    submission=submission,
+                    state=state,
+                    status_mtime=mtime,
+                    cmd=_load_cmd(sdir / 'runargs.json'),
+                    created=created,
+                    updated=mtime or created,
+                ))
+                for jdir in sdir.glob('job_*'):
+                    if not jdir.is_dir() or not jdir.name[4:].isdigit():
+                        continue
+                    try:
+                        props = self._read_job(submission, int(jdir.name[4:]))
+                    except Exception as e:
+                        lgr.warning('Ignoring unreadable job at %s: %s',
+                                    jdir, exc_str(e))
+                        continue
+                    self._insert('jobs', dict(
+                        props,
+                        created=created,
+                        updated=props['status_mtime'] or created,
+                    ))
+
+    def get_submissions(self, submission=None):
+        """Return submission records, ordered by creation"""
+        return [dict(r) for r in self._db.execute(
+            'SELECT * FROM submissions {} ORDER BY created, submission'.format(
+                'WHERE submission = ?' if submission else ''),
+            (submission,) if submission else ())]
+
+    def get_jobs(self, submission=None, jobs=None, state=None,
+                 older_than=None, newer_than=None, cmd=None):
+        """Return job records matching all given criteria
+
+        Parameters
+        ----------
+        submission : str, optional
+        jobs : list, optional
+          Job indices.
+        state : str, optional
+          Matches the state reported by a job itself, or the state
+          indicated by its HTCondor log. Jobs without a state of their own
+          have the state of their submission.
+        older_than, newer_than : float, optional
+          Age of a job (time since it was prepared) in seconds.
+        cmd : str, optional
+          Glob pattern the command of a job must match.
+
+        Returns
+        -------
+        list
+          Job records (dicts), ordered by submission creation and job index.
+        """
+        conds = []
+        args = []
+        if submission:
+            conds.append('j.submission = ?')
+            args.append(submission)
+        if jobs is not None:
+            conds.append('j.job IN ({})'.format(', '.join('?' for j in jobs)))
+            args.extend(jobs)
+        if state:
+            conds.append('(COALESCE(j.state, s.state) = ? '
+                         'OR j.condor_state = ?)')
+            args.extend([state, state])
+        now = time.time()
+        if older_than is not None:
+            conds.append('j.created < ?')
+            args.append(now - older_than)
+        if newer_than is not None:
+            conds.append('j.created >= ?')
+            args.append(now - newer_than)
+        if cmd:
+            conds.append('j.cmd GLOB ?')
+            args.append(cmd)
+        return [dict(r) for r in self._db.execute(
+            'SELECT j.submission, j.job, COALESCE(j.state, s.state) AS state, '
+            'j.cmd, j.created, j.updated, j.input_bytes, j.output_bytes, '
+            'j.condor_state, j.exit_code '
+            'FROM jobs j JOIN submissions s USING (submission) '
+            '{} ORDER BY s.created, j.submission, j.job'.format(
+                'WHERE ' + ' AND '.join(conds) if conds else ''),
+            args)]
@@ -15,11 +15,17 @@ import logging
 import tempfile
 from six import (
     iteritems,
+    string_types,
     text_type,
 )
+import hashlib
+import heapq
+import json
+import os
 import shlex
 import stat
 import os.path as op
+from six.moves import shlex_quote
 
 from pkg_resources import resource_string
 
@@ -38,10 +44,17 @@ from datalad.interface.results import get_status_dict
 from datalad.support import json_py
 
 from datalad.support.param import Parameter
-from datalad.support.constraints import EnsureNone
+from datalad.support.constraints import (
+    EnsureNone,
+    EnsureInt,
+)
 from datalad.support.exceptions import CommandError
 
 from datalad.utils import get_dataset_pwds as get_command_pwds
+from datalad.utils import (
+    anything2bool,
+    assure_list,
+)
 
 from datalad.cmd import Runner
 
@@ -51,11 +64,28 @@ from datalad_revolution.gitrepo import RevolutionGitRepo as GitRepo
 
 import datalad_revolution.utils as ut
 from datalad_revolution.dataset import (
+    RevolutionDataset as Dataset,
     datasetmethod,
     require_dataset,
     EnsureDataset,
 )
 
+from datalad_htcondor import local
+from datalad_htcondor.catalog import (
+    Catalog,
+    _load_cmd,
+)
+from datalad_htcondor.resultcache import (
+    ResultCache,
+    get_cache_key,
+)
+from datalad_htcondor.stats import (
+    StatsStore,
+    get_signature,
+    propose_requests,
+)
+from datalad_htcondor.timing import Timer
+
 
 lgr = logging.getLogger('datalad.htcondor.htcprepare')
 
@@ -80,21 +110,32 @@ environment  = "{environment}"
 # transfer and execution setup
 run_as_owner = {run_as_owner_flag}
 should_transfer_files = {transfer_files_mode}
-when_to_transfer_output = {transfer_output_mode}
 
 # each job has its own dir, to receive the outputs back
-initial_dir = job_$(Process)
-
-# paths must be relative to initial dir
-transfer_input_files = {transfer_files_list}
-transfer_output_files = status,stamps,output
-
+initial_dir = job_$(job)
+{file_transfer}
 # paths are relative to a job's initial dir
 Error   = logs/err
 # TODO support this case
 #Input   = logs/in
 Output  = logs/out
 Log     = logs/log
+{resource_requests}
+# one job per line in the item data file: <job index>, <arguments>
+arguments = "$(job_arguments)"
+queue job,job_arguments from {jobs_file}
+"""
+
+
+# file transfer setup, not used with a shared file system
+file_transfer_template = u"""
+when_to_transfer_output = {transfer_output_mode}
+
+# paths must be relative to initial dir
+# shared files are referenced in the submission dir, job-specific
+# ones live in the job dir
+transfer_input_files = {transfer_files_list}
+transfer_output_files = status,stamps,output,output_files
 """
 
 
@@ -123,6 +164,245 @@ submission_defaults = dict(
 )
 
 
+# settings of the pre-crafted job configurations, selectable via --jobcfg
+# settings can be overridden, and additional configurations can be defined,
+# via `datalad.htcondor.jobcfg.<name>.<setting>` configuration items (with
+# '-' instead of '_' in the setting name)
+jobcfg_defaults = dict(
+    # number of concurrent input file transfers in the preflight stage
+    fetch_jobs=4,
+    # directory on the execute node where input files and container
+    # images are cached across jobs (none by default)
+    node_cache='',
+    # maximum size of the node cache in bytes
+    node_cache_size=10 * 1024 ** 3,
+    # jobs run directly in their job dir in the submission pack, and read
+    # inputs from the dataset, without transferring any files. Requires
+    # the execute nodes to share a file system with the submit host
+    shared_fs=False,
+    # clone the dataset on the execute node, and obtain annexed inputs
+    # from its remotes, rather than through the submit host. Anything that
+    # cannot be obtained this way is still transferred
+    annex_get=False,
+    # URL to clone the dataset from on the execute nodes (defaults to the
+    # URL of the dataset's tracking remote)
+    clone_url='',
+    # send the git history of the dataset and its installed subdatasets
+    # along, as git bundles that are cached across submissions. Jobs get
+    # a dataset with real git state (not used with annex_get or shared_fs,
+    # they come with it already)
+    git_bundle=False,
+    # compression of the job outputs that are sent back: 'gzip', 'zstd'
+    # (multi-threaded), 'none', or 'auto' (no compression for outputs that
+    # are mostly compressed already, zstd or gzip otherwise)
+    output_compression='gzip',
+    # seconds between checkpoints, at which outputs a job modified since the
+    # last one are sent back to its job dir. An evicted job restarts with
+    # these outputs in place, and they can be merged before the job
+    # completed. 0 disables checkpoints, they are not used with shared_fs
+    checkpoint_interval=0,
+    # what runs the jobs: 'condor' submits them to the HTCondor pool,
+    # 'local' runs them on this machine (see `datalad_htcondor.local`)
+    backend='condor',
+    # number of jobs the local backend runs concurrently, 0 for one per
+    # CPU core
+    local_workers=0,
+    # resources each job requests: CPU cores, memory in MB, disk space in
+    # KB. 0 estimates a request from the resource usage of earlier jobs of
+    # the same command (see `datalad_htcondor.stats`) and the size of the
+    # inputs, or leaves it to HTCondor's defaults, without anything to
+    # base an estimate on
+    request_cpus=0,
+    request_memory=0,
+    request_disk=0,
+    # factor applied to estimated requests, to not run out of resources
+    # when a job needs more than any earlier one
+    request_margin=1.25,
+    # maximum size in bytes of the cache of merged job outputs (see
+    # `datalad_htcondor.resultcache`). Jobs whose outputs are in the cache
+    # are not run again. 0 disables the cache
+    result_cache_size=10 * 1024 ** 3,
+)
+
+output_compressions = ('none', 'gzip', 'zstd', 'auto')
+
+backends = ('condor', 'local')
+
+job_configs = dict(
+    default=dict(),
+    sharedfs=dict(shared_fs=True),
+    annex=dict(annex_get=True),
+    bundle=dict(git_bundle=True),
+    local=dict(backend='local'),
+)
+
+# submit file settings that differ for jobs on a shared file system
+shared_fs_submission = dict(
+    # no chirp needed to obtain inputs
+    ioproxy_flag='false',
+    # jobs must be able to write to their job dir
+    run_as_owner_flag='true',
+    transfer_files_mode='NO',
+)
+
+
+def _convert_setting(default, value):
+    if isinstance(default, bool):
+        return anything2bool(value)
+    elif isinstance(default, int):
+        return int(value)
+    elif isinstance(default, float):
+        return float(value)
+    return value
+
+
+def get_jobcfg(ds, name):
+    """Return the settings of a job configuration
+
+    Parameters
+    ----------
+    ds : Dataset
+      Dataset whose configuration is considered.
+    name : str
+      Name of the job configuration.
+
+    Returns
+    -------
+    dict
+
+    Raises
+    ------
+    ValueError
+      For an unknown job configuration.
+    """
+    prefix = 'datalad.htcondor.jobcfg.{}.'.format(name)
+    if name not in job_configs and \
+            not any(k.startswith(prefix) for k in ds.config.keys()):
+        raise ValueError("unknown job configuration '{}'".format(name))
+    cfg = dict(jobcfg_defaults, **job_configs.get(name, {}))
+    for k in cfg:
+        v = ds.config.get(prefix + k.replace('_', '-'), None)
+        if v is not None:
+            cfg[k] = _convert_setting(cfg[k], v)
+    if cfg['output_compression'] not in output_compressions:
+        raise ValueError(
+            "unknown output compression '{}', must be one of: {}".format(
+                cfg['output_compression'], ', '.join(output_compressions)))
+    if cfg['backend'] not in backends:
+        raise ValueError(
+            "unknown backend '{}', must be one of: {}".format(
+                cfg['backend'], ', '.join(backends)))
+    return cfg
+
+
+def get_jobcfg_environment(jobcfg):
+    """Return environment variables that expose a job configuration
+
+    Each setting is available as DATALAD_HTC_<SETTING> to the scripts on the
+    execute side. Boolean values are represented as 'yes' or 'no'.
+    """
+    return {
+        'DATALAD_HTC_{}'.format(k.upper()):
+        ('yes' if v else 'no') if isinstance(v, bool) else text_type(v)
+        for k, v in iteritems(jobcfg)
+    }
+
+
+def submit_cluster(submission_dir, submit_file, jobcfg):
+    """Queue the jobs of a submit file, with the backend of a job configuration
+
+    Parameters
+    ----------
+    submission_dir : Path
+    submit_file : str
+      Name of the submit file in the submission dir.
+    jobcfg : dict
+      Settings of the job configuration of the submission.
+
+    Raises
+    ------
+    CommandError
+      If the jobs could not be queued.
+    """
+    if jobcfg.get('backend', 'condor') == 'local':
+        try:
+            local.submit(
+                submission_dir, submit_file,
+                workers=jobcfg.get('local_workers', 0))
+        except (IOError, OSError, ValueError) as e:
+            raise CommandError(
+                cmd='local.submit', msg=exc_str(e))
+        return
+    Runner(cwd=text_type(submission_dir)).run(
+        ['condor_submit', submit_file],
+        log_stdout=False,
+        log_stderr=False,
+        expect_stderr=True,
+        expect_fail=True,
+    )
+
+
+def get_resource_requests(subroot_dir, cmd, jobcfg, input_bytes):
+    """Return the resource requests for the jobs of a submission
+
+    Requests set in the job configuration are taken as they are, any
+    others are estimated from earlier jobs of the same command.
+
+    Parameters
+    ----------
+    subroot_dir : Path
+      Directory with all submissions of the dataset.
+    cmd : str
+      Command (template) of the submission.
+    jobcfg : dict
+      Settings of the job configuration of the submission.
+    input_bytes : int
+      Size of the inputs of the largest job.
+
+    Returns
+    -------
+    dict
+      Submit commands (e.g. `request_memory`) with their values.
+    """
+    requests = {k: jobcfg[k]
+                for k in ('request_cpus', 'request_memory', 'request_disk')
+                if jobcfg[k]}
+    if len(requests) == 3:
+        return requests
+    with StatsStore(subroot_dir) as stats:
+        runs = stats.get_runs(get_signature(cmd))
+    # inputs are read from a shared file system, not placed on the
+    # execute node's disk
+    for k, v in iteritems(propose_requests(
+            runs,
+            0 if jobcfg['shared_fs'] else input_bytes,
+            jobcfg['request_margin'])):
+        requests.setdefault(k, v)
+    lgr.debug('Resource requests %s, based on %d earlier runs of the '
+              'command', requests, len(runs))
+    return requests
+
+
+def get_clone_url(ds):
+    """Return the URL of the remote a dataset's branch is tracking
+
+    The 'origin' remote is considered, if there is no tracking branch.
+    Returns None, if there is no such remote.
+    """
+    remote, _ = ds.repo.get_tracking_branch()
+    return ds.config.get('remote.{}.url'.format(remote or 'origin'), None)
+
+
+def format_condor_env(env):
+    """Format a mapping of environment variables for an HTCondor submit file
+
+    The result must be wrapped in double quotes in a submit file.
+    """
+    return ' '.join(
+        "{}='{}'".format(k, v.replace("'", "''").replace('"', '""'))
+        for k, v in sorted(iteritems(env)))
+
+
 def make_executable(pathobj):
     pathobj.chmod(
         stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH |
@@ -130,13 +410,188 @@ def make_executable(pathobj):
         stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
 
-def get_singularity_jobspec(cmd):
+# leading bytes of singularity image files: SIF images and the (squashfs
+# or ext3) images of singularity 2.x start with a launcher line, raw
+# squashfs images with the squashfs magic
+_singularity_image_magic = (
+    b'#!/usr/bin/env run-singularity',
+    b'hsqs',
+)
+
+# singularity version of this process' environment (empty string if there
+# is no singularity), determined once
+_singularity_version = []
+
+
+def _get_singularity_version():
+    """Return the version string of the available singularity, or None"""
+    if not _singularity_version:
+        try:
+            stdout, stderr = Runner().run(
+                ['singularity', '--version'],
+                log_stdout=True,
+                log_stderr=True,
+                expect_stderr=True,
+                expect_fail=True,
+            )
+            # TODO could be used to tailor handling to particular versions
+            _singularity_version.append(stdout.strip())
+        except CommandError as e:  # pragma: no cover
+            # we do not have a singularity installation that we can handle
+            # log debug, because there is no guarantee that the executable
+            # actually was a singularity container
+            lgr.debug('No suitable singularity version installed: %s',
+                      exc_str(e))
+            _singularity_version.append('')
+    return _singularity_version[0] or None
+
+
+def _has_image_signature(path):
+    """Cheap test whether `path` could possibly be a singularity image"""
+    if op.isdir(path):
+        # sandbox container
+        return op.exists(op.join(path, '.singularity.d')) or \
+            op.exists(op.join(path, 'singularity'))
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(64)
+    except (IOError, OSError):
+        return False
+    return head.startswith(_singularity_image_magic) or b'SIF_MAGIC' in head
+
+
+def _load_json_cache(path):
+    if path is None or not path.exists():
+        return {}
+    try:
+        return json_py.load(text_type(path))
+    except Exception as e:
+        lgr.debug('Ignoring unreadable cache at %s: %s', path, exc_str(e))
+        return {}
+
+
+def _save_json_cache(path, cache):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temp file and move in place, no reader will ever
+    # see a partial cache
+    fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=text_type(path.parent))
+    os.close(fd)
+    json_py.dump(cache, tmp)
+    os.rename(tmp, text_type(path))
+
+
+def is_singularity_image(path, cache=None):
+    """Test whether `path` is a singularity image
+
+    Parameters
+    ----------
+    path : str
+      Path to an existing file or directory.
+    cache : Path, optional
+      Path of a JSON file where test results are cached. A cached result
+      is used as long as inode, size and modification time of the file
+      match.
+
+    Returns
+    -------
+    bool
+    """
+    path = op.realpath(path)
+    st = os.stat(path)
+    props = [st.st_ino, st.st_size, st.st_mtime]
+    known = _load_json_cache(cache)
+    rec = known.get(path, {})
+    if rec.get('stat', None) == props and 'image' in rec:
+        return rec['image']
+
+    if not _has_image_signature(path):
+        lgr.debug('%s is not a singularity image: no image signature', path)
+        is_image = False
+    elif not _get_singularity_version():
+        # cannot tell without singularity, and do not cache
+        # this, it would outlive the next singularity installation
+        return False
+    else:
+        try:
+            Runner().run(
+                ['singularity', 'exec', path,
+                 'cat', '/singularity'],
+                log_stdout=True,
+                log_stderr=True,
+                expect_stderr=True,
+                expect_fail=True,
+            )
+            is_image = True
+        except CommandError as e:
+            # log debug, because there is no guarantee that the executable
+            # actually was a singularity container
+            lgr.debug('%s is not a singularity image: %s',
+                      path, exc_str(e))
+            is_image = False
+    if cache is not None:
+        known[path] = dict(
+            rec if rec.get('stat', None) == props else {},
+            stat=props,
+            image=is_image)
+        _save_json_cache(cache, known)
+    return is_image
+
+
+def get_content_key(path, cache=None):
+    """Return a key that identifies the content of a file
+
+    Parameters
+    ----------
+    path : str
+      Path to an existing file.
+    cache : Path, optional
+      Path of a JSON file where computed keys are cached. A cached key
+      is used as long as inode, size and modification time of the file
+      match.
+
+    Returns
+    -------
+    str
+      The annex key for a file in an annex object store, or a SHA256-based
+      key in the same format otherwise.
+    """
+    path = op.realpath(path)
+    if op.join('annex', 'objects', '') in path:
+        # the content object of an annexed file is named after its key
+        return op.basename(path)
+    st = os.stat(path)
+    props = [st.st_ino, st.st_size, st.st_mtime]
+    known = _load_json_cache(cache)
+    rec = known.get(path, {})
+    if rec.get('stat', None) == props and 'key' in rec:
+        return rec['key']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    key = 'SHA256-s{}--{}'.format(st.st_size, digest.hexdigest())
+    if cache is not None:
+        known[path] = dict(
+            rec if rec.get('stat', None) == props else {},
+            stat=props,
+            key=key)
+        _save_json_cache(cache, known)
+    return key
+
+
+def get_singularity_jobspec(cmd, cache=None):
     """Extract the runscript of a singularity container used as an executable
 
     Parameters
     ----------
     cmd : list
       A command as an argument list.
+    cache : Path, optional
+      Path of a JSON file where the outcome of the (expensive) image
+      detection is cached, see `is_singularity_image()`.
 
     Returns
     -------
@@ -149,46 +604,12 @@ def get_singularity_jobspec(cmd):
     # get the path to the command's executable
     exec_path = cmd[0]
 
-    runner = Runner()
     if not op.exists(exec_path):
         # probably a command from PATH
         return
 
     # this is a real file, not just a command on the path
-    try:
-        stdout, stderr = runner.run(
-            ['singularity', '--version'],
-            log_stdout=True,
-            log_stderr=True,
-            expect_stderr=True,
-            expect_fail=True,
-        )
-        # TODO could be used to tailor handling to particular versions
-    except CommandError as e:  # pragma: no cover
-        # we do not have a singularity installation that we can handle
-        # log debug, because there is no guarantee that the executable
-        # actually was a singularity container
-        lgr.debug('No suitable singularity version installed: %s',
-                  exc_str(e))
-        return
-    # we have singularity
-    try:
-        stdout, stderr = runner.run(
-            # stringification only needed for pythons older than 3.6
-            ['singularity', 'exec', exec_path,
-             'cat', '/singularity'],
-            log_stdout=True,
-            log_stderr=True,
-            expect_stderr=True,
-            expect_fail=True,
-        )
-        # TODO could be used to tailor handling to particular versions
-    except CommandError as e:
-        # we do not have a singularity installation that we can handle
-        # log debug, because there is no guarantee that the executable
-        # actually was a singularity container
-        lgr.debug('%s is not a singularity image: %s',
-                  exec_path, exc_str(e))
+    if not is_singularity_image(exec_path, cache=cache):
         return
     # all but the container itself are the arguments
     return exec_path, cmd[1:]
@@ -199,6 +620,332 @@ def get_submissions_dir(ds):
     return ds.pathobj / GitRepo.get_git_dir(ds.path) / 'datalad' / 'htc'
 
 
+def get_result_cache(subroot_dir, jobcfg):
+    """Return the result cache for jobs of a configuration, or None"""
+    if not jobcfg.get('result_cache_size', 0):
+        return None
+    return ResultCache(
+        subroot_dir / 'result_cache', jobcfg['result_cache_size'])
+
+
+# longest chain of incremental bundles a job has to apply, before a
+# complete bundle is made again
+max_bundle_chain = 10
+
+
+def _git_output(path, args):
+    out, _ = Runner(cwd=text_type(path)).run(
+        ['git'] + args, expect_stderr=True)
+    return out
+
+
+def _get_bundle_chain(index, commit):
+    """Return the names of the bundles that lead up to `commit`
+
+    Returns None, if any bundle of the chain is unknown.
+    """
+    chain = []
+    while commit is not None:
+        if commit not in index:
+            return None
+        chain.insert(0, index[commit]['file'])
+        commit = index[commit]['prerequisite']
+    return chain
+
+
+def get_git_bundles(repo, bundle_dir):
+    """Return the git bundles to obtain the history of a repository's HEAD
+
+    Bundles are cached in `bundle_dir`, one per bundled commit, along with
+    an index. A commit that is a descendant of an already bundled one is
+    bundled incrementally, containing only the commits in between. Bundles
+    carry the commit as their only ref, underneath 'refs/datalad-htc/'.
+
+    Parameters
+    ----------
+    repo : GitRepo
+    bundle_dir : Path
+
+    Returns
+    -------
+    list
+      Paths of the bundles, in the order in which they must be fetched.
+      Empty, if the repository has no commit.
+    """
+    commit = repo.get_hexsha()
+    if commit is None:
+        return []
+    index_path = bundle_dir / 'index.json'
+    index = _load_json_cache(index_path)
+    # trust no index entry whose bundle has gone
+    index = {c: b for c, b in iteritems(index)
+             if (bundle_dir / b['file']).exists()}
+    chain = _get_bundle_chain(index, commit)
+    if chain is None:
+        # the closest ancestor that has a short enough chain of bundles
+        prerequisite = None
+        for c in _git_output(repo.path, ['rev-list', commit]).splitlines():
+            base_chain = _get_bundle_chain(index, c)
+            if base_chain is not None and \
+                    len(base_chain) < max_bundle_chain:
+                prerequisite = c
+                break
+        name = '{}.bundle'.format(commit)
+        bundle_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=text_type(bundle_dir))
+        os.close(fd)
+        # a bundle needs a ref to carry, use a private one, that no
+        # concurrent call moves
+        ref = 'refs/datalad-htc/bundle-{}'.format(op.basename(tmp)[4:])
+        try:
+            _git_output(repo.path, ['update-ref', ref, commit])
+            _git_output(
+                repo.path,
+                ['bundle', 'create', tmp, ref] +
+                (['^{}'.format(prerequisite)] if prerequisite else []))
+            heads = [l.split()
+                     for l in _git_output(
+                         repo.path, ['bundle', 'list-heads', tmp]
+                     ).splitlines()]
+            if heads != [[commit, ref]]:
+                raise RuntimeError(
+                    'bundle of {} carries unexpected heads: {}'.format(
+                        commit, heads))
+            os.rename(tmp, text_type(bundle_dir / name))
+        finally:
+            _git_output(repo.path, ['update-ref', '-d', ref])
+            if op.lexists(tmp):
+                os.unlink(tmp)
+        # another process may have added to the index meanwhile
+        index = dict(_load_json_cache(index_path), **index)
+        index[commit] = dict(file=name, prerequisite=prerequisite)
+        _save_json_cache(index_path, index)
+        chain = _get_bundle_chain(index, commit)
+    return [bundle_dir / b for b in chain]
+
+
+def quote_condor_args(args):
+    """Quote an argument list for HTCondor's 'new' argument syntax
+
+    Each argument is wrapped in single quotes, embedded single and double
+    quotes are escaped by repeating them. The result must be wrapped in
+    double quotes in a submit file.
+
+    Parameters
+    ----------
+    args : list
+      Arguments
+
+    Returns
+    -------
+    str
+    """
+    for a in args:
+        if '\n' in a:
+            raise ValueError(
+                'HTCondor cannot handle newlines in job arguments: '
+                '{!r}'.format(a))
+    return ' '.join(
+        "'{}'".format(a.replace("'", "''").replace('"', '""'))
+        for a in args)
+
+
+def _get_jobspecs(jobs):
+    """Normalize a job specification into a list of dicts
+
+    Parameters
+    ----------
+    jobs : None or str or list
+      None for a single job, a path to a JSON file with a list of job
+      specifications, or such a list itself.
+
+    Returns
+    -------
+    list
+      Dicts with `inputs` and `outputs` lists, and a `placeholders` dict
+      with all other job properties.
+    """
+    if jobs is None:
+        # a single job with nothing specific to it
+        jobs = [{}]
+    elif isinstance(jobs, string_types):
+        jobs = json_py.load(jobs)
+    if isinstance(jobs, dict):
+        jobs = [jobs]
+    if not jobs:
+        raise ValueError('job specification does not define any job')
+    specs = []
+    for j in jobs:
+        if not isinstance(j, dict):
+            raise ValueError(
+                'job specification must be a mapping, got: {!r}'.format(j))
+        specs.append(dict(
+            inputs=assure_list(j.get('inputs', None)),
+            outputs=assure_list(j.get('outputs', None)),
+            placeholders={k: v for k, v in iteritems(j)
+                          if k not in ('inputs', 'outputs')},
+        ))
+    return specs
+
+
+def _assign_to_jobs(records, job_inputs):
+    """Sort status records into the jobs whose inputs match them
+
+    Parameters
+    ----------
+    records : iterable
+      Status result records with a 'path' property.
+    job_inputs : list
+      For each job a list of (full) input paths. A record is assigned to
+      a job, if its path matches one of the job's inputs, or is located
+      underneath any of them.
+
+    Returns
+    -------
+    list
+      For each job a list of matching records.
+    """
+    path2jobs = {}
+    for i, paths in enumerate(job_inputs):
+        for p in paths:
+            path2jobs.setdefault(op.normpath(p), set()).add(i)
+    assigned = [[] for j in job_inputs]
+    for r in records:
+        p = text_type(r['path'])
+        jobs = set()
+        # walk up the tree, rather than testing each job's inputs
+        # one by one, this scales with the depth of the tree and
+        # not with the number of jobs
+        while True:
+            jobs.update(path2jobs.get(p, ()))
+            parent = op.dirname(p)
+            if parent == p:
+                break
+            p = parent
+        for j in jobs:
+            assigned[j].append(r)
+    return assigned
+
+
+def _expand_existing(globs, pwd):
+    """Expand globs into full paths, skipping anything that does not exist
+    """
+    # it could be that an input expression does not expand,
+    # because it doesn't match anything. In such a case
+    # we need to filter out such globs to not confuse
+    # the status() call that only takes real paths
+    return [p for p in GlobbedPaths(globs, pwd=pwd).expand(full=True)
+            if op.lexists(p)]
+
+
+def _get_input_records(ds, paths):
+    """Return status records for all files matching `paths`"""
+    return list(ds.rev_status(
+        path=paths,
+        # TODO do we really want that True? I doubt it
+        # this might pull in the world
+        recursive=False,
+        # we would have otherwise no idea
+        untracked='no',
+        # for key and size of annexed files
+        annex='basic',
+        result_renderer=None))
+
+
+def _get_bytesize(rec):
+    """Return the size of a file described by a status record"""
+    if rec.get('bytesize', None) is not None:
+        # annex key size
+        return rec['bytesize']
+    try:
+        return os.stat(text_type(rec['path'])).st_size
+    except OSError:
+        return 0
+
+
+def _get_content_ids(ds, records):
+    """Return (path, content identifier) tuples for status records
+
+    Returns None, if any file is modified, there is no telling what a job
+    would see then.
+    """
+    ids = []
+    for r in records:
+        cid = r.get('key', None) or r.get('gitshasum', None)
+        if r.get('state', None) != 'clean' or not cid:
+            return None
+        ids.append((op.relpath(text_type(r['path']), ds.path), cid))
+    return ids
+
+
+def _write_input_manifest(ds, path, records):
+    """Write the manifest of a job's input files
+
+    One JSON record per line, with the `path` of a file relative to the
+    dataset root and its `size`. Unmodified files also come with an
+    identifier of their content: the annex `key` of annexed files, and
+    the `gitsha` of the blob of any other file.
+    """
+    with path.open('w') as f:
+        for r in records:
+            props = dict(
+                path=op.relpath(text_type(r['path']), ds.path),
+                size=_get_bytesize(r),
+            )
+            # the identifiers reflect the recorded state, not necessarily
+            # what is in the worktree
+            if r.get('state', None) == 'clean':
+                if r.get('key', None):
+                    props['key'] = r['key']
+                elif r.get('gitshasum', None):
+                    props['gitsha'] = r['gitshasum']
+            f.write(text_type(json.dumps(props)))
+            f.write(u'\n')
+
+
+def shard_by_size(items, nshards=None, shard_size=None):
+    """Distribute items into shards of similar total size
+
+    Items are assigned largest first, each to the shard with the smallest
+    total size so far (longest processing time first). This is not optimal,
+    but never worse than 4/3 of the optimal largest shard.
+
+    Parameters
+    ----------
+    items : list
+      (size, item) tuples.
+    nshards : int, optional
+      Number of shards. At most as many shards as there are items are
+      created.
+    shard_size : int, optional
+      Target total size of a shard, used to determine the number of shards
+      when `nshards` is not given.
+
+    Returns
+    -------
+    list
+      Non-empty lists of items.
+    """
+    if nshards is None:
+        if not shard_size:
+            raise ValueError('need either number of shards or shard size')
+        total = sum(i[0] for i in items)
+        nshards = max(1, -(-total // shard_size))
+    if nshards < 1:
+        raise ValueError('number of shards must be positive')
+    nshards = min(nshards, len(items))
+    shards = [[] for i in range(nshards)]
+    # heap of (total size, shard index)
+    heap = [(0, i) for i in range(nshards)]
+    # largest first, stable order for items of identical size
+    order = sorted(range(len(items)), key=lambda i: (-items[i][0], i))
+    for size, item in (items[i] for i in order):
+        total, idx = heapq.heappop(heap)
+        shards[idx].append(item)
+        heapq.heappush(heap, (total + size, idx))
+    return [s for s in shards if s]
+
+
 @build_doc
 class HTCPrepare(Interface):
     """TODO
@@ -218,7 +965,45 @@ class HTCPrepare(Interface):
         jobcfg=Parameter(
             args=("--jobcfg",),
             doc="""name of pre-crafted job configuration that is used to
-            the tailor the HTCondor setup."""),
+            the tailor the HTCondor setup. Settings of a job configuration
+            can be adjusted via 'datalad.htcondor.jobcfg.<name>.<setting>'
+            configuration items. 'default' transfers all files to and from
+            the execute nodes, 'sharedfs' runs jobs in the submission
+            directory and reads inputs straight from the dataset, for
+            execute nodes that share a file system with the submit
+            host, 'annex' clones the dataset on the execute nodes
+            and obtains annexed inputs from its remotes, 'bundle'
+            sends the git history of the dataset along with the job, and
+            'local' runs the jobs on this machine, without HTCondor."""),
+        jobs=Parameter(
+            args=("--jobs",),
+            metavar='JOBSPEC',
+            doc="""specification of multiple jobs to be submitted as a
+            single cluster. This is a path to a JSON file with a list of job
+            specifications, or such a list itself. Each job specification
+            is a mapping: 'inputs' and 'outputs' are lists of paths that are
+            added to the common [CMD: --input/--output CMD][PY: `inputs`/
+            `outputs` PY] of all jobs, any other key is made available as a
+            placeholder for formatting the command (e.g. '{subject}').
+            By default a single job is prepared."""),
+        shards=Parameter(
+            args=("--shards",),
+            metavar='N',
+            doc="""split the input files into (at most) this many jobs.
+            Files are distributed such that each job receives a similar
+            amount of data, based on the file size (or the size recorded in
+            the annex key of an annexed file). The input files of a job are
+            available via the '{shard}' placeholder, the index of a job via
+            '{shard_index}'. Cannot be combined with [CMD: --jobs CMD][PY:
+            `jobs` PY].""",
+            constraints=EnsureInt() | EnsureNone()),
+        shard_size=Parameter(
+            args=("--shard-size",),
+            metavar='BYTES',
+            doc="""like [CMD: --shards CMD][PY: `shards` PY], but determine
+            the number of jobs from a target amount of input data per
+            job.""",
+            constraints=EnsureInt() | EnsureNone()),
         submit=Parameter(
             args=("--submit",),
             action='store_true',
@@ -238,10 +1023,14 @@ class HTCPrepare(Interface):
             message=None,
             sidecar=None,
             jobcfg='default',
+            jobs=None,
+            shards=None,
+            shard_size=None,
             submit=False):
 
         # TODO makes sure a different rel_pwd is handled properly on the remote end
         pwd, rel_pwd = get_command_pwds(dataset)
+        timer = Timer()
 
         ds = require_dataset(
             dataset,
@@ -249,24 +1038,153 @@ class HTCPrepare(Interface):
             purpose='preparing a remote command execution')
 
         try:
-            cmd_expanded = format_command(ds,
-                                          cmd,
-                                          pwd=pwd,
-                                          dspath=ds.path,
-                                          inputs=inputs,
-                                          outputs=outputs)
-        except KeyError as exc:
+            jobcfg_settings = get_jobcfg(ds, jobcfg)
+        except ValueError as e:
             yield get_status_dict(
                 'htcprepare',
                 ds=ds,
                 status='impossible',
-                message=('command has an unrecognized placeholder: %s',
-                         exc))
+                message=exc_str(e))
             return
 
+        if jobcfg_settings['annex_get'] and not jobcfg_settings['clone_url']:
+            jobcfg_settings['clone_url'] = get_clone_url(ds)
+            if not jobcfg_settings['clone_url']:
+                yield get_status_dict(
+                    'htcprepare',
+                    ds=ds,
+                    status='impossible',
+                    message=('job configuration %s needs a URL to clone '
+                             'the dataset from, but there is no remote '
+                             'and no clone_url setting', jobcfg))
+                return
+
+        try:
+            jobspecs = _get_jobspecs(jobs)
+        except Exception as e:
+            yield get_status_dict(
+                'htcprepare',
+                ds=ds,
+                status='impossible',
+                message=('invalid job specification: %s', exc_str(e)))
+            return
+
+        common_inputs = assure_list(inputs)
+        if shards or shard_size:
+            if jobs is not None:
+                yield get_status_dict(
+                    'htcprepare',
+                    ds=ds,
+                    status='impossible',
+                    message='input sharding and explicit job '
+                            'specifications are mutually exclusive')
+                return
+            timer.phase('shard')
+            for res in prepare_inputs(ds, GlobbedPaths(inputs, pwd=pwd)):
+                yield res
+            paths = _expand_existing(inputs, pwd)
+            files = [
+                r for r in (_get_input_records(ds, paths) if paths else [])
+                if r.get('type', None) in ('file', 'symlink')]
+            jobspecs = []
+            for i, shard in enumerate(shard_by_size(
+                    [(_get_bytesize(r), r) for r in files],
+                    nshards=shards,
+                    shard_size=shard_size)):
+                shard_paths = [text_type(r['path']) for r in shard]
+                jobspecs.append(dict(
+                    inputs=shard_paths,
+                    outputs=[],
+                    placeholders=dict(
+                        shard=[shlex_quote(op.relpath(p, pwd))
+                               for p in shard_paths],
+                        shard_index=i,
+                    ),
+                    # no need to query for these again
+                    expanded_inputs=shard_paths,
+                    records=shard,
+                ))
+            if not jobspecs:
+                yield get_status_dict(
+                    'htcprepare',
+                    ds=ds,
+                    status='impossible',
+                    message='no input files to shard')
+                return
+            # the common inputs are distributed across the shards
+            common_inputs = []
+
+        # format the command of each job, using its particular inputs,
+        # outputs and placeholders
+        timer.phase('format_command')
+        for spec in jobspecs:
+            spec['inputs'] = common_inputs + spec['inputs']
+            spec['outputs'] = assure_list(outputs) + spec['outputs']
+            try:
+                spec['cmd'] = format_command(
+                    ds,
+                    cmd,
+                    pwd=pwd,
+                    dspath=ds.path,
+                    inputs=spec['inputs'],
+                    outputs=spec['outputs'],
+                    **spec['placeholders'])
+            except KeyError as exc:
+                yield get_status_dict(
+                    'htcprepare',
+                    ds=ds,
+                    status='impossible',
+                    message=('command has an unrecognized placeholder: %s',
+                             exc))
+                return
+
+        # is this a singularity job?
+        # all jobs share a single runner and container, detect once per
+        # distinct executable
+        timer.phase('singularity')
+        jobspec_cache = {}
+        for spec in jobspecs:
+            split_cmd = shlex.split(spec['cmd'])
+            if split_cmd[0] not in jobspec_cache:
+                jobspec_cache[split_cmd[0]] = get_singularity_jobspec(
+                    split_cmd,
+                    cache=get_submissions_dir(ds) / 'singularity_images.json')
+            singularity_job = jobspec_cache[split_cmd[0]]
+            if not singularity_job:
+                spec['args'] = split_cmd
+            else:
+                # all but the container itself are the arguments
+                spec['args'] = ['singularity.simg'] + split_cmd[1:]
+            try:
+                spec['condor_args'] = quote_condor_args(spec['args'])
+            except ValueError as e:
+                yield get_status_dict(
+                    'htcprepare',
+                    ds=ds,
+                    status='impossible',
+                    message=('cannot pass command to HTCondor: %s',
+                             exc_str(e)))
+                return
+        containers = set(
+            text_type(ut.Path(j[0]).resolve())
+            for j in jobspec_cache.values() if j)
+        if len(containers) > 1 or (
+                containers and None in jobspec_cache.values()):
+            yield get_status_dict(
+                'htcprepare',
+                ds=ds,
+                status='impossible',
+                message=('all jobs of a submission must use the same '
+                         'singularity container, or none'))
+            return
+
+        timer.phase('write_scripts')
         transfer_files_list = [
-            'pre.sh', 'post.sh'
+            'pre.sh', 'post.sh', 'htchelper.py'
         ]
+        # files that exist in each job dir, rather than once
+        # for the entire submission
+        job_files_list = []
 
         # where all the submission packs live
         subroot_dir = get_submissions_dir(ds)
@@ -277,23 +1195,33 @@ class HTCPrepare(Interface):
             prefix='submit_', dir=text_type(subroot_dir)))
         submission = submission_dir.name[7:]
 
-        split_cmd = shlex.split(cmd_expanded)
-        # is this a singularity job?
-        singularity_job = get_singularity_jobspec(split_cmd)
-        if not singularity_job:
+        if not containers:
             with (submission_dir / 'runner.sh').open('wb') as f:
                 f.write(resource_string(
                     'datalad_htcondor',
                     'resources/scripts/runner_direct.sh'))
-            job_args = split_cmd
         else:
+            image = containers.pop()
             # link the container into the submission dir
-            (submission_dir / 'singularity.simg').symlink_to(
-                ut.Path(singularity_job[0]).resolve())
-            transfer_files_list.append('singularity.simg')
-            # arguments of the job
-            job_args = singularity_job[1]
-            job_args.insert(0, 'singularity.simg')
+            (submission_dir / 'singularity.simg').symlink_to(image)
+            if jobcfg_settings['node_cache'] and \
+                    not jobcfg_settings['shared_fs'] and \
+                    not op.isdir(image):
+                # have the preflight script obtain the image through
+                # the node cache
+                with (submission_dir / 'container_files').open('w') as f:
+                    f.write(text_type(json.dumps(dict(
+                        path='singularity.simg',
+                        size=op.getsize(image),
+                        key=get_content_key(
+                            image,
+                            cache=subroot_dir / 'singularity_images.json'),
+                        source=image,
+                    ))))
+                    f.write(u'\n')
+                transfer_files_list.append('container_files')
+            else:
+                transfer_files_list.append('singularity.simg')
 
             # TODO conditional on run_as_user=false
             with (submission_dir / 'runner.sh').open('wb') as f:
@@ -303,14 +1231,17 @@ class HTCPrepare(Interface):
         make_executable(submission_dir / 'runner.sh')
 
         # htcondor wants the log dir to exist at submit time
-        # TODO ATM we only support a single job per cluster submission
-        (submission_dir / 'job_0' / 'logs').mkdir(parents=True)
+        for i in range(len(jobspecs)):
+            (submission_dir / 'job_{0:d}'.format(i) / 'logs').mkdir(
+                parents=True)
 
         # TODO make job pre/post script selection configurable
         with (submission_dir / 'pre.sh').open('wb') as f:
             f.write(resource_string(
                 'datalad_htcondor',
-                'resources/scripts/pre_posix_chirp.sh'))
+                'resources/scripts/pre_posix_sharedfs.sh'
+                if jobcfg_settings['shared_fs']
+                else 'resources/scripts/pre_posix_chirp.sh'))
         make_executable(submission_dir / 'pre.sh')
 
         with (submission_dir / 'post.sh').open('wb') as f:
@@ -319,66 +1250,209 @@ class HTCPrepare(Interface):
                 'resources/scripts/post_posix.sh'))
         make_executable(submission_dir / 'post.sh')
 
+        with (submission_dir / 'htchelper.py').open('wb') as f:
+            f.write(resource_string(
+                'datalad_htcondor',
+                'resources/scripts/htchelper.py'))
+
         # API support selection (bound dataset methods and such)
         # internal import to avoid circularities
         from datalad.api import (
             rev_status as status,
         )
 
-        inputs = GlobbedPaths(inputs, pwd=pwd)
-        prepare_inputs(ds, inputs)
+        # make sure all inputs of all jobs are present, in one go
+        # (sharded inputs are taken care of already)
+        timer.phase('inputs')
+        all_globs = sorted(set(
+            p for spec in jobspecs if 'records' not in spec
+            for p in spec['inputs']))
+        for res in prepare_inputs(ds, GlobbedPaths(all_globs, pwd=pwd)):
+            yield res
 
-        # it could be that an input expression does not expand,
-        # because it doesn't match anything. In such a case
-        # we need to filter out such globs to not confuse
-        # the status() call below that only takes real paths
-        inputs = [p for p in inputs.expand(full=True)
-                  if op.lexists(p)]
+        expanded = {}
+        for spec in jobspecs:
+            if 'records' in spec:
+                continue
+            paths = []
+            seen = set()
+            for p in spec['inputs']:
+                if p not in expanded:
+                    expanded[p] = _expand_existing([p], pwd)
+                paths.extend(e for e in expanded[p] if e not in seen)
+                seen.update(expanded[p])
+            spec['expanded_inputs'] = paths
+
+        all_inputs = sorted(set(p for v in expanded.values() for p in v))
         # now figure out what matches the remaining paths in the
         # entire repo and dump a list of files to transfer
-        if inputs:
-            with (submission_dir / 'input_files').open('w') as f:
-                # TODO disable output renderer
-                for p in ds.rev_status(
-                        path=inputs,
-                        # TODO do we really want that True? I doubt it
-                        # this might pull in the world
-                        recursive=False,
-                        # we would have otherwise no idea
-                        untracked='no',
-                        result_renderer=None):
-                    f.write(text_type(p['path']))
-                    f.write(u'\0')
-                transfer_files_list.append('input_files')
-
-        if outputs:
-            # write the output globs to a file for eval on the execute
-            # side
-            # XXX we may not want to eval them on the remote side
-            # at all, however. This would make things different
-            # than with local execute, where we also just write to
-            # a dataset and do not have an additional filter
-            (submission_dir / 'output_globs').write_text(
-                # we need a final trailing delimiter as a terminator
-                u'\0'.join(outputs) + u'\0')
-            transfer_files_list.append('output_globs')
+        # a single status call for all jobs
+        if all_inputs:
+            specs = [spec for spec in jobspecs if 'records' not in spec]
+            for spec, records in zip(
+                    specs,
+                    _assign_to_jobs(
+                        _get_input_records(ds, all_inputs),
+                        [spec['expanded_inputs'] for spec in specs])):
+                spec['records'] = records
+        timer.phase('manifests')
+        if any('records' in spec for spec in jobspecs):
+            for i, spec in enumerate(jobspecs):
+                _write_input_manifest(
+                    ds,
+                    submission_dir / 'job_{0:d}'.format(i) / 'input_files',
+                    spec.get('records', []))
+            job_files_list.append('input_files')
+
+        if any(spec['outputs'] for spec in jobspecs):
+            for i, spec in enumerate(jobspecs):
+                # write the output globs to a file for eval on the execute
+                # side
+                # XXX we may not want to eval them on the remote side
+                # at all, however. This would make things different
+                # than with local execute, where we also just write to
+                # a dataset and do not have an additional filter
+                (submission_dir / 'job_{0:d}'.format(i) /
+                 'output_globs').write_text(
+                    # we need a final trailing delimiter as a terminator
+                    u''.join(o + u'\0' for o in spec['outputs']))
+            job_files_list.append('output_globs')
 
+        timer.stop(
+            files=sum(len(spec.get('records', [])) for spec in jobspecs),
+            bytes=sum(_get_bytesize(r)
+                      for spec in jobspecs
+                      for r in spec.get('records', [])))
+        timer.phase('bundles')
         (submission_dir / 'source_dataset_location').write_text(
             text_type(ds.pathobj) + op.sep)
         transfer_files_list.append('source_dataset_location')
+        if jobcfg_settings['annex_get']:
+            # the state of the dataset that the jobs must see
+            (submission_dir / 'source_dataset_commit').write_text(
+                text_type(ds.repo.get_hexsha()))
+            transfer_files_list.append('source_dataset_commit')
+        elif jobcfg_settings['git_bundle'] and \
+                not jobcfg_settings['shared_fs']:
+            bundle_specs = []
+            for sds in [ds] + [
+                    Dataset(r['path']) for r in ds.subdatasets(
+                        fulfilled=True,
+                        recursive=True,
+                        result_renderer=None,
+                        return_type='list')]:
+                # bundles of a dataset are shared by all its clones
+                sds_id = sds.id or hashlib.md5(
+                    sds.path.encode('utf-8')).hexdigest()
+                bundles = get_git_bundles(
+                    sds.repo, subroot_dir / 'bundles' / sds_id)
+                if not bundles:
+                    continue
+                names = []
+                for b in bundles:
+                    # all files are transferred into the same dir
+                    name = '{}_{}'.format(sds_id, b.name)
+                    (submission_dir / name).symlink_to(b)
+                    names.append(name)
+                bundle_specs.append(dict(
+                    path=op.relpath(sds.path, ds.path),
+                    commit=sds.repo.get_hexsha(),
+                    bundles=names,
+                ))
+                transfer_files_list.extend(names)
+            if bundle_specs:
+                json_py.dump(
+                    bundle_specs, text_type(submission_dir / 'bundles.json'))
+                transfer_files_list.append('bundles.json')
+
+        # jobs that ran before, with the same command, inputs, container
+        # and configuration, need not run again
+        timer.phase('result_cache')
+        cached = []
+        result_cache = get_result_cache(subroot_dir, jobcfg_settings)
+        images = [text_type(ut.Path(j[0]).resolve())
+                  for j in jobspec_cache.values() if j]
+        if result_cache is not None and not (images and op.isdir(images[0])):
+            container_key = get_content_key(
+                images[0],
+                cache=subroot_dir / 'singularity_images.json') \
+                if images else None
+            # jobs that get a clone of the dataset see more than their
+            # inputs
+            commit = ds.repo.get_hexsha() \
+                if jobcfg_settings['annex_get'] or \
+                jobcfg_settings['git_bundle'] else None
+            for i, spec in enumerate(jobspecs):
+                inputs = _get_content_ids(ds, spec.get('records', []))
+                if inputs is None:
+                    continue
+                key = get_cache_key(
+                    spec['cmd'], rel_pwd, spec['outputs'], inputs,
+                    container=container_key,
+                    commit=commit,
+                    jobcfg=jobcfg_settings)
+                jdir = submission_dir / 'job_{0:d}'.format(i)
+                # the outputs are kept under this key, once merged
+                (jdir / 'cache_key').write_text(text_type(key))
+                if result_cache.get(key, jdir):
+                    (jdir / 'status').write_text(u'completed')
+                    cached.append(i)
+        if cached:
+            lgr.info('Using the cached outputs of %d of %d jobs',
+                     len(cached), len(jobspecs))
 
+        # item data for the cluster: one line per job
+        timer.phase('submit_files')
+        with (submission_dir / 'jobs').open('w') as f:
+            for i, spec in enumerate(jobspecs):
+                if i in cached:
+                    continue
+                f.write(u'{}, {}\n'.format(i, spec['condor_args']))
+
+        submission_props = dict(submission_defaults)
+        if jobcfg_settings['shared_fs']:
+            submission_props.update(shared_fs_submission)
+            # jobs execute in their job dir, where they expect to find
+            # all the files that would have been transferred otherwise
+            for i in range(len(jobspecs)):
+                for f in transfer_files_list:
+                    (submission_dir / 'job_{0:d}'.format(i) / f).symlink_to(
+                        op.join(op.pardir, f))
+            file_transfer = ''
+        else:
+            file_transfer = file_transfer_template.format(
+                transfer_files_list=','.join(
+                    [op.join(op.pardir, f) for f in transfer_files_list] +
+                    job_files_list),
+                **submission_props)
+
+        json_py.dump(
+            jobcfg_settings, text_type(submission_dir / 'jobcfg.json'))
+        # the job configuration is exposed to all execute-side scripts,
+        # postflight checksums outputs like the annex would
+        resource_requests = get_resource_requests(
+            subroot_dir, cmd, jobcfg_settings,
+            max(sum(_get_bytesize(r) for r in spec.get('records', []))
+                for spec in jobspecs))
+        job_env = format_condor_env(dict(
+            get_jobcfg_environment(jobcfg_settings),
+            DATALAD_HTC_ANNEX_BACKEND=(
+                ds.config.get('annex.backends', None) or 'MD5E').split()[0]))
         with (submission_dir / 'cluster.submit').open('w') as f:
             f.write(submission_template.format(
                 executable='runner.sh',
                 # TODO if singularity_job else 'job.sh',
-                transfer_files_list=','.join(
-                    op.join(op.pardir, f) for f in transfer_files_list),
-                **submission_defaults
-            ))
-
-            f.write(u'\narguments = "{}"\nqueue\n'.format(
-                # TODO deal with single quotes in the args
-                ' '.join("'{}'".format(a) for a in job_args)
+                file_transfer=file_transfer,
+                resource_requests=u''.join(
+                    u'{} = {}\n'.format(k, v)
+                    for k, v in sorted(resource_requests.items())),
+                jobs_file='jobs',
+                **dict(
+                    submission_props,
+                    environment=job_env,
+                    preflight_script_env=job_env,
+                    postflight_script_env=job_env,
+                )
             ))
 
         # dump the run command args into a file for re-use
@@ -387,43 +1461,82 @@ class HTCPrepare(Interface):
         # acted upon, to be able to convince `run` to create
         # a full run record that maybe could be re-run
         # locally
-        json_py.dump(
-            dict(
-                cmd=cmd,
-                inputs=inputs,
-                outputs=outputs,
-                expand=expand,
-                explicit=explicit,
-                message=message,
-                sidecar=sidecar,
-                # report the PWD to, to given `run` a chance
-                # to be correct after the fact
-                pwd=pwd,
-            ),
-            text_type(submission_dir / 'runargs.json')
+        runargs = dict(
+            cmd=cmd,
+            inputs=[p for p in GlobbedPaths(inputs, pwd=pwd).expand(full=True)
+                    if op.lexists(p)] if inputs else [],
+            outputs=outputs,
+            expand=expand,
+            explicit=explicit,
+            message=message,
+            sidecar=sidecar,
+            # report the PWD to, to given `run` a chance
+            # to be correct after the fact
+            pwd=pwd,
         )
+        json_py.dump(runargs, text_type(submission_dir / 'runargs.json'))
+        for i, spec in enumerate(jobspecs):
+            json_py.dump(
+                dict(
+                    runargs,
+                    # the command is fully expanded already, protect
+                    # any braces from being taken as placeholders, when
+                    # `run` formats the command again
+                    cmd=spec['cmd'].replace(u'{', u'{{').replace(u'}', u'}}'),
+                    inputs=spec['expanded_inputs'],
+                    outputs=spec['outputs'] or None,
+                ),
+                text_type(submission_dir / 'job_{0:d}'.format(i) /
+                          'runargs.json'))
 
         # we use this file to inspect what state this submission is in
         (submission_dir / 'status').write_text(u'prepared')
+        with Catalog(subroot_dir) as catalog:
+            catalog.add_submission(
+                submission,
+                state='prepared',
+                cmd=cmd,
+                jobs=[dict(
+                    job=i,
+                    cmd=_load_cmd(
+                        submission_dir / 'job_{0:d}'.format(i) /
+                        'runargs.json'),
+                    input_bytes=sum(
+                        _get_bytesize(r) for r in spec.get('records', [])),
+                ) for i, spec in enumerate(jobspecs)])
+        timer.stop()
+        timer.write(submission_dir / 'timing' / 'prepare')
 
         yield get_status_dict(
             action='htc_prepare',
             status='ok',
             refds=text_type(ds.pathobj),
             submission=submission,
+            jobs=len(jobspecs),
+            cached_jobs=cached,
+            resource_requests=resource_requests,
             path=text_type(submission_dir),
             logger=lgr)
 
-        if submit:
+        if submit and len(cached) == len(jobspecs):
+            yield get_status_dict(
+                action='htc_submit',
+                status='notneeded',
+                submission=submission,
+                message='the outputs of all jobs are cached',
+                refds=text_type(ds.pathobj),
+                path=text_type(submission_dir),
+                logger=lgr)
+        elif submit:
+            timer.phase('submit')
             try:
-                Runner(cwd=text_type(submission_dir)).run(
-                    ['condor_submit', 'cluster.submit'],
-                    log_stdout=False,
-                    log_stderr=False,
-                    expect_stderr=True,
-                    expect_fail=True,
-                )
+                submit_cluster(
+                    submission_dir, 'cluster.submit', jobcfg_settings)
+                timer.stop()
+                timer.write(submission_dir / 'timing' / 'prepare')
                 (submission_dir / 'status').write_text(u'submitted')
+                with Catalog(subroot_dir) as catalog:
+                    catalog.set_state(submission, 'submitted')
                 yield get_status_dict(
                     action='htc_submit',
                     status='ok',
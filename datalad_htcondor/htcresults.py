@@ -10,11 +10,19 @@
 
 __docformat__ = 'restructuredtext'
 
+import json
 import logging
+import os
+import os.path as op
+import re
 import shutil
+import tempfile
+import threading
+import time
 from six import (
     text_type,
 )
+from six.moves import queue
 
 import datalad.support.ansi_colors as ac
 from datalad.interface.base import (
@@ -29,6 +37,7 @@ from datalad.interface.run import (
     GlobbedPaths,
 )
 from datalad.interface.utils import eval_results
+from datalad.cmd import Runner
 from datalad.support import json_py
 
 from datalad.support.param import Parameter
@@ -36,25 +45,56 @@ from datalad.support.constraints import (
     EnsureNone,
     EnsureChoice,
     EnsureInt,
+    EnsureListOf,
+    EnsureStr,
+    EnsureFloat,
 )
-from datalad.support.exceptions import CommandError
 
-from datalad.cmd import Runner
+from datalad.support.exceptions import CommandError
 
 from datalad.dochelpers import exc_str
 
 from datalad_revolution.dataset import (
+    RevolutionDataset as Dataset,
     datasetmethod,
     require_dataset,
     EnsureDataset,
 )
+from datalad_htcondor.catalog import (
+    Catalog,
+    _load_cmd,
+)
+from datalad_htcondor.ingest import (
+    get_unchanged_outputs,
+    ingest_archive,
+    open_archive,
+    safe_members,
+    _is_within,
+)
+from datalad_htcondor.timing import (
+    Timer,
+    aggregate,
+    get_phases,
+    read_timing,
+)
+from datalad_htcondor.userlog import (
+    Watcher,
+    final_states,
+    read_events,
+)
 from datalad_htcondor.htcprepare import (
+    get_result_cache,
     get_submissions_dir,
+    submit_cluster,
+    _git_output,
 )
 
 
 lgr = logging.getLogger('datalad.htcondor.htcresults')
 
+# seconds between checks for changes that cannot be watched for
+wait_poll_interval = 5
+
 
 @build_doc
 class HTCResults(Interface):
@@ -70,7 +110,9 @@ class HTCResults(Interface):
             metavar=("SUBCOMMAND",),
             nargs='?',
             doc="""""",
-            constraints=EnsureChoice('list', 'merge', 'remove')),
+            constraints=EnsureChoice(
+                'list', 'merge', 'remove', 'resubmit', 'wait', 'watch',
+                'rebuild')),
         dataset=Parameter(
             args=("-d", "--dataset"),
             doc="""specify the dataset to record the command results in.
@@ -86,12 +128,97 @@ class HTCResults(Interface):
         job=Parameter(
             args=("-j", "--job",),
             metavar='NUMBER',
-            doc="""""",
-            constraints=EnsureInt() | EnsureNone()),
+            action='append',
+            doc="""index of a job in a submission. Can be given multiple
+            times to address several jobs.""",
+            constraints=EnsureInt() | EnsureListOf(int) | EnsureNone()),
         all=Parameter(
             args=("--all",),
             action='store_true',
             doc=""""""),
+        state=Parameter(
+            args=("--state",),
+            doc="""only consider jobs in this state, e.g. 'completed',
+            or a state indicated by HTCondor's job log, e.g. 'held'. When
+            any job filter is given, submissions themselves are not
+            reported or removed, only their matching jobs. For 'wait',
+            this is the state to wait for ('completed' by default), jobs
+            that ended, are held, or were never submitted are not waited
+            for.
+            'resubmit' only ever considers jobs that failed, were held or
+            evicted, or ended without completing.""",
+            constraints=EnsureStr() | EnsureNone()),
+        older_than=Parameter(
+            args=("--older-than",),
+            metavar='AGE',
+            doc="""only consider jobs that were prepared longer ago than
+            this, given in seconds or with a unit suffix (m, h, d), e.g.
+            '12h'.""",
+            constraints=EnsureStr() | EnsureNone()),
+        newer_than=Parameter(
+            args=("--newer-than",),
+            metavar='AGE',
+            doc="""only consider jobs that were prepared within this time
+            span, see [CMD: --older-than CMD][PY: `older_than` PY].""",
+            constraints=EnsureStr() | EnsureNone()),
+        command=Parameter(
+            args=("--command",),
+            metavar='PATTERN',
+            doc="""only consider jobs whose command matches this glob
+            pattern, e.g. '*fslmaths*'.""",
+            constraints=EnsureStr() | EnsureNone()),
+        any=Parameter(
+            args=("--any",),
+            action='store_true',
+            doc="""with 'wait', return as soon as any job reached the
+            target state, rather than all of them."""),
+        timeout=Parameter(
+            args=("--timeout",),
+            metavar='SECONDS',
+            doc="""with 'wait' or 'watch', give up after this many
+            seconds.""",
+            constraints=EnsureFloat() | EnsureNone()),
+        workers=Parameter(
+            args=("--workers",),
+            metavar='N',
+            doc="""with 'watch', number of job outputs that are validated
+            and extracted concurrently. The dataset itself is only ever
+            modified by a single merge at a time. With 'merge --worktree',
+            number of merges that run concurrently.""",
+            constraints=EnsureInt()),
+        batch=Parameter(
+            args=("--batch",),
+            action='store_true',
+            doc="""with 'merge', merge the outputs of all jobs of a
+            submission at once, and record them in a single commit. The
+            run record of this commit lists the command and exit code of
+            each job. By default, each job is merged into a commit of its
+            own."""),
+        partial=Parameter(
+            args=("--partial",),
+            action='store_true',
+            doc="""with 'merge', merge the partial results of jobs that are
+            still running, i.e. the checkpoints they sent back so far (see
+            the 'checkpoint_interval' job configuration setting). Jobs
+            remain, their further checkpoints or final results can be
+            merged later on."""),
+        worktree=Parameter(
+            args=("--worktree",),
+            action='store_true',
+            doc="""with 'merge', merge each job (or each submission with
+            [CMD: --batch CMD][PY: `batch` PY]) in a temporary worktree of
+            its own, several at a time. The resulting commits are merged
+            into the checked out branch at the end, with a single
+            (fast-forward or octopus) merge. Until then, the dataset's
+            working tree is left untouched. Jobs whose outputs overlap
+            cannot be merged this way."""),
+        max_pending=Parameter(
+            args=("--max-pending",),
+            metavar='N',
+            doc="""with 'watch', maximum number of jobs that are extracted
+            but not yet merged. No further job is extracted, until the
+            merge caught up.""",
+            constraints=EnsureInt()),
     )
 
     @staticmethod
@@ -102,30 +229,104 @@ class HTCResults(Interface):
             dataset=None,
             submission=None,
             job=None,
-            all=False):
+            all=False,
+            state=None,
+            older_than=None,
+            newer_than=None,
+            command=None,
+            any=False,
+            timeout=None,
+            workers=4,
+            max_pending=16,
+            batch=False,
+            partial=False,
+            worktree=False):
 
         ds = require_dataset(
             dataset,
             check_installed=True,
             purpose='handling results of remote command executions')
 
+        if cmd == 'rebuild':
+            submissions_dir = get_submissions_dir(ds)
+            with Catalog(submissions_dir) as catalog:
+                catalog.rebuild()
+            yield dict(
+                action='htc_results_rebuild',
+                status='ok',
+                path=text_type(submissions_dir / Catalog.filename),
+                refds=text_type(ds.pathobj),
+                submission='',
+                logger=lgr)
+            return
+
+        filters = dict(
+            state=state,
+            older_than=_parse_age(older_than),
+            newer_than=_parse_age(newer_than),
+            cmd=command,
+        )
+
+        if isinstance(job, int):
+            job = [job]
+
+        if cmd == 'wait':
+            for res in _wait(
+                    ds, submission, job,
+                    dict(filters, state=None),
+                    target=state or 'completed',
+                    any_job=any,
+                    timeout=timeout):
+                yield res
+            return
+
+        if cmd == 'watch':
+            for res in _watch(
+                    ds, submission, job, filters,
+                    workers=workers,
+                    max_pending=max_pending,
+                    timeout=timeout):
+                yield res
+            return
+
+        if cmd == 'merge' and partial:
+            for res in _doit(ds, submission, job, _apply_checkpoints, None,
+                             filters):
+                yield res
+            return
+
+        if cmd == 'merge' and worktree:
+            for res in _merge_in_worktrees(
+                    ds, submission, job, filters,
+                    batch=batch,
+                    workers=workers):
+                yield res
+            return
+
         if cmd == 'list':
             jw = _list_job
             sw = _list_submission
         elif cmd == 'merge':
-            jw = _apply_output
+            jw = _apply_outputs if batch else _apply_output
             sw = None
         elif cmd == 'remove':
-            if not all and not submission and not job:
+            if not all and not submission and not job and \
+                    not [v for v in filters.values() if v is not None]:
                 raise ValueError(
                     "use the '--all' flag to remove all results across all "
                     "submissions")
             jw = _remove_dir
             sw = _remove_dir
+        elif cmd == 'resubmit':
+            # one new cluster per submission
+            jw = _resubmit_jobs
+            sw = None
         else:
             raise ValueError("unknown sub-command '{}'".format(cmd))
 
-        for res in _doit(ds, submission, job, jw, sw):
+        for res in _doit(ds, submission, job, jw, sw, filters,
+                         batch=(cmd == 'merge' and batch) or
+                         cmd == 'resubmit'):
             yield res
 
     @staticmethod
@@ -140,28 +341,49 @@ class HTCResults(Interface):
             if action != 'list' else '',
             sub=res['submission'],
             job=' :{}'.format(res['job']) if 'job' in res else '',
-            state=' [{}]'.format(
+            state=' [{}{}]'.format(
                 ac.color_word(
                     res['state'],
                     kw_color_map.get(res['state'], ac.MAGENTA))
-                if res.get('state', None) else 'unknown')
-            if action == 'list' else '',
+                if res.get('state', None) else 'unknown',
+                # what HTCondor has to say
+                ', {}'.format(res['condor_state'])
+                if res.get('condor_state', None) else '') +
+            (' ({} checkpoints)'.format(res['checkpoints'])
+             if res.get('checkpoints', None) else '')
+            if action in ('list', 'wait') else '',
             cmd=': {}'.format(
                 _format_cmd_shorty(res['cmd']))
             if 'cmd' in res else '',
         ))
+        if action != 'list':
+            return
+        if 'job' in res and res.get('timing', None):
+            ui.message('  {}'.format(', '.join(
+                '{} {:.1f}s'.format(name, props['seconds'])
+                for name, props in res['timing'].items())))
+        if res.get('prepare_timing', None):
+            ui.message('  prepare: {}'.format(', '.join(
+                '{} {:.1f}s'.format(name, props['seconds'])
+                for name, props in res['prepare_timing'].items())))
+        if 'job' not in res and res.get('timing', None):
+            for name, props in res['timing'].items():
+                ui.message(
+                    '  {}: p50 {p50:.1f}s, p90 {p90:.1f}s, max {max:.1f}s '
+                    '({jobs} jobs)'.format(name, **props))
 
 
 kw_color_map = {
     'remove': ac.RED,
     'merge': ac.GREEN,
+    'resubmit': ac.YELLOW,
     'completed': ac.GREEN,
     'submitted': ac.WHITE,
     'prepared': ac.YELLOW,
 }
 
 
-def _remove_dir(ds, dir, _ignored=None):
+def _remove_dir(ds, dir, *_ignored):
     common = dict(
         action='htc_result_remove',
         path=text_type(dir),
@@ -179,45 +401,103 @@ def _remove_dir(ds, dir, _ignored=None):
             **common)
 
 
-def _list_job(ds, jdir, sdir):
-    props = list(_list_submission(ds, sdir))[0]
-    job_status_path = jdir / 'status'
-    yield dict(
-        props,
-        state=job_status_path.read_text() if job_status_path.exists()
-        else props.get('state', None),
+def _list_job(ds, jdir, sdir, rec):
+    res = dict(
+        action='htc_result_list',
+        status='ok',
         path=text_type(jdir),
+        **{k: v for k, v in rec.items()
+           if k not in ('submission', 'job') and v is not None}
     )
+    # partial results sent back by a running job
+    checkpoints = _read_count(jdir / 'checkpoint_count')
+    if checkpoints:
+        res['checkpoints'] = checkpoints
+    timing = get_phases(read_timing(jdir / 'stamps' / 'timing'))
+    if timing:
+        res['timing'] = timing
+    yield res
 
 
-def _list_submission(ds, sdir):
-    submission_status_path = sdir / 'status'
-    args_path = sdir / 'runargs.json'
-    if args_path.exists():
-        try:
-            cmd = json_py.load(args_path)['cmd']
-        except Exception:
-            cmd = None
-    else:
-        cmd = None
-    yield dict(
+def _list_submission(ds, sdir, rec):
+    res = dict(
         action='htc_result_list',
         status='ok',
-        state=submission_status_path.read_text()
-        if submission_status_path.exists() else None,
         path=text_type(sdir),
-        **(dict(cmd=cmd) if cmd else {})
+        **{k: v for k, v in rec.items()
+           if k in ('state', 'cmd', 'created', 'updated') and v is not None}
     )
+    prepare_timing = get_phases(read_timing(sdir / 'timing' / 'prepare'))
+    if prepare_timing:
+        res['prepare_timing'] = prepare_timing
+    # jobs that were merged already are accounted for too
+    timing = aggregate(
+        get_phases(read_timing(p)) for p in _get_timing_paths(sdir))
+    if timing:
+        res['timing'] = timing
+    yield res
+
+
+def _get_timing_paths(sdir):
+    """Return the paths of the timing records of all jobs of a submission
+
+    The record kept for a merged job supersedes the one in its job dir.
+    """
+    paths = {}
+    for p in sdir.glob('job_*/stamps/timing'):
+        paths[p.parent.parent.name] = p
+    for p in sdir.glob('timing/job_*'):
+        paths[p.name] = p
+    return [paths[k] for k in sorted(paths)]
+
+
+def _cache_output(jdir, sdir, rec):
+    """Keep the outputs of a merged job in the result cache
+
+    Only jobs that were prepared with the cache enabled, and did not fail,
+    are considered.
+    """
+    if not (jdir / 'cache_key').exists() or \
+            (rec or {}).get('exit_code', None):
+        return
+    try:
+        jobcfg = json_py.load(text_type(sdir / 'jobcfg.json'))
+        cache = get_result_cache(sdir.parent, jobcfg)
+        if cache is not None:
+            cache.put((jdir / 'cache_key').read_text().strip(), jdir)
+    except Exception as e:
+        lgr.debug('Could not cache the outputs of %s: %s',
+                  jdir, exc_str(e))
 
 
-def _apply_output(ds, jdir, sdir):
+def _keep_timing(jdir, sdir, timer=None):
+    """Keep the timing record of a job in its submission dir
+
+    Execute-side timing would otherwise vanish with the job dir, once its
+    results are merged. The phases of the merge itself are appended.
+    """
+    kept = sdir / 'timing' / jdir.name
+    try:
+        if not kept.exists() and (jdir / 'stamps' / 'timing').exists():
+            if not kept.parent.exists():
+                kept.parent.mkdir()
+            shutil.copyfile(text_type(jdir / 'stamps' / 'timing'),
+                            text_type(kept))
+        if timer is not None:
+            timer.write(kept)
+    except (IOError, OSError) as e:
+        lgr.debug('Could not keep the timing record of %s: %s',
+                  jdir, exc_str(e))
+
+
+def _apply_output(ds, jdir, sdir, rec=None, cleanup=True, refds=None):
     common = dict(
         action='htc_result_merge',
         refds=text_type(ds.pathobj),
         path=text_type(jdir),
         logger=lgr,
     )
-    args_path = sdir / 'runargs.json'
+    args_path = _get_runargs_path(jdir, sdir)
     try:
         # anything below PY3.6 needs stringification
         runargs = json_py.load(str(args_path))
@@ -228,34 +508,164 @@ def _apply_output(ds, jdir, sdir):
             message=("could not load submission arguments from '%s': %s",
                      args_path, exc_str(e)))
         return
+    timer = Timer()
+    timer.phase('merge_prep')
     # TODO check recursive status to have dataset clean
     # TODO have query limited to outputs if exlicit was given
-    # prep outputs (unlock or remove)
+    unchanged = _get_unchanged(ds, jdir)
+    for res in _prep_outputs(ds, runargs, unchanged, refds=refds):
+        yield res
+
+    # TODO need to immitate PWD change, if needed
+    timer.phase('merge_ingest')
+    staged = _get_staged_output(jdir)
+    if staged is not None:
+        # results of a job that ran on a shared file system, or that were
+        # extracted ahead of time, no need to copy anything
+        try:
+            _place_tree(staged, ds.pathobj, skip=unchanged)
+        except (IOError, OSError, ValueError) as e:
+            yield dict(
+                common,
+                status='error',
+                message=("could not place job results from '%s' in '%s': %s",
+                         str(staged), ds.path, exc_str(e)))
+            return
+    else:
+        # stream the archive into the dataset
+        try:
+            ingest_archive(ds, jdir / 'output', skip=unchanged)
+        except Exception as e:
+            yield dict(
+                common,
+                status='error',
+                message=("could not ingest job results from '%s' into '%s': "
+                         "%s", str(jdir / 'output'), ds.path, exc_str(e)))
+            return
+
+    # fake a run record, as if we would have executed locally
+    timer.phase('merge_commit')
+    for res in run_command(
+            runargs['cmd'],
+            dataset=ds,
+            inputs=runargs['inputs'],
+            outputs=runargs['outputs'],
+            expand=runargs['expand'],
+            explicit=runargs['explicit'],
+            message=runargs['message'],
+            sidecar=runargs['sidecar'],
+            # TODO pwd, exit code
+            extra_info=None,
+            inject=True):
+        yield res
+    timer.stop()
+    _keep_timing(jdir, sdir, timer)
+    _cache_output(jdir, sdir, rec)
+
+    if not cleanup:
+        return
+    res = list(_remove_dir(ds, jdir))[0]
+    res['action'] = 'htc_results_merge'
+    res['status'] = 'ok'
+    res.pop('message', None)
+    # not removing the submission files (for now), even if the last job output
+    # might be removed now. Those submissions are tiny and could be resubmitted
+    yield res
+
+
+def _get_runargs_path(jdir, sdir):
+    # job-specific arguments take precedence over those of the submission
+    args_path = jdir / 'runargs.json'
+    if not args_path.exists():
+        args_path = sdir / 'runargs.json'
+    return args_path
+
+
+def _get_pwd(ds, runargs, refds=None):
+    """Return the directory a job's command ran in, within `ds`
+
+    `runargs` report it in `refds`, the dataset the job was prepared in,
+    and `ds` may be a worktree of it.
+    """
+    if refds is None or refds.path == ds.path:
+        return runargs['pwd']
+    return op.normpath(op.join(
+        ds.path, op.relpath(runargs['pwd'], refds.path)))
+
+
+def _prep_outputs(ds, runargs, unchanged, refds=None):
+    """Unlock or remove the outputs of a job, unless they are unchanged"""
     # COPY: this is a copy of the code from run_command
-    outputs = GlobbedPaths(runargs['outputs'], pwd=runargs['pwd'],
+    outputs = GlobbedPaths(runargs['outputs'],
+                           pwd=_get_pwd(ds, runargs, refds),
                            expand=runargs['expand'] in ["outputs", "both"])
     if outputs:
         for res in _install_and_reglob(ds, outputs):
             yield res
-        for res in _unlock_or_remove(ds, outputs.expand(full=True)):
+        # outputs that are committed as-is already are left alone
+        for res in _unlock_or_remove(
+                ds, [p for p in outputs.expand(full=True)
+                     if op.relpath(p, ds.path) not in unchanged]):
             yield res
     # END COPY
 
-    # TODO need to immitate PWD change, if needed
-    # -> extract tarball
+
+def _read_count(path):
+    """Return the number in a file, or 0"""
     try:
-        stdout, stderr = Runner().run(
-            ['tar', '-xf', '{}'.format(jdir / 'output')],
-            cwd=ds.path)
-    except CommandError as e:
+        return int(path.read_text().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _apply_checkpoints(ds, jdir, sdir, rec):
+    """Merge the checkpoints a job sent back, that were not merged yet
+
+    The job dir remains, such that further checkpoints, or the final
+    results, can be merged later on.
+    """
+    common = dict(
+        action='htc_result_merge',
+        refds=text_type(ds.pathobj),
+        path=text_type(jdir),
+        logger=lgr,
+    )
+    count = _read_count(jdir / 'checkpoint_count')
+    merged = _read_count(jdir / 'checkpoint_merged')
+    if rec.get('state', None) == 'completed':
+        yield dict(
+            common,
+            status='notneeded',
+            message='job completed, its results can be merged')
+        return
+    if count <= merged:
+        yield dict(common, status='notneeded', message='no new checkpoint')
+        return
+    args_path = _get_runargs_path(jdir, sdir)
+    try:
+        runargs = json_py.load(str(args_path))
+    except Exception as e:
         yield dict(
             common,
             status='error',
-            message=("could not un-tar job results from '%s' at '%s': %s",
-                     str(jdir / 'output'), ds.path, exc_str(e)))
+            message=("could not load submission arguments from '%s': %s",
+                     args_path, exc_str(e)))
         return
+    for res in _prep_outputs(ds, runargs, set()):
+        yield res
+    # each checkpoint holds what changed since the one before
+    for i in range(merged + 1, count + 1):
+        archive = jdir / 'checkpoint_{0:d}'.format(i)
+        try:
+            ingest_archive(ds, archive)
+        except Exception as e:
+            yield dict(
+                common,
+                status='error',
+                message=("could not ingest checkpoint '%s' into '%s': %s",
+                         str(archive), ds.path, exc_str(e)))
+            return
 
-    # fake a run record, as if we would have executed locally
     for res in run_command(
             runargs['cmd'],
             dataset=ds,
@@ -263,68 +673,901 @@ def _apply_output(ds, jdir, sdir):
             outputs=runargs['outputs'],
             expand=runargs['expand'],
             explicit=runargs['explicit'],
+            message=u'{} (partial results, checkpoint {:d})'.format(
+                runargs['message'] or u'HTCondor job', count),
+            sidecar=runargs['sidecar'],
+            extra_info=dict(htcondor=dict(
+                submission=sdir.name[7:],
+                job=rec['job'],
+                checkpoint=count,
+                partial=True,
+            )),
+            inject=True):
+        yield res
+    (jdir / 'checkpoint_merged').write_text(text_type(count))
+    yield dict(common, status='ok', checkpoint=count)
+
+
+def _apply_outputs(ds, sdir, jobs, cleanup=True, refds=None):
+    """Merge the outputs of several jobs of a submission in one commit
+
+    The outputs of all jobs are validated before the dataset is modified,
+    jobs with invalid outputs are reported and left out of the merge.
+
+    Parameters
+    ----------
+    ds : Dataset
+    sdir : Path
+      Submission directory.
+    jobs : list
+      (job dir, catalog record) tuples.
+    cleanup : bool
+      Whether to remove the job dirs after the merge.
+    refds : Dataset, optional
+      Dataset the jobs were prepared in, if `ds` is a worktree of it.
+    """
+    common = dict(
+        action='htc_result_merge',
+        refds=text_type(ds.pathobj),
+        logger=lgr,
+    )
+    merged = []
+    runargs = None
+    inputs = []
+    outputs = []
+    for jdir, rec in jobs:
+        args_path = _get_runargs_path(jdir, sdir)
+        try:
+            jargs = json_py.load(str(args_path))
+            staged = _get_staged_output(jdir)
+            if staged is None and not (jdir / 'output').exists():
+                raise ValueError('no job output')
+            _check_output(ds, jdir, staged)
+        except Exception as e:
+            yield dict(
+                common,
+                status='error',
+                path=text_type(jdir),
+                job=rec['job'],
+                message=("cannot merge job output from '%s': %s",
+                         str(jdir), exc_str(e)))
+            continue
+        runargs = runargs or jargs
+        inputs.extend(i for i in (jargs['inputs'] or []) if i not in inputs)
+        outputs.extend(o for o in (jargs['outputs'] or []) if o not in outputs)
+        merged.append((jdir, rec, jargs, staged, _get_unchanged(ds, jdir)))
+    if not merged:
+        return
+
+    timer = Timer()
+    timer.phase('merge_prep')
+    # prep the outputs of all jobs at once
+    # COPY: this is a copy of the code from run_command
+    globbed = GlobbedPaths(outputs, pwd=_get_pwd(ds, runargs, refds),
+                           expand=runargs['expand'] in ["outputs", "both"])
+    # an output is left alone, if no job changes it
+    unchanged = set()
+    changed = set()
+    for jdir, _, _, _, junchanged in merged:
+        unchanged |= junchanged
+        changed |= _get_output_paths(jdir) - junchanged
+    unchanged -= changed
+    if globbed:
+        for res in _install_and_reglob(ds, globbed):
+            yield res
+        for res in _unlock_or_remove(
+                ds, [p for p in globbed.expand(full=True)
+                     if op.relpath(p, ds.path) not in unchanged]):
+            yield res
+    # END COPY
+
+    timer.phase('merge_ingest')
+    for i, (jdir, rec, jargs, staged, junchanged) in enumerate(merged):
+        try:
+            if staged is None:
+                ingest_archive(ds, jdir / 'output', skip=junchanged)
+            else:
+                _place_tree(staged, ds.pathobj, skip=junchanged)
+        except Exception as e:
+            yield dict(
+                common,
+                status='error',
+                path=text_type(jdir),
+                job=rec['job'],
+                message=("could not place job results from '%s' in '%s': %s",
+                         str(jdir), ds.path, exc_str(e)))
+            # nothing is committed, the outputs placed so far stay in the
+            # dataset, for inspection
+            for jdir, other, _, _, _ in merged:
+                if other is rec:
+                    continue
+                yield dict(
+                    common,
+                    status='error',
+                    path=text_type(jdir),
+                    job=other['job'],
+                    message=("not merged, as the results of job %s could "
+                             "not be placed", rec['job']))
+            return
+
+    # the submission's command template stands for all jobs, its job
+    # placeholders cannot be formatted again
+    timer.phase('merge_commit')
+    cmd = _load_cmd(sdir / 'runargs.json')
+    cmd = cmd.replace(u'{', u'{{').replace(u'}', u'}}') if cmd \
+        else runargs['cmd']
+    for res in run_command(
+            cmd,
+            dataset=ds,
+            inputs=inputs,
+            outputs=outputs or None,
+            expand=runargs['expand'],
+            explicit=runargs['explicit'],
             message=runargs['message'],
             sidecar=runargs['sidecar'],
-            # TODO pwd, exit code
-            extra_info=None,
+            extra_info=dict(htcondor=dict(
+                submission=sdir.name[7:],
+                jobs=[dict(job=rec['job'],
+                           # undo the protection of braces
+                           cmd=jargs['cmd'].replace(u'{{', u'{').replace(
+                               u'}}', u'}'),
+                           exit=rec.get('exit_code', None))
+                      for jdir, rec, jargs, _, _ in merged],
+            )),
             inject=True):
         yield res
+    timer.stop(jobs=len(merged))
+    # a single merge for all jobs
+    for jdir, rec, _, _, _ in merged:
+        _keep_timing(jdir, sdir)
+        _cache_output(jdir, sdir, rec)
+    timer.write(sdir / 'timing' / 'merge')
 
-    res = list(_remove_dir(ds, jdir))[0]
-    res['action'] = 'htc_results_merge'
-    res['status'] = 'ok'
-    res.pop('message', None)
-    # not removing the submission files (for now), even if the last job output
-    # might be removed now. Those submissions are tiny and could be resubmitted
-    yield res
+    if not cleanup:
+        return
+    for jdir, rec, _, _, _ in merged:
+        res = list(_remove_dir(ds, jdir))[0]
+        res['action'] = 'htc_results_merge'
+        res['status'] = 'ok'
+        res['job'] = rec['job']
+        res.pop('message', None)
+        yield res
+
+
+def _check_output(ds, jdir, staged):
+    """Raise ValueError if the outputs of a job cannot be merged safely
+
+    Parameters
+    ----------
+    ds : Dataset
+    jdir : Path
+    staged : Path or None
+      Directory with the extracted outputs, if there is one, the output
+      archive is checked otherwise.
+    """
+    if staged is not None:
+        _place_tree(staged, ds.pathobj, check_only=True)
+    elif (jdir / 'output').stat().st_size:
+        with open_archive(jdir / 'output') as tar:
+            for m in safe_members(tar, ds.path):
+                pass
+
+
+def _place_tree(src, dst, skip=None, check_only=False):
+    """Place all files underneath `src` at the same relative path in `dst`
+
+    Files are hardlinked (or copied across file systems), `src` remains
+    intact until the job dir is removed, hence an interrupted merge can
+    simply be repeated. Existing files in `dst` are replaced, unless their
+    relative path is in `skip`. With `check_only`, `dst` is not modified,
+    only checked.
+
+    Raises
+    ------
+    ValueError
+      For anything that would end up outside of `dst`, or in its .git
+      directory, by way of a symlink already in `dst`, and for symlinks
+      that point outside of `dst`, like `safe_members()` does for archives.
+    """
+    skip = skip or set()
+    rdst = op.realpath(text_type(dst))
+    for root, dirs, files in os.walk(text_type(src)):
+        relroot = op.relpath(root, text_type(src))
+        target = op.join(text_type(dst), relroot)
+        rtarget = op.realpath(target)
+        if not _is_within(rtarget, rdst) or \
+                _is_within(rtarget, op.join(rdst, '.git')):
+            raise ValueError(
+                'job output leaves the dataset: {}'.format(relroot))
+        if not op.isdir(target) and not check_only:
+            os.makedirs(target)
+        # symlinks to directories are not walked into, place them as-is
+        for f in files + [d for d in dirs if op.islink(op.join(root, d))]:
+            if op.normpath(op.join(relroot, f)) in skip:
+                continue
+            dst_file = op.join(target, f)
+            src_file = op.join(root, f)
+            if op.islink(src_file):
+                linkname = os.readlink(src_file)
+                if op.isabs(linkname) or not _is_within(
+                        op.realpath(op.join(rtarget, linkname)), rdst):
+                    raise ValueError('unsafe symlink in job output: {}'.format(
+                        op.join(relroot, f)))
+            if check_only:
+                continue
+            if op.lexists(dst_file):
+                os.unlink(dst_file)
+            if op.islink(src_file):
+                os.symlink(linkname, dst_file)
+                continue
+            try:
+                os.link(src_file, dst_file)
+            except OSError:
+                shutil.copy2(src_file, dst_file)
+
+
+def _get_output_paths(jdir):
+    """Return the paths of all outputs listed in a job's checksum manifest"""
+    manifest = jdir / 'output_files'
+    if not manifest.exists():
+        return set()
+    with manifest.open() as f:
+        return set(json.loads(l)['path'] for l in f if l.strip())
+
+
+def _get_unchanged(ds, jdir):
+    """Return the paths of a job's outputs that match what is committed"""
+    try:
+        unchanged = get_unchanged_outputs(ds, jdir / 'output_files')
+    except Exception as e:
+        lgr.debug('Cannot determine unchanged outputs of %s: %s',
+                  jdir, exc_str(e))
+        return set()
+    if unchanged:
+        lgr.debug('Skipping %d unchanged outputs of %s', len(unchanged), jdir)
+    return unchanged
+
+
+def _get_staged_output(jdir):
+    """Return the directory with the extracted outputs of a job, or None"""
+    for name in ('output.staged', 'output'):
+        if (jdir / name).is_dir():
+            return jdir / name
+    return None
+
+
+def _stage_output(jdir):
+    """Validate and extract the output archive of a job into its job dir
 
+    The outputs end up in 'output.staged', or nowhere, if anything goes
+    wrong. Any leftovers of an interrupted extraction are discarded.
+    """
+    if _get_staged_output(jdir) is not None:
+        return
+    tmp = jdir / 'output.extracting'
+    if tmp.exists():
+        shutil.rmtree(text_type(tmp))
+    tmp.mkdir()
+    output = jdir / 'output'
+    # an empty output file means there were no outputs
+    if output.stat().st_size:
+        with open_archive(output) as tar:
+            tar.extractall(text_type(tmp), members=safe_members(tar, tmp))
+    os.rename(text_type(tmp), text_type(jdir / 'output.staged'))
+
+
+# HTCondor states of jobs that will not complete without another attempt.
+# held and evicted jobs are still queued, and are removed first
+resubmit_states = ('failed', 'aborted', 'held', 'evicted')
+
+# what a job attempt leaves in a job dir, moved aside on resubmission.
+# checkpoints remain, a new attempt can resume from them
+_attempt_files = ('logs', 'status', 'stamps', 'output', 'output.staged',
+                  'output.extracting', 'output_files')
+
+
+def _get_resubmit_reason(rec):
+    """Return why a job needs another attempt, or None"""
+    if rec['state'] == 'completed':
+        if rec['exit_code']:
+            return 'exit code {}'.format(rec['exit_code'])
+        return None
+    if rec['condor_state'] in resubmit_states:
+        return rec['condor_state']
+    if rec['condor_state'] == 'terminated':
+        # ended without the postflight reporting back
+        return 'incomplete'
+    return None
+
+
+def _get_condor_id(jdir):
+    """Return the 'cluster.proc' ID of a job, as found in its log"""
+    try:
+        events, _ = read_events(jdir / 'logs' / 'log')
+    except (IOError, OSError):
+        return None
+    if not events:
+        return None
+    return '{cluster:d}.{proc:d}'.format(**events[-1])
 
-def _doit(ds, submission, job, jworker, sworker):
+
+def _retire_attempt(jdir):
+    """Move what an earlier attempt of a job left behind aside"""
+    n = len(list(jdir.glob('attempt_*'))) + 1
+    adir = jdir / 'attempt_{0:d}'.format(n)
+    adir.mkdir()
+    for name in _attempt_files:
+        if op.lexists(text_type(jdir / name)):
+            os.rename(text_type(jdir / name), text_type(adir / name))
+    # htcondor wants the log dir to exist at submit time
+    (jdir / 'logs').mkdir()
+
+
+def _resubmit_jobs(ds, sdir, items):
+    """Submit failed jobs of a submission again, in a new cluster
+
+    The submission pack is reused as is. Only the item data for the
+    cluster, i.e. which jobs to run, and a submit file referencing it
+    are written anew. Jobs that completed are left alone.
+    """
     common = dict(
+        action='htc_result_resubmit',
+        refds=text_type(ds.pathobj),
+        logger=lgr,
+    )
+    todo = []
+    for jdir, rec in items:
+        reason = _get_resubmit_reason(rec)
+        if reason is None:
+            yield dict(
+                common,
+                status='notneeded',
+                path=text_type(jdir),
+                job=rec['job'],
+                message=('job is %s',
+                         rec['state'] or rec['condor_state'] or 'unknown'))
+        else:
+            todo.append((jdir, rec, reason))
+    if not todo:
+        return
+
+    jobcfg = json_py.load(text_type(sdir / 'jobcfg.json')) \
+        if (sdir / 'jobcfg.json').exists() else {}
+    for jdir, rec, reason in todo:
+        # local jobs never remain queued
+        if jobcfg.get('backend', 'condor') == 'condor' and \
+                rec['condor_state'] in ('held', 'evicted'):
+            condor_id = _get_condor_id(jdir)
+            if condor_id is None:
+                continue
+            try:
+                Runner().run(
+                    ['condor_rm', condor_id],
+                    log_stdout=False,
+                    log_stderr=False,
+                    expect_stderr=True,
+                    expect_fail=True,
+                )
+            except CommandError as e:
+                # most likely not in the queue anymore
+                lgr.debug('Could not remove job %s from the queue: %s',
+                          condor_id, exc_str(e))
+    for jdir, rec, reason in todo:
+        _retire_attempt(jdir)
+
+    n = len(list(sdir.glob('resubmit_*.submit'))) + 1
+    jobs_file = 'jobs_resubmit_{0:d}'.format(n)
+    submit_file = 'resubmit_{0:d}.submit'.format(n)
+    indices = set(rec['job'] for jdir, rec, reason in todo)
+    with (sdir / 'jobs').open() as f:
+        items = [l for l in f if int(l.split(',', 1)[0]) in indices]
+    with (sdir / jobs_file).open('w') as f:
+        f.writelines(items)
+    (sdir / submit_file).write_text(re.sub(
+        r'^queue (.*) from \S+$',
+        r'queue \1 from {}'.format(jobs_file),
+        (sdir / 'cluster.submit').read_text(),
+        flags=re.MULTILINE))
+    try:
+        submit_cluster(sdir, submit_file, jobcfg)
+    except CommandError as e:
+        for jdir, rec, reason in todo:
+            yield dict(
+                common,
+                status='error',
+                path=text_type(jdir),
+                job=rec['job'],
+                message=('submission failed: %s', exc_str(e)))
+        return
+    (sdir / 'status').write_text(u'submitted')
+    for jdir, rec, reason in todo:
+        yield dict(
+            common,
+            status='ok',
+            path=text_type(jdir),
+            job=rec['job'],
+            reason=reason)
+
+
+def _parse_age(age):
+    """Return an age like '30', '15m', '12h', or '7d' in seconds"""
+    if age is None:
+        return None
+    units = dict(s=1, m=60, h=3600, d=24 * 3600)
+    age = age.strip()
+    if age and age[-1] in units:
+        return float(age[:-1]) * units[age[-1]]
+    return float(age)
+
+
+def _check_submission(submissions_dir, submission):
+    """Return an error result, if a submission does not exist"""
+    sdir = submissions_dir / 'submit_{}'.format(submission)
+    if sdir.is_dir():
+        return None
+    return dict(
+        action='htc_results',
+        status='error',
+        path=text_type(sdir),
+        message=("submission '%s' does not exist", submission))
+
+
+def _get_end_reason(rec):
+    """Return why a job will not change state on its own, or None"""
+    if rec['condor_state'] in final_states:
+        return "job ended"
+    elif rec['condor_state'] == 'held':
+        return "job is held"
+    elif rec['state'] == 'prepared' and rec['condor_state'] is None:
+        # e.g. submission failed
+        return "job was never submitted"
+    return None
+
+
+def _wait(ds, submission, job, filters, target, any_job, timeout):
+    """Wait for jobs to reach a state
+
+    Jobs that end, are held, or were never submitted, without having
+    reached it, are not waited for.
+    """
+    common = dict(
+        action='htc_result_wait',
         refds=text_type(ds.pathobj),
         logger=lgr,
     )
     submissions_dir = get_submissions_dir(ds)
-    if not submissions_dir.exists() or not submissions_dir.is_dir():
+    if not submissions_dir.is_dir():
         return
     if submission:
-        sdir = submissions_dir / 'submit_{}'.format(submission)
-        if not sdir.is_dir():
+        error = _check_submission(submissions_dir, submission)
+        if error:
+            yield dict(error, **common)
+            return
+    start = time.time()
+    with Catalog(submissions_dir) as catalog:
+        catalog.refresh(submission)
+        recs = catalog.get_jobs(submission=submission, jobs=job, **filters)
+        keys = set((r['submission'], r['job']) for r in recs)
+        jdirs = [submissions_dir / 'submit_{}'.format(r['submission']) /
+                 'job_{0:d}'.format(r['job']) for r in recs]
+        # the execute side reports back into the job dir, HTCondor into
+        # the job's log
+        with Watcher(d for j in jdirs for d in (j, j / 'logs')
+                     if d.is_dir()) as watcher:
+            while True:
+                reached = [r for r in recs
+                           if target in (r['state'], r['condor_state'])]
+                ended = [r for r in recs if r not in reached and
+                         _get_end_reason(r)]
+                if (any_job and reached) or \
+                        len(reached) + len(ended) == len(recs):
+                    break
+                remaining = None if timeout is None \
+                    else timeout - (time.time() - start)
+                if remaining is not None and remaining <= 0:
+                    break
+                watcher.wait(wait_poll_interval if remaining is None
+                             else min(wait_poll_interval, remaining))
+                catalog.refresh(submission)
+                recs = [r for r in catalog.get_jobs(
+                        submission=submission, jobs=job, **filters)
+                        if (r['submission'], r['job']) in keys]
+    for r in recs:
+        res = dict(
+            common,
+            submission=r['submission'],
+            job=r['job'],
+            path=text_type(
+                submissions_dir / 'submit_{}'.format(r['submission']) /
+                'job_{0:d}'.format(r['job'])),
+            **{k: r[k] for k in ('state', 'condor_state', 'exit_code')
+               if r[k] is not None})
+        if r in reached:
+            yield dict(res, status='ok')
+        elif r in ended:
             yield dict(
-                action='htc_results',
+                res,
                 status='error',
-                path=text_type(sdir),
-                message=("submission '%s' does not exist", submission),
-                **common)
+                message=("%s without reaching state '%s'",
+                         _get_end_reason(r), target))
+        elif not (any_job and reached):
+            yield dict(
+                res,
+                status='error',
+                message=("timeout while waiting for state '%s'", target))
+
+
+def _stage_worker(todo, done):
+    while True:
+        item = todo.get()
+        if item is None:
+            return
+        key, jdir = item
+        try:
+            _stage_output(jdir)
+            done.put((key, jdir, None))
+        except Exception as e:
+            done.put((key, jdir, e))
+
+
+def _watch(ds, submission, job, filters, workers, max_pending, timeout):
+    """Merge the outputs of jobs as they complete
+
+    Job outputs are extracted by a pool of worker threads, while merges
+    happen one after another. Anything a crash may leave behind is either
+    redone (extraction) or repeated (merge), hence watching can always be
+    started again.
+    """
+    common = dict(
+        refds=text_type(ds.pathobj),
+        logger=lgr,
+    )
+    submissions_dir = get_submissions_dir(ds)
+    if not submissions_dir.is_dir():
+        return
+    if submission:
+        error = _check_submission(submissions_dir, submission)
+        if error:
+            yield dict(error, **common)
             return
-    for p in submissions_dir.iterdir() \
-            if submission is None \
-            else [sdir]:
-        if sworker is not None and job is None:
-            for res in sworker(ds, p):
+
+    def get_jdir(key):
+        return submissions_dir / 'submit_{}'.format(key[0]) / \
+            'job_{0:d}'.format(key[1])
+
+    start = time.time()
+    todo = queue.Queue()
+    done = queue.Queue()
+    threads = [threading.Thread(target=_stage_worker, args=(todo, done))
+               for i in range(max(1, workers))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    # jobs handed to the workers, and not yet merged, with their latest
+    # catalog records
+    pending = {}
+    # jobs whose outputs cannot be merged
+    failed = set()
+    try:
+        with Catalog(submissions_dir) as catalog:
+            catalog.refresh(submission)
+            keys = set(
+                (r['submission'], r['job'])
+                for r in catalog.get_jobs(
+                    submission=submission, jobs=job, **filters)
+                # never submitted, nothing to wait for
+                if r['state'] != 'prepared')
+            with Watcher(d for k in keys
+                         for d in (get_jdir(k), get_jdir(k) / 'logs')
+                         if d.is_dir()) as watcher:
+                while True:
+                    recs = [r for r in catalog.get_jobs(
+                            submission=submission, jobs=job, **filters)
+                            if (r['submission'], r['job']) in keys]
+                    for r in recs:
+                        key = (r['submission'], r['job'])
+                        if key in pending:
+                            # e.g. its exit code was logged meanwhile
+                            pending[key] = r
+                            continue
+                        if r['state'] != 'completed' or key in failed:
+                            continue
+                        if len(pending) >= max_pending:
+                            break
+                        pending[key] = r
+                        todo.put((key, get_jdir(key)))
+                    # merged jobs are gone from the catalog
+                    waiting = [r for r in recs
+                               if (r['submission'], r['job']) not in failed
+                               and (r['state'] == 'completed' or
+                                    r['condor_state'] not in final_states)]
+                    if not waiting:
+                        break
+                    if timeout is not None and \
+                            time.time() - start > timeout:
+                        for r in waiting:
+                            yield dict(
+                                action='htc_result_watch',
+                                status='error',
+                                path=text_type(get_jdir(
+                                    (r['submission'], r['job']))),
+                                submission=r['submission'],
+                                job=r['job'],
+                                message='timeout while waiting for the job '
+                                        'to complete',
+                                **common)
+                        break
+                    try:
+                        key, jdir, error = done.get(timeout=1) \
+                            if pending else done.get_nowait()
+                    except queue.Empty:
+                        if not pending:
+                            watcher.wait(wait_poll_interval)
+                        catalog.refresh(submission)
+                        continue
+                    if error is not None:
+                        failed.add(key)
+                        pending.pop(key, None)
+                        yield dict(
+                            action='htc_result_merge',
+                            status='error',
+                            path=text_type(jdir),
+                            submission=key[0],
+                            job=key[1],
+                            message=("invalid job output: %s",
+                                     exc_str(error)),
+                            **common)
+                        continue
+                    # all modifications of the dataset happen here
+                    for res in _apply_output(
+                            ds, jdir, jdir.parent, pending[key]):
+                        if res.get('action', '').startswith('htc_'):
+                            if res['action'] == 'htc_results_merge' and \
+                                    res['status'] == 'ok':
+                                catalog.remove(key[0], key[1])
+                            elif res['status'] in ('error', 'impossible'):
+                                failed.add(key)
+                            yield dict(
+                                res, submission=key[0], job=key[1],
+                                **common)
+                        else:
+                            yield res
+                    pending.pop(key, None)
+                    catalog.refresh(submission)
+    finally:
+        for t in threads:
+            todo.put(None)
+
+
+def _worktree_worker(todo):
+    while True:
+        task = todo.get()
+        if task is None:
+            return
+        wds = Dataset(task['worktree'])
+        try:
+            if task['batch']:
+                results = _apply_outputs(
+                    wds, task['sdir'], task['items'], cleanup=False,
+                    refds=task['refds'])
+            else:
+                (jdir, rec), = task['items']
+                results = _apply_output(
+                    wds, jdir, task['sdir'], rec, cleanup=False,
+                    refds=task['refds'])
+            task['results'] = list(results)
+            if not [r for r in task['results']
+                    if r['status'] in ('error', 'impossible')]:
+                task['commit'] = _git_output(
+                    task['worktree'], ['rev-parse', 'HEAD']).strip()
+        except Exception as e:
+            task['error'] = e
+
+
+def _merge_in_worktrees(ds, submission, job, filters, batch, workers):
+    """Merge job outputs in temporary worktrees, then into the checkout
+
+    Each job (or submission, with `batch`) is merged into a commit of its
+    own, in a linked worktree that starts at the current HEAD. These
+    merges run concurrently and leave the dataset's working tree alone.
+    At the end all resulting commits are merged into the checked out
+    branch at once, as a fast-forward for a single commit, or an octopus
+    merge otherwise. Job outputs are only removed once they made it into
+    the branch.
+    """
+    common = dict(
+        refds=text_type(ds.pathobj),
+        logger=lgr,
+    )
+    submissions_dir = get_submissions_dir(ds)
+    if not submissions_dir.is_dir():
+        return
+    if submission:
+        error = _check_submission(submissions_dir, submission)
+        if error:
+            yield dict(error, **common)
+            return
+    try:
+        _git_output(ds.path, ['symbolic-ref', '-q', 'HEAD'])
+        base = _git_output(ds.path, ['rev-parse', 'HEAD']).strip()
+    except CommandError:
+        yield dict(
+            action='htc_results_merge',
+            status='impossible',
+            path=ds.path,
+            message='merging in worktrees requires a checked out branch',
+            **common)
+        return
+
+    with Catalog(submissions_dir) as catalog:
+        catalog.refresh(submission)
+        tasks = []
+        # records come ordered by submission
+        for rec in catalog.get_jobs(submission=submission, jobs=job,
+                                    **filters):
+            sdir = submissions_dir / 'submit_{}'.format(rec['submission'])
+            jdir = sdir / 'job_{0:d}'.format(rec['job'])
+            if not jdir.is_dir():
+                continue
+            if batch and tasks and tasks[-1]['sdir'] == sdir:
+                tasks[-1]['items'].append((jdir, rec))
+            else:
+                tasks.append(dict(sdir=sdir, items=[(jdir, rec)],
+                                  batch=batch, refds=ds))
+        if not tasks:
+            return
+
+        todo = queue.Queue()
+        try:
+            # git serializes changes to the list of worktrees anyway
+            for t in tasks:
+                t['worktree'] = tempfile.mkdtemp(
+                    prefix='worktree_', dir=text_type(submissions_dir))
+                _git_output(
+                    ds.path,
+                    ['worktree', 'add', '--detach', t['worktree'], base])
+                todo.put(t)
+            threads = [
+                threading.Thread(target=_worktree_worker, args=(todo,))
+                for i in range(max(1, min(workers, len(tasks))))]
+            for t in threads:
+                todo.put(None)
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            for t in tasks:
+                if 'worktree' in t:
+                    shutil.rmtree(t['worktree'], ignore_errors=True)
+            _git_output(ds.path, ['worktree', 'prune'])
+
+        # the only modification of the dataset's working tree
+        commits = [t['commit'] for t in tasks
+                   if t.get('commit', base) != base]
+        merge_error = None
+        if commits:
+            try:
+                _git_output(
+                    ds.path,
+                    ['merge', '--no-edit', '-m',
+                     'Merge results of {} HTCondor job{}'.format(
+                         len(commits), 's' if len(commits) > 1 else '')] +
+                    commits)
+            except CommandError as e:
+                merge_error = e
+                try:
+                    _git_output(ds.path, ['merge', '--abort'])
+                except CommandError:
+                    # nothing to abort, merge refused to start
+                    pass
+
+        for t in tasks:
+            for res in t.get('results', []):
                 if res.get('action', '').startswith('htc_'):
-                    # polish our own results
-                    yield dict(
+                    res = dict(
                         res,
-                        submission=text_type(p.name)[7:],
+                        submission=t['sdir'].name[7:],
+                        job=res.get('job', t['items'][0][1]['job']),
                         **common)
+                yield res
+            for jdir, rec in t['items']:
+                jcommon = dict(
+                    common,
+                    action='htc_results_merge',
+                    path=text_type(jdir),
+                    submission=rec['submission'],
+                    job=rec['job'],
+                )
+                if 'error' in t:
+                    yield dict(
+                        jcommon,
+                        status='error',
+                        message=("could not merge job results: %s",
+                                 exc_str(t['error'])))
+                elif 'commit' not in t:
+                    # failure was reported already
+                    continue
+                elif merge_error is not None and t['commit'] != base:
+                    yield dict(
+                        jcommon,
+                        status='error',
+                        message=("could not merge job results into the "
+                                 "checked out branch: %s",
+                                 exc_str(merge_error)))
                 else:
-                    # let others pass through
-                    yield res
-        if not p.is_dir() or not p.match('submit_*'):
-            continue
-        for j in p.iterdir() \
-                if job is None else [p / 'job_{0:d}'.format(job)]:
-            if not j.is_dir():
+                    res = list(_remove_dir(ds, jdir))[0]
+                    if res['status'] == 'ok':
+                        catalog.remove(rec['submission'], rec['job'])
+                    res.pop('message', None)
+                    yield dict(res, **dict(jcommon, status='ok'))
+
+
+def _doit(ds, submission, job, jworker, sworker, filters, batch=False):
+    common = dict(
+        refds=text_type(ds.pathobj),
+        logger=lgr,
+    )
+    submissions_dir = get_submissions_dir(ds)
+    if not submissions_dir.exists() or not submissions_dir.is_dir():
+        return
+    if submission:
+        error = _check_submission(submissions_dir, submission)
+        if error:
+            yield dict(error, **common)
+            return
+    filtered = any(v is not None for v in filters.values())
+    with Catalog(submissions_dir) as catalog:
+        catalog.refresh(submission)
+        jobs = {}
+        for rec in catalog.get_jobs(submission=submission, jobs=job,
+                                    **filters):
+            jobs.setdefault(rec['submission'], []).append(rec)
+        for srec in catalog.get_submissions(submission):
+            sub = srec['submission']
+            p = submissions_dir / 'submit_{}'.format(sub)
+            if sworker is not None and job is None and not filtered:
+                for res in sworker(ds, p, srec):
+                    if res.get('action', '').startswith('htc_'):
+                        if res['action'] == 'htc_result_remove' and \
+                                res['status'] == 'ok':
+                            catalog.remove(sub)
+                        # polish our own results
+                        yield dict(
+                            res,
+                            submission=sub,
+                            **common)
+                    else:
+                        # let others pass through
+                        yield res
+            items = [(p / 'job_{0:d}'.format(rec['job']), rec)
+                     for rec in jobs.get(sub, [])]
+            items = [(j, rec) for j, rec in items if j.is_dir()]
+            if not items:
                 continue
-            for res in jworker(ds, j, p):
+            if batch:
+                # all jobs of a submission at once, results tell which
+                # job they are about
+                results = ((None, res) for res in jworker(ds, p, items))
+            else:
+                results = ((rec['job'], res)
+                           for j, rec in items
+                           for res in jworker(ds, j, p, rec))
+            for jidx, res in results:
                 if res.get('action', '').startswith('htc_'):
+                    jidx = res.get('job', jidx)
+                    if res['action'] in ('htc_result_remove',
+                                         'htc_results_merge') and \
+                            res['status'] == 'ok' and jidx is not None:
+                        catalog.remove(sub, jidx)
+                    elif res['action'] == 'htc_result_resubmit' and \
+                            res['status'] == 'ok' and jidx is not None:
+                        catalog.reset_job(sub, jidx)
                     # polish our own results
                     yield dict(
                         res,
-                        submission=text_type(p.name)[7:],
-                        job=int(text_type(j.name)[4:]),
-                        **common)
+                        submission=sub,
+                        **dict(common, **(dict(job=jidx)
+                                          if jidx is not None else {})))
                 else:
                     # let others pass through
                     yield res
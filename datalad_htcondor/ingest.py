@@ -0,0 +1,468 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Ingest job output archives into a dataset"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from six import text_type
+
+from datalad_revolution.gitrepo import RevolutionGitRepo as GitRepo
+
+
+lgr = logging.getLogger('datalad.htcondor.ingest')
+
+
+# bytes read from an archive at once, bounds memory use
+chunk_size = 1024 * 1024
+
+# hashes of the annex backends we can compute while reading
+_backend_hashes = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'SHA512': 'sha512',
+}
+
+# leading bytes of a zstd frame, tarfile cannot read those by itself
+_zstd_magic = b'\x28\xb5\x2f\xfd'
+
+_largerthan = re.compile(r'largerthan=(\d+)\s*([kmgt]?)b?', re.IGNORECASE)
+
+
+def _is_within(path, root):
+    """Whether a (real) path is `root` or underneath it"""
+    return path == root or path.startswith(root + os.sep)
+
+
+def safe_members(tar, root):
+    """Yield all members of a tar archive, if they are safe to extract
+
+    Each member is checked against what is on disk at the time it is
+    requested, hence members must be extracted one by one, in order (like
+    `TarFile.extractall()` does), for a symlink extracted earlier to be
+    taken into account.
+
+    Parameters
+    ----------
+    tar : TarFile
+    root : str
+      Directory the archive is extracted into.
+
+    Raises
+    ------
+    ValueError
+      For any member that would end up outside the extraction directory,
+      or in its .git directory, also by way of a symlink (in the archive,
+      or in the directory already), a link that points outside of it, or
+      a member that is not a plain file, directory, or link.
+    """
+    root = op.realpath(text_type(root))
+    for m in tar:
+        parts = m.name.split('/')
+        if m.name.startswith('/') or '..' in parts or '.git' in parts:
+            raise ValueError('unsafe path in archive: {}'.format(m.name))
+        if not (m.isfile() or m.isdir() or m.issym() or m.islnk()):
+            raise ValueError('unsupported member type: {}'.format(m.name))
+        target = op.join(root, m.name)
+        # where the member is written to, a symlink member replaces
+        # whatever is in its place, but not its parent directories
+        rdir = op.realpath(target if m.isdir() else op.dirname(target))
+        if not _is_within(rdir, root) or \
+                _is_within(rdir, op.join(root, '.git')):
+            raise ValueError(
+                'archive member leaves the extraction directory: {}'.format(
+                    m.name))
+        if m.issym() and (
+                op.isabs(m.linkname) or
+                not _is_within(op.realpath(op.join(rdir, m.linkname)),
+                               root)):
+            raise ValueError('unsafe symlink in archive: {}'.format(m.name))
+        if m.islnk() and (
+                op.isabs(m.linkname) or
+                '..' in m.linkname.split('/') or
+                not _is_within(op.realpath(op.join(root, m.linkname)),
+                               root)):
+            raise ValueError('unsafe hardlink in archive: {}'.format(m.name))
+        yield m
+
+
+@contextmanager
+def open_archive(path):
+    """Open a job output archive for reading, whatever its compression
+
+    Plain tar archives and gzip, bzip2, or xz compressed ones are read
+    directly, zstd compressed ones are streamed through the `zstd` tool.
+    In the latter case members can only be accessed in order.
+    """
+    with open(text_type(path), 'rb') as f:
+        magic = f.read(len(_zstd_magic))
+    if magic != _zstd_magic:
+        with tarfile.open(text_type(path)) as tar:
+            yield tar
+        return
+    try:
+        proc = subprocess.Popen(
+            ['zstd', '-dcq', text_type(path)], stdout=subprocess.PIPE)
+    except OSError as e:
+        raise RuntimeError(
+            'zstd is required to read {}: {}'.format(path, e))
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            yield tar
+    finally:
+        # a truncated stream fails reading, zstd's exit does not matter
+        proc.stdout.close()
+        proc.wait()
+
+
+def annex_extension(path, maxlen=4):
+    """Return the extension git-annex puts into the key of a file
+
+    Up to two extensions of at most `maxlen` alphanumeric characters each
+    are kept, e.g. '.tar.gz'.
+    """
+    exts = op.basename(path).split('.')[1:]
+    keep = []
+    for e in reversed(exts):
+        if len(keep) == 2 or len(e) > maxlen or \
+                not all(c.isalnum() and ord(c) < 128 for c in e):
+            break
+        if e:
+            keep.insert(0, e)
+    return ''.join('.' + e for e in keep)
+
+
+def goes_to_git(largefiles, size, head):
+    """Whether a file is committed to git, rather than annexed
+
+    Only the common `annex.largefiles` expressions are understood, anything
+    else is annexed, like git-annex does by default.
+
+    Parameters
+    ----------
+    largefiles : str or None
+      Value of the `annex.largefiles` attribute of the file.
+    size : int
+    head : bytes
+      Leading bytes of the file content.
+    """
+    if largefiles in (None, '', 'unspecified', 'unset', 'anything'):
+        return False
+    if largefiles == 'nothing':
+        return True
+    if 'mimetype=text/' in largefiles or 'mimeencoding=binary' in largefiles:
+        # e.g. text2git, text goes to git
+        return b'\0' not in head
+    match = _largerthan.search(largefiles)
+    if match:
+        factor = 1024 ** ('kmgt'.index(match.group(2).lower()) + 1) \
+            if match.group(2) else 1
+        return size <= int(match.group(1)) * factor
+    return False
+
+
+class _CheckAttr(object):
+    """Query the `annex.largefiles` attribute of paths, one at a time"""
+    def __init__(self, path):
+        self._proc = subprocess.Popen(
+            ['git', 'check-attr', '-z', '--stdin', 'annex.largefiles'],
+            cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def __call__(self, path):
+        self._proc.stdin.write(path.encode('utf-8') + b'\0')
+        self._proc.stdin.flush()
+        # <path> NUL <attribute> NUL <value> NUL
+        fields = []
+        buf = b''
+        while len(fields) < 3:
+            c = self._proc.stdout.read(1)
+            if not c:
+                raise RuntimeError('git check-attr ended prematurely')
+            if c == b'\0':
+                fields.append(buf)
+                buf = b''
+            else:
+                buf += c
+        return fields[2].decode('utf-8')
+
+    def close(self):
+        if self._proc.returncode is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+
+def _copy_member(src, dst, hasher=None, head=b''):
+    if head:
+        dst.write(head)
+        if hasher:
+            hasher.update(head)
+    while True:
+        chunk = src.read(chunk_size)
+        if not chunk:
+            break
+        dst.write(chunk)
+        if hasher:
+            hasher.update(chunk)
+
+
+def _remove(path):
+    if op.isdir(path) and not op.islink(path):
+        shutil.rmtree(path)
+    elif op.lexists(path):
+        os.unlink(path)
+
+
+def _parse_key(key):
+    """Return (backend, size, hash) of an annex key, or None"""
+    try:
+        fields, digest = key.split('--', 1)
+        fields = fields.split('-')
+        size = [int(f[1:]) for f in fields[1:] if f.startswith('s')]
+    except ValueError:
+        return None
+    if not size:
+        return None
+    # strip any extension
+    return fields[0], size[0], digest.split('.', 1)[0]
+
+
+def get_unchanged_outputs(ds, manifest):
+    """Return the paths of job outputs that are identical to committed ones
+
+    Parameters
+    ----------
+    ds : Dataset
+    manifest : Path
+      Checksums of the outputs of a job, as recorded on the execute side.
+
+    Returns
+    -------
+    set
+      Paths relative to the dataset root, of outputs whose content matches
+      the annex key or git blob in HEAD, and which are unmodified in the
+      worktree.
+    """
+    if not manifest.exists():
+        return set()
+    entries = {}
+    with manifest.open() as f:
+        for line in f:
+            if line.strip():
+                e = json.loads(line)
+                entries[e['path']] = e
+    if not entries:
+        return set()
+    unchanged = set()
+    paths = sorted(entries)
+    for i in range(0, len(paths), 500):
+        batch = paths[i:i + 500]
+        out = subprocess.check_output(
+            ['git', 'ls-tree', '-r', '-z', 'HEAD', '--'] + batch,
+            cwd=ds.path)
+        modified = set(subprocess.check_output(
+            ['git', 'diff', '--name-only', '-z', 'HEAD', '--'] + batch,
+            cwd=ds.path).decode('utf-8').split('\0'))
+        for rec in out.decode('utf-8').split('\0'):
+            if not rec:
+                continue
+            meta, path = rec.split('\t', 1)
+            mode, _, sha = meta.split()
+            e = entries.get(path, None)
+            if e is None or path in modified:
+                continue
+            if sha == e['gitsha']:
+                # the very same blob, file or symlink
+                unchanged.add(path)
+            elif mode == '120000' and not e.get('symlink', False):
+                # annexed, compare with the key
+                try:
+                    key = _parse_key(
+                        op.basename(os.readlink(op.join(ds.path, path))))
+                except OSError:
+                    key = None
+                if key is None:
+                    continue
+                backend, size, digest = key
+                hash_name = _backend_hashes.get(
+                    backend[:-1] if backend.endswith('E') else backend, None)
+                if size == e['size'] and hash_name and \
+                        e.get(hash_name, None) == digest:
+                    unchanged.add(path)
+    return unchanged
+
+
+def _get_common_dir(path):
+    """Return the git dir shared by all worktrees of a repository"""
+    try:
+        common = subprocess.check_output(
+            ['git', 'rev-parse', '--git-common-dir'],
+            cwd=path).decode('utf-8').strip()
+    except subprocess.CalledProcessError:
+        common = None
+    if not common or common.startswith('--'):
+        # git too old to know about worktrees
+        common = GitRepo.get_git_dir(path)
+    return op.normpath(op.join(path, common))
+
+
+def _extract(ds, archive, skip):
+    with open_archive(archive) as tar:
+        for m in safe_members(tar, ds.path):
+            if op.normpath(m.name) in skip:
+                continue
+            if not m.isdir():
+                _remove(op.join(ds.path, m.name))
+            tar.extract(m, ds.path)
+
+
+def ingest_archive(ds, archive, skip=None):
+    """Place the content of a job output archive in a dataset
+
+    Each file is read from the archive exactly once. Content that is to
+    be annexed is hashed while it is read and written straight into the
+    annex object store, the worktree only receives the annex symlink.
+    Other files are written into the worktree as-is. The result needs to
+    be saved, like any other modification.
+
+    If the dataset has no annex, or one that cannot be fed this way (an
+    unsupported backend, or a file system that needs unlocked files),
+    the archive is simply extracted into the worktree.
+
+    Parameters
+    ----------
+    ds : Dataset
+    archive : Path
+      A (possibly compressed) tar archive, paths relative to the dataset
+      root. See `open_archive()` for supported compressions.
+    skip : set, optional
+      Paths (relative to the dataset root) of files to leave alone.
+
+    Raises
+    ------
+    ValueError
+      For unsafe archive content.
+    """
+    if archive.stat().st_size == 0:
+        # no outputs
+        return
+    skip = skip or set()
+    cfg = ds.config
+    backend = (cfg.get('annex.backends', None) or 'MD5E').split()[0]
+    hash_name = _backend_hashes.get(
+        backend[:-1] if backend.endswith('E') else backend, None)
+    if not cfg.get('annex.uuid', None) or hash_name is None or \
+            cfg.getbool('annex', 'crippledfilesystem', False) or \
+            cfg.get('annex.thin', None):
+        lgr.debug('Cannot stream %s into the annex, extracting', archive)
+        _extract(ds, archive, skip)
+        return
+
+    annex_dir = op.join(_get_common_dir(ds.path), 'annex')
+    tmp_dir = op.join(annex_dir, 'tmp')
+    if not op.isdir(tmp_dir):
+        os.makedirs(tmp_dir)
+    maxlen = int(cfg.get('annex.maxextensionlength', None) or 4)
+    # (path, key, temp file)
+    annexed = []
+    tmp = None
+    check_attr = _CheckAttr(ds.path)
+    try:
+        with open_archive(archive) as tar:
+            for m in safe_members(tar, ds.path):
+                if op.normpath(m.name) in skip:
+                    continue
+                path = op.normpath(op.join(ds.path, m.name))
+                if m.isdir():
+                    if not op.isdir(path):
+                        _remove(path)
+                        os.makedirs(path)
+                    continue
+                if not op.isdir(op.dirname(path)):
+                    os.makedirs(op.dirname(path))
+                _remove(path)
+                if m.issym() or m.islnk():
+                    # links are rare in outputs, nothing to gain here
+                    tar.extract(m, ds.path)
+                    continue
+                src = tar.extractfile(m)
+                head = src.read(8192)
+                if goes_to_git(check_attr(op.relpath(path, ds.path)),
+                               m.size, head):
+                    with open(path, 'wb') as dst:
+                        _copy_member(src, dst, head=head)
+                    os.chmod(path, m.mode & 0o777 | stat.S_IWUSR)
+                    continue
+                hasher = hashlib.new(hash_name)
+                fd, tmp = tempfile.mkstemp(prefix='htc-', dir=tmp_dir)
+                with os.fdopen(fd, 'wb') as dst:
+                    _copy_member(src, dst, hasher=hasher, head=head)
+                key = '{}-s{:d}--{}{}'.format(
+                    backend, m.size, hasher.hexdigest(),
+                    annex_extension(path, maxlen)
+                    if backend.endswith('E') else '')
+                annexed.append((path, key, tmp))
+                tmp = None
+        check_attr.close()
+        _place_annexed(ds, annex_dir, annexed)
+    finally:
+        check_attr.close()
+        # never leave partial content behind in the annex
+        for t in [tmp] + [t for _, _, t in annexed]:
+            if t and op.lexists(t):
+                os.unlink(t)
+
+
+def _place_annexed(ds, annex_dir, annexed):
+    if not annexed:
+        return
+    keys = sorted(set(key for _, key, _ in annexed))
+    # where each key lives in the object store
+    locations = {}
+    for i in range(0, len(keys), 500):
+        out = subprocess.check_output(
+            ['git', 'annex', 'examinekey',
+             '--format=${hashdirmixed}${key}/${key}\\n'] + keys[i:i + 500],
+            cwd=ds.path)
+        for key, loc in zip(keys[i:i + 500], out.decode('utf-8').splitlines()):
+            locations[key] = loc
+    for path, key, tmp in annexed:
+        obj = op.join(annex_dir, 'objects', locations[key])
+        if not op.exists(obj):
+            if not op.isdir(op.dirname(obj)):
+                os.makedirs(op.dirname(obj))
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(tmp, obj)
+        # relative symlink through the worktree's .git, like git-annex does
+        os.symlink(
+            op.relpath(
+                op.join(ds.path, '.git', 'annex', 'objects', locations[key]),
+                op.dirname(path)),
+            path)
+    # record the new content as present
+    proc = subprocess.Popen(
+        ['git', 'annex', 'setpresentkey', '--batch'],
+        cwd=ds.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.communicate(u''.join(
+        u'{} {} 1\n'.format(key, ds.config.get('annex.uuid'))
+        for key in keys).encode('utf-8'))
+    if proc.returncode:
+        raise RuntimeError('could not record annexed job outputs as present')
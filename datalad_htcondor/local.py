@@ -0,0 +1,412 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Run the jobs of a submission pack locally, without HTCondor
+
+The local backend understands the subset of the submit file syntax that
+`htc-prepare` writes. Each job runs through the same pre-flight script,
+runner and post-flight script it would run through on an execute node,
+in a scratch dir of its own that input files are copied into (unless the
+submission is for a shared file system), with stand-ins for
+`condor_chirp` and `condor_config_val`. Its progress is reported in a
+user log, like HTCondor would, hence all of `htc-results` works with
+local jobs too.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import argparse
+import logging
+import multiprocessing
+import os
+import os.path as op
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pkg_resources import resource_string
+from six import text_type
+from six.moves import queue
+
+import datalad_revolution.utils as ut
+
+from datalad_htcondor.userlog import write_event
+
+
+lgr = logging.getLogger('datalad.htcondor.local')
+
+_macro = re.compile(r'\$\((\w+)\)')
+
+_queue_from = re.compile(r'^queue\s+(?P<vars>.*?)\s+from\s+(?P<file>\S+)$',
+                         re.IGNORECASE)
+
+
+def split_condor_args(value):
+    """Split a value in HTCondor's 'new' argument syntax
+
+    This is the reverse of `quote_condor_args()`, and is used for
+    environment specifications too.
+
+    Parameters
+    ----------
+    value : str
+      With or without the enclosing double quotes.
+
+    Returns
+    -------
+    list
+    """
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] == '"':
+        value = value[1:-1]
+    value = value.replace('""', '"')
+    args = []
+    arg = None
+    quoted = False
+    i = 0
+    while i < len(value):
+        c = value[i]
+        if quoted:
+            if c == "'" and value[i + 1:i + 2] == "'":
+                arg += c
+                i += 1
+            elif c == "'":
+                quoted = False
+            else:
+                arg += c
+        elif c == "'":
+            quoted = True
+            arg = arg or ''
+        elif c.isspace():
+            if arg is not None:
+                args.append(arg)
+                arg = None
+        else:
+            arg = (arg or '') + c
+        i += 1
+    if quoted:
+        raise ValueError('unterminated quote in {!r}'.format(value))
+    if arg is not None:
+        args.append(arg)
+    return args
+
+
+def read_submit_file(path):
+    """Read the settings and the job items of a submit file
+
+    Parameters
+    ----------
+    path : Path
+
+    Returns
+    -------
+    (dict, list)
+      Settings with lower-case names (job ClassAd attributes keep their
+      leading '+'), and for each job a dict with the values of the queue
+      variables.
+    """
+    props = {}
+    items = None
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = _queue_from.match(line)
+        if match:
+            variables = [v.strip().lower()
+                         for v in match.group('vars').split(',')]
+            items = []
+            with (path.parent / match.group('file')).open() as f:
+                for l in f:
+                    if not l.strip():
+                        continue
+                    # the last variable takes the rest of the line
+                    items.append(dict(zip(
+                        variables,
+                        re.split(r'\s*,\s*|\s+', l.strip(),
+                                 maxsplit=len(variables) - 1))))
+            continue
+        if '=' not in line:
+            raise ValueError('unsupported submit file statement: {}'.format(
+                line))
+        k, v = line.split('=', 1)
+        k = k.strip().lower()
+        v = v.strip()
+        if k.startswith('+') and len(v) > 1 and v[0] == v[-1] == '"':
+            # a ClassAd string
+            v = v[1:-1]
+        props[k] = v
+    if items is None:
+        raise ValueError(
+            "no 'queue ... from ...' statement in {}".format(path))
+    return props, items
+
+
+def install_stand_ins(bindir):
+    """Place the stand-ins for HTCondor's tools in a directory"""
+    for name, script in (('condor_chirp', 'local_chirp.sh'),
+                         ('condor_config_val', 'local_config_val.sh')):
+        path = op.join(bindir, name)
+        with open(path, 'wb') as f:
+            f.write(resource_string(
+                'datalad_htcondor', 'resources/scripts/' + script))
+        os.chmod(path, 0o755)
+
+
+class _TransferError(Exception):
+    pass
+
+
+class LocalJob(object):
+    """A single job of a cluster, as HTCondor would run it
+
+    Parameters
+    ----------
+    submission_dir : Path
+      Directory of the submit file, relative paths in it are relative to
+      this directory, or to a job's initial dir.
+    props : dict
+      Submit file settings, as returned by `read_submit_file()`.
+    item : dict
+      Values of the queue variables of this job.
+    cluster, proc : int
+      Job ID.
+    """
+    def __init__(self, submission_dir, props, item, cluster, proc):
+        self.cluster = cluster
+        self.proc = proc
+        self._macros = dict(item, cluster=str(cluster), process=str(proc))
+        self._props = props
+        self.submission_dir = submission_dir
+        self.initial_dir = submission_dir / self._get('initial_dir', '.')
+        self.transfer = self._get(
+            'should_transfer_files', 'YES').upper() != 'NO'
+
+    def _get(self, name, default=''):
+        return _macro.sub(
+            lambda m: self._macros.get(m.group(1).lower(), m.group(0)),
+            self._props.get(name, default))
+
+    def _iwd_path(self, name):
+        return self.initial_dir / self._get(name)
+
+    def log(self, code, text, lines=()):
+        if 'log' in self._props:
+            write_event(self._iwd_path('log'), code, self.cluster, self.proc,
+                        text, lines)
+
+    def _transfer_in(self, scratch):
+        names = [n.strip()
+                 for n in self._get('transfer_input_files').split(',')
+                 if n.strip()]
+        for name in names:
+            src = self.initial_dir / name
+            dst = op.join(scratch, op.basename(name))
+            try:
+                if src.is_dir():
+                    shutil.copytree(text_type(src), dst)
+                else:
+                    shutil.copy2(text_type(src), dst)
+            except (IOError, OSError) as e:
+                raise _TransferError(
+                    'Transfer input files failure: {}'.format(e))
+        shutil.copy2(
+            text_type(self.submission_dir / self._get('executable')), scratch)
+
+    def _transfer_out(self, scratch):
+        names = [n.strip()
+                 for n in self._get('transfer_output_files').split(',')
+                 if n.strip()]
+        for name in names:
+            src = op.join(scratch, name)
+            dst = text_type(self.initial_dir / op.basename(name))
+            if not op.lexists(src):
+                raise _TransferError(
+                    'Transfer output files failure: {} does not '
+                    'exist'.format(name))
+            if op.isdir(dst) and not op.islink(dst):
+                shutil.rmtree(dst)
+            elif op.lexists(dst):
+                os.unlink(dst)
+            if op.isdir(src) and not op.islink(src):
+                shutil.copytree(src, dst, symlinks=True)
+            else:
+                shutil.copy2(src, dst)
+
+    def run(self, bindir):
+        """Run the job, and report its progress in its log"""
+        scratch = tempfile.mkdtemp(prefix='datalad_htc_job_') \
+            if self.transfer else text_type(self.initial_dir)
+        try:
+            if self.transfer:
+                try:
+                    self._transfer_in(scratch)
+                except _TransferError as e:
+                    self.log(12, 'Job was held.', [str(e)])
+                    return
+                executable = op.join(
+                    scratch, op.basename(self._get('executable')))
+            else:
+                executable = text_type(
+                    self.submission_dir / self._get('executable'))
+            env = dict(
+                os.environ,
+                _CONDOR_SCRATCH_DIR=scratch,
+                # HTCondor sets this to the number of cores of the slot
+                OMP_NUM_THREADS='1',
+                PATH=os.pathsep.join((bindir, os.environ.get('PATH', ''))),
+                # for the chirp stand-in
+                DATALAD_HTC_LOCAL_IWD=text_type(self.initial_dir),
+            )
+            env.update(
+                a.split('=', 1)
+                for a in split_condor_args(self._get('environment')))
+            self.log(1, 'Job executing on host: <local>')
+            with self._iwd_path('output').open('ab') as out, \
+                    self._iwd_path('error').open('ab') as err:
+                def call(cmd, args):
+                    return subprocess.call(
+                        [cmd] + split_condor_args(args),
+                        cwd=scratch, env=env, stdout=out, stderr=err)
+                exit_code = 0
+                if self._get('+precmd'):
+                    exit_code = call(op.join(scratch, self._get('+precmd')),
+                                     self._get('+prearguments'))
+                if not exit_code:
+                    exit_code = call(executable, self._get('arguments'))
+                if self._get('+postcmd'):
+                    post_exit = call(op.join(scratch, self._get('+postcmd')),
+                                     self._get('+postarguments'))
+                    exit_code = exit_code or post_exit
+            if self.transfer:
+                try:
+                    self._transfer_out(scratch)
+                except _TransferError as e:
+                    self.log(12, 'Job was held.', [str(e)])
+                    return
+            self.log(
+                5, 'Job terminated.',
+                ['(0) Abnormal termination (signal {})'.format(-exit_code)]
+                if exit_code < 0 else
+                ['(1) Normal termination (return value {})'.format(
+                    exit_code)])
+        finally:
+            if self.transfer:
+                shutil.rmtree(scratch, ignore_errors=True)
+
+
+def get_jobs(submission_dir, submit_file, cluster):
+    """Return the jobs of a submit file"""
+    props, items = read_submit_file(submission_dir / submit_file)
+    return [LocalJob(submission_dir, props, item, cluster, proc)
+            for proc, item in enumerate(items)]
+
+
+def _job_worker(todo, bindir):
+    while True:
+        job = todo.get()
+        if job is None:
+            return
+        try:
+            job.run(bindir)
+        except Exception as e:
+            lgr.error('Local job %d.%d failed: %s', job.cluster, job.proc, e)
+            job.log(9, 'Job was aborted.', [str(e)])
+
+
+def run_jobs(jobs, workers=0):
+    """Run jobs, several at a time, and return when all of them are done
+
+    Parameters
+    ----------
+    jobs : list
+      `LocalJob` instances.
+    workers : int
+      Number of jobs that run concurrently, 0 for one per CPU core.
+    """
+    bindir = tempfile.mkdtemp(prefix='datalad_htc_bin_')
+    try:
+        install_stand_ins(bindir)
+        todo = queue.Queue()
+        for job in jobs:
+            todo.put(job)
+        threads = [
+            threading.Thread(target=_job_worker, args=(todo, bindir))
+            for i in range(
+                min(workers or multiprocessing.cpu_count(), len(jobs)))]
+        for t in threads:
+            todo.put(None)
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        shutil.rmtree(bindir, ignore_errors=True)
+
+
+def submit(submission_dir, submit_file, workers=0):
+    """Queue the jobs of a submit file for local execution
+
+    Like `condor_submit`, this returns as soon as the jobs are queued.
+    They run in a detached process, whose own messages end up in
+    'local_<cluster>.log' in the submission dir.
+
+    Parameters
+    ----------
+    submission_dir : Path
+    submit_file : str
+      Name of the submit file in the submission dir.
+    workers : int
+      Number of jobs that run concurrently, 0 for one per CPU core.
+
+    Returns
+    -------
+    int
+      Cluster ID. Local clusters are numbered by their submission time.
+    """
+    cluster = int(time.time())
+    for job in get_jobs(submission_dir, submit_file, cluster):
+        job.log(0, 'Job submitted from host: <local>')
+    with open(os.devnull, 'rb') as devnull, \
+            (submission_dir / 'local_{:d}.log'.format(cluster)).open(
+                'wb') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'datalad_htcondor.local',
+             '--workers', str(workers),
+             '--cluster', str(cluster),
+             text_type(submission_dir), submit_file],
+            stdin=devnull, stdout=log, stderr=subprocess.STDOUT,
+            close_fds=True,
+            # not to be taken down with the submitting process
+            preexec_fn=os.setsid)
+    return cluster
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Run the jobs of a submission pack locally')
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='number of concurrent jobs, 0 for one per CPU core')
+    parser.add_argument(
+        '--cluster', type=int, default=0, help='cluster ID')
+    parser.add_argument('submission_dir', help='submission directory')
+    parser.add_argument('submit_file', help='name of the submit file')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    run_jobs(
+        get_jobs(ut.Path(args.submission_dir), args.submit_file,
+                 args.cluster),
+        workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1063 @@
+#!/usr/bin/env python
+#
+# execute-side helper for the pre-/postflight stages of a job
+#
+# must run with any Python (2.7 or 3.x) that may be found on an
+# execute node, hence only the standard library is used
+
+import argparse
+import errno
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+def read_manifest(path):
+    """Yield the records of a manifest file (one JSON object per line)"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def record_event(path, event, **counts):
+    """Append a timestamped event (one JSON object per line) to a file"""
+    with open(path, 'a') as f:
+        f.write(json.dumps(dict(counts, event=event, time=time.time()),
+                           sort_keys=True) + '\n')
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # may have been created concurrently
+        if e.errno != errno.EEXIST or not op.isdir(path):
+            raise
+
+
+def run_parallel(func, items, njobs):
+    """Call `func` on all `items` using `njobs` worker threads
+
+    Returns
+    -------
+    list
+      (item, exception) tuples for all failed calls.
+    """
+    todo = queue.Queue()
+    for i in items:
+        todo.put(i)
+    errors = []
+
+    def worker():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception as e:
+                errors.append((item, e))
+
+    threads = [threading.Thread(target=worker)
+               for i in range(max(1, min(njobs, len(items))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def chirp_fetch(chirp, remote, local):
+    if subprocess.call([chirp, 'fetch', remote, local]) != 0:
+        raise RuntimeError('could not fetch {}'.format(remote))
+
+
+def chirp_put(chirp, local, remote):
+    if subprocess.call([chirp, 'put', local, remote]) != 0:
+        raise RuntimeError('could not send {}'.format(remote))
+
+
+def link_file(src, dst, copy=False):
+    """Make `dst` point to the same content as `src`
+
+    A hardlink is used whenever possible, otherwise a copy (if `copy` is
+    set), or a relative symlink.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        if copy:
+            shutil.copyfile(src, dst)
+        else:
+            os.symlink(op.relpath(src, op.dirname(dst)), dst)
+
+
+# ioctl request for a copy-on-write clone of a file (Linux)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Place the content of `src` at `dst`, without duplicating it if possible
+
+    A copy-on-write clone (reflink) is made on file systems that support it.
+    Read-only content (e.g. annex objects) is hardlinked, anything else is
+    copied, such that a job can never modify the source via `dst`.
+    """
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return
+    except (IOError, OSError):
+        if op.lexists(dst):
+            os.unlink(dst)
+    if not os.stat(src).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+
+
+def content_id(entry):
+    """Return an identifier of a manifest entry's content, or None"""
+    if entry.get('key', None):
+        return entry['key']
+    if entry.get('gitsha', None):
+        return 'GITSHA1--{}'.format(entry['gitsha'])
+    return None
+
+
+class ContentCache(object):
+    """Node-local, content-addressed file cache
+
+    Can be shared by any number of concurrently running jobs. Objects are
+    never modified once they are in the cache, and never linked anywhere
+    but via hardlinks or copies, hence removing them from the cache does
+    not affect any job that uses them. Objects are made read-only, a job
+    cannot alter the cache content via a hardlink by accident.
+
+    Layout::
+
+      <root>/objects/<id>  content objects
+      <root>/access/<id>   mtime is the last time an object was used
+      <root>/tmp/          partial objects
+      <root>/lock          shared lock for use, exclusive for eviction
+    """
+    def __init__(self, root, maxsize):
+        self.root = root
+        self.maxsize = maxsize
+        for d in ('objects', 'access', 'tmp'):
+            makedirs(op.join(root, d))
+
+    def _name(self, cid):
+        # keys can be anything, keep the file names safe
+        if '/' in cid or cid.startswith('.') or len(cid) > 200:
+            return hashlib.sha256(cid.encode('utf-8')).hexdigest()
+        return cid
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        with open(op.join(self.root, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _touch(self, name):
+        # not touching the object itself, its mtime is shared with
+        # all hardlinks in any job
+        with open(op.join(self.root, 'access', name), 'a'):
+            pass
+        os.utime(op.join(self.root, 'access', name), None)
+
+    def get(self, cid, dst):
+        """Place the content of `cid` at `dst`, if it is cached
+
+        Returns
+        -------
+        bool
+          Whether the content was found in the cache.
+        """
+        name = self._name(cid)
+        obj = op.join(self.root, 'objects', name)
+        with self.lock():
+            if not op.exists(obj):
+                return False
+            link_file(obj, dst, copy=True)
+            self._touch(name)
+        return True
+
+    def put(self, cid, fetcher, dst):
+        """Obtain content via `fetcher`, add it to the cache, place at `dst`
+
+        Parameters
+        ----------
+        cid : str
+          Content identifier.
+        fetcher : callable
+          Called with a path to write the content to.
+        dst : str
+          Path to place the content at.
+        """
+        name = self._name(cid)
+        tmp = op.join(
+            self.root, 'tmp', '{}.{}.{}'.format(
+                name, os.getpid(), threading.current_thread().ident))
+        try:
+            fetcher(tmp)
+            os.chmod(tmp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            with self.lock():
+                # atomic, even if another job just did the same
+                os.rename(tmp, op.join(self.root, 'objects', name))
+                link_file(op.join(self.root, 'objects', name), dst,
+                          copy=True)
+                self._touch(name)
+        finally:
+            if op.lexists(tmp):
+                os.unlink(tmp)
+
+    def evict(self):
+        """Remove least recently used objects until within size limit"""
+        with self.lock(exclusive=True):
+            objects = []
+            total = 0
+            for name in os.listdir(op.join(self.root, 'objects')):
+                size = os.stat(op.join(self.root, 'objects', name)).st_size
+                try:
+                    used = os.stat(
+                        op.join(self.root, 'access', name)).st_mtime
+                except OSError:
+                    used = 0
+                objects.append((used, size, name))
+                total += size
+            for used, size, name in sorted(objects):
+                if total <= self.maxsize:
+                    break
+                for d in ('objects', 'access'):
+                    if op.lexists(op.join(self.root, d, name)):
+                        os.unlink(op.join(self.root, d, name))
+                total -= size
+            # leftovers of crashed jobs, nobody is writing now
+            for name in os.listdir(op.join(self.root, 'tmp')):
+                path = op.join(self.root, 'tmp', name)
+                if os.stat(path).st_mtime < time.time() - 24 * 3600:
+                    os.unlink(path)
+
+
+def group_by_key(entries):
+    """Group manifest entries that share the same content
+
+    Entries without a content identifier form a group of their own.
+
+    Returns
+    -------
+    list
+      Lists of entries, in order of first appearance.
+    """
+    groups = {}
+    order = []
+    for e in entries:
+        k = content_id(e) or ('path', e['path'])
+        if k not in groups:
+            groups[k] = []
+            order.append(k)
+        groups[k].append(e)
+    return [groups[k] for k in order]
+
+
+def fetch(args):
+    entries = list(read_manifest(args.manifest))
+    if args.skip_present:
+        entries = [e for e in entries if not is_present(e, args.dest)]
+    # create all directories in one pass
+    for d in sorted(set(op.dirname(op.join(args.dest, e['path']))
+                        for e in entries)):
+        makedirs(d)
+    # transfer the content of each annex key only once
+    groups = group_by_key(entries)
+    # largest first, many small files will fill the gaps at the end
+    groups.sort(key=lambda g: -g[0].get('size', 0))
+
+    cache = ContentCache(args.cache, args.cache_size) if args.cache else None
+
+    def get(group):
+        first = op.join(args.dest, group[0]['path'])
+        source = group[0].get('source', None) or \
+            args.source + group[0]['path']
+        cid = content_id(group[0])
+        if op.lexists(first):
+            # e.g. a symlink into the annex of a clone that has no content
+            os.unlink(first)
+        if cache is None or cid is None:
+            chirp_fetch(args.chirp, source, first)
+        elif not cache.get(cid, first):
+            cache.put(
+                cid,
+                lambda tmp: chirp_fetch(args.chirp, source, tmp),
+                first)
+        for e in group[1:]:
+            link_file(first, op.join(args.dest, e['path']))
+
+    errors = run_parallel(get, groups, args.jobs)
+    for g, exc in errors:
+        sys.stderr.write('{}: {}\n'.format(g[0]['path'], exc))
+    if cache is not None:
+        cache.evict()
+    args.counts = dict(
+        files=len(entries), bytes=sum(e.get('size', 0) for e in entries))
+    return 1 if errors else 0
+
+
+def _git(path, *args):
+    return subprocess.call(['git', '-C', path] + list(args))
+
+
+def _clone(url, commit, dest):
+    """Make a shallow clone of a dataset at a particular commit in `dest`
+
+    Returns
+    -------
+    bool
+      Whether the clone was successful.
+    """
+    if subprocess.call([
+            'git', 'clone', '-q', '--no-checkout', '--depth', '1',
+            # we need the git-annex branch too
+            '--no-single-branch', '--no-tags',
+            url, dest]) != 0:
+        return False
+    if _git(dest, 'cat-file', '-e', commit + '^{commit}') != 0 and \
+            _git(dest, 'fetch', '-q', '--depth', '1', 'origin', commit) != 0:
+        # the remote does not have this commit (yet)
+        return False
+    return _git(dest, 'checkout', '-q', commit) == 0 and \
+        _git(dest, 'annex', 'init', '-q', 'datalad-htcondor job') == 0
+
+
+def _clear_dir(path):
+    for name in os.listdir(path):
+        p = op.join(path, name)
+        if op.isdir(p) and not op.islink(p):
+            shutil.rmtree(p)
+        else:
+            os.unlink(p)
+
+
+def is_present(entry, dest):
+    """Whether the content of a manifest entry is already in `dest`
+
+    Only entries with a content identifier are considered, they
+    describe the recorded state of a file in a dataset.
+    """
+    if not content_id(entry):
+        return False
+    path = op.join(dest, entry['path'])
+    # the size tells unlocked annexed files from their pointer file
+    return op.exists(path) and os.stat(path).st_size == entry.get('size', None)
+
+
+def annex_get(args):
+    if not _clone(args.url, args.commit, args.dest):
+        sys.stderr.write(
+            'could not clone {} at {}, falling back on other means '
+            'of transport\n'.format(args.url, args.commit))
+        # leave no trace of a partial clone
+        _clear_dir(args.dest)
+        return 0
+    annexed = [e['path'] for e in read_manifest(args.manifest)
+               if e.get('key', None)]
+    # keep the command lines at a sane length
+    for i in range(0, len(annexed), 500):
+        # failure is not fatal, anything that is missing afterwards
+        # is obtained via the fallback
+        _git(args.dest, 'annex', 'get', '-q', '-J', str(args.jobs),
+             '--', *annexed[i:i + 500])
+    return 0
+
+
+def unbundle(args):
+    with open(args.bundles) as f:
+        specs = json.load(f)
+    # superdatasets first
+    specs.sort(key=lambda s: len(op.normpath(s['path']).split(os.sep))
+               if s['path'] != '.' else 0)
+    for spec in specs:
+        dest = op.normpath(op.join(args.dest, spec['path']))
+        makedirs(dest)
+        # bundles carry their commit as a private ref, named uniquely
+        if subprocess.call(['git', 'init', '-q', dest]) != 0 or \
+                any(_git(dest, 'fetch', '-q', op.abspath(b),
+                         '+refs/datalad-htc/*:refs/datalad-htc/*') != 0
+                    for b in spec['bundles']) or \
+                _git(dest, 'checkout', '-q', spec['commit']) != 0:
+            sys.stderr.write(
+                'could not restore {} from bundles, falling back on other '
+                'means of transport\n'.format(spec['path']))
+            _clear_dir(args.dest)
+            return 0
+    return 0
+
+
+def link(args):
+    entries = list(read_manifest(args.manifest))
+    # create all directories in one pass
+    for d in sorted(set(op.dirname(op.join(args.dest, e['path']))
+                        for e in entries)):
+        makedirs(d)
+
+    def place(e):
+        # annexed files are symlinks into the annex, go for the content
+        clone_file(
+            op.realpath(e.get('source', None) or args.source + e['path']),
+            op.join(args.dest, e['path']))
+
+    errors = run_parallel(place, entries, args.jobs)
+    for e, exc in errors:
+        sys.stderr.write('{}: {}\n'.format(e['path'], exc))
+    args.counts = dict(
+        files=len(entries), bytes=sum(e.get('size', 0) for e in entries))
+    return 1 if errors else 0
+
+
+def _walk_files(path):
+    """Yield all files and symlinks underneath a directory, skip .git"""
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d != '.git']
+        for f in files:
+            yield op.join(root, f)
+        # symlinks to directories are outputs too
+        for d in dirs:
+            if op.islink(op.join(root, d)):
+                yield op.join(root, d)
+
+
+def collect_outputs(source, globs=None, inputs=None, newer=None):
+    """Return the outputs of a job
+
+    With output globs, only what matches them is considered, files in
+    matching directories included. Otherwise the whole dataset is
+    searched. Inputs listed in the input manifest are only collected if
+    a glob names them, and only files that were modified after `newer`
+    are collected.
+
+    Parameters
+    ----------
+    source : str
+      Dataset directory the job ran in.
+    globs : str, optional
+      File with NUL-terminated output globs, relative to `source`.
+    inputs : str, optional
+      Input file manifest.
+    newer : float, optional
+      Modification time.
+
+    Returns
+    -------
+    dict
+      Size of each output file, by path relative to `source`.
+    """
+    source = op.abspath(source)
+    inputs = set(op.normpath(e['path']) for e in read_manifest(inputs)) \
+        if inputs and op.exists(inputs) else set()
+    # paths that were matched by a glob themselves, inputs among them are
+    # modified in place
+    explicit = set()
+    if globs:
+        with open(globs) as f:
+            globs = [g for g in f.read().split('\0') if g]
+        candidates = []
+        for g in globs:
+            if op.isabs(g) or '..' in g.split('/'):
+                sys.stderr.write('ignoring output glob outside the dataset: '
+                                 '{}\n'.format(g))
+                continue
+            for match in glob.glob(op.join(source, g)):
+                if op.isdir(match) and not op.islink(match):
+                    candidates.extend(_walk_files(match))
+                else:
+                    candidates.append(match)
+                    explicit.add(op.relpath(match, source))
+    else:
+        candidates = _walk_files(source)
+    paths = {}
+    for c in candidates:
+        path = op.relpath(c, source)
+        if path in paths or (path in inputs and path not in explicit):
+            continue
+        st = os.lstat(c)
+        if newer is not None and st.st_mtime <= newer:
+            continue
+        paths[path] = st.st_size
+    return paths
+
+
+def write_filelist(path, paths):
+    with open(path, 'w') as f:
+        for p in sorted(paths):
+            f.write('./{}\n'.format(p))
+
+
+def collect(args):
+    """Write the list of a job's outputs, one relative path per line"""
+    paths = collect_outputs(
+        args.source, globs=args.globs, inputs=args.inputs,
+        newer=os.stat(args.newer).st_mtime if args.newer else None)
+    write_filelist(args.filelist, paths)
+    report = dict(files=len(paths), bytes=sum(paths.values()))
+    args.counts = report
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f)
+    sys.stdout.write('collected {files:d} output files, {bytes:d} '
+                     'bytes\n'.format(**report))
+    return 0
+
+
+# outputs with these extensions do not gain from another compression
+compressed_extensions = (
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z',
+    '.png', '.jpg', '.jpeg', '.gif', '.mp3', '.mp4', '.mkv', '.webm',
+)
+
+
+def which(name):
+    """Return the path of an executable in PATH, or None"""
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        path = op.join(d, name)
+        if op.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def choose_compression(paths, source):
+    """Return the compression that pays off for a set of files
+
+    No compression, if most of the data is compressed already, otherwise
+    zstd, or gzip if zstd is not available.
+    """
+    total = compressed = 0
+    for p in paths:
+        size = os.lstat(op.join(source, p)).st_size
+        total += size
+        if p.lower().endswith(compressed_extensions):
+            compressed += size
+    if total and compressed * 2 >= total:
+        return 'none'
+    return 'zstd' if which('zstd') else 'gzip'
+
+
+def pack_files(filelist, source, output, compression='gzip', threads=0):
+    """Pack files into a (compressed) tar archive
+
+    Parameters
+    ----------
+    filelist : str
+      File with one path (relative to `source`) per line.
+    source : str
+    output : str
+      Archive file to write.
+    compression : {'none', 'gzip', 'zstd', 'auto'}
+    threads : int
+      Number of compression threads, 0 uses all cores.
+
+    Returns
+    -------
+    str
+      The compression that was used.
+    """
+    with open(filelist) as f:
+        paths = [l.rstrip('\n') for l in f if l.strip()]
+    if compression == 'auto':
+        compression = choose_compression(paths, source)
+    if compression == 'zstd' and not which('zstd'):
+        sys.stderr.write('zstd not available, using gzip\n')
+        compression = 'gzip'
+    if compression == 'zstd':
+        compressor = ['zstd', '-q', '-T{:d}'.format(threads)]
+    elif compression == 'gzip' and which('pigz'):
+        # multi-threaded, and compatible
+        compressor = ['pigz', '-c'] + (['-p', str(threads)] if threads else [])
+    elif compression == 'gzip':
+        compressor = ['gzip', '-c']
+    else:
+        compressor = None
+    with open(output, 'wb') as out:
+        tar = subprocess.Popen(
+            ['tar', '-cf', '-', '--files-from', op.abspath(filelist)],
+            cwd=source,
+            stdout=subprocess.PIPE if compressor else out)
+        if compressor:
+            comp = subprocess.Popen(compressor, stdin=tar.stdout, stdout=out)
+            # only the compressor reads from tar now
+            tar.stdout.close()
+            if comp.wait() != 0:
+                tar.wait()
+                raise RuntimeError('{} failed'.format(compressor[0]))
+        if tar.wait() != 0:
+            raise RuntimeError('tar failed')
+    return compression
+
+
+def pack(args):
+    """Pack files (listed one per line) into a (compressed) tar archive"""
+    compression = pack_files(
+        args.filelist, args.source, args.output,
+        compression=args.compression, threads=args.threads or 0)
+    with open(args.filelist) as f:
+        nfiles = len([l for l in f if l.strip()])
+    args.counts = dict(files=nfiles, bytes=os.path.getsize(args.output))
+    sys.stdout.write('packed {:d} output files ({})\n'.format(
+        nfiles, compression))
+    return 0
+
+
+def _is_within(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def _check_member(m, root):
+    """Raise ValueError if an archive member is unsafe to extract now
+
+    Same checks as `datalad_htcondor.ingest.safe_members()`, given the
+    real path of `root`: the member must not end up outside of `root`,
+    or in its .git directory, also by way of a symlink on disk, and
+    symlinks must not point outside of `root`. Hardlinks are not
+    supported.
+    """
+    parts = m.name.split('/')
+    if m.name.startswith('/') or '..' in parts or '.git' in parts or \
+            not (m.isfile() or m.isdir() or m.issym()):
+        raise ValueError('unsafe archive member: {}'.format(m.name))
+    target = op.join(root, m.name)
+    rdir = op.realpath(target if m.isdir() else op.dirname(target))
+    if not _is_within(rdir, root) or \
+            _is_within(rdir, op.join(root, '.git')):
+        raise ValueError(
+            'archive member leaves the extraction directory: {}'.format(
+                m.name))
+    if m.issym() and (
+            op.isabs(m.linkname) or
+            not _is_within(op.realpath(op.join(rdir, m.linkname)), root)):
+        raise ValueError('unsafe symlink in archive: {}'.format(m.name))
+
+
+def extract_archive(path, dest):
+    """Extract a (possibly zstd compressed) tar archive safely
+
+    Returns
+    -------
+    list
+      Paths of all extracted files.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    proc = None
+    if magic == b'\x28\xb5\x2f\xfd':
+        proc = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE)
+        tar = tarfile.open(fileobj=proc.stdout, mode='r|')
+    else:
+        tar = tarfile.open(path)
+    extracted = []
+    root = op.realpath(dest)
+    try:
+        for m in tar:
+            # members are checked one by one, right before they are
+            # extracted, for links extracted before to be accounted for
+            _check_member(m, root)
+            target = op.join(dest, m.name)
+            if not m.isdir() and op.lexists(target):
+                os.unlink(target)
+            tar.extract(m, dest)
+            if m.isfile():
+                extracted.append(target)
+    finally:
+        tar.close()
+        if proc is not None:
+            proc.stdout.close()
+            proc.wait()
+    return extracted
+
+
+def send_checkpoint(args, number, since):
+    """Send the outputs modified after `since` back to the submit host
+
+    Returns
+    -------
+    bool
+      Whether there was anything to send.
+    """
+    globs = op.join(args.workdir, 'output_globs')
+    paths = collect_outputs(
+        args.dataset,
+        globs=globs if op.exists(globs) else None,
+        inputs=op.join(args.workdir, 'input_files'),
+        newer=since)
+    if not paths:
+        return False
+    stamps = op.join(args.workdir, 'stamps')
+    filelist = op.join(stamps, 'checkpoint_files')
+    archive = op.join(args.workdir, 'checkpoint')
+    write_filelist(filelist, paths)
+    # leave the cores to the job
+    pack_files(filelist, args.dataset, archive,
+               compression=args.compression, threads=1)
+    chirp_put(args.chirp, archive, 'checkpoint_{:d}'.format(number))
+    os.unlink(archive)
+    # only now the checkpoint counts
+    count_file = op.join(stamps, 'checkpoint_count')
+    with open(count_file, 'w') as f:
+        f.write('{:d}'.format(number))
+    chirp_put(args.chirp, count_file, 'checkpoint_count')
+    sys.stdout.write('sent checkpoint {:d} ({:d} files)\n'.format(
+        number, len(paths)))
+    return True
+
+
+def checkpoint(args):
+    """Run a command, and periodically send its new outputs back
+
+    Each checkpoint holds the outputs that were modified since the
+    previous one. When the job is evicted, a final checkpoint is
+    attempted after the command ended.
+    """
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    stamps = op.join(args.workdir, 'stamps')
+    count_file = op.join(stamps, 'checkpoint_count')
+    number = 0
+    if op.exists(count_file):
+        # continue after the checkpoints of an earlier run
+        with open(count_file) as f:
+            number = int(f.read().strip() or 0)
+    since = os.stat(op.join(stamps, 'prep_complete')).st_mtime
+    proc = subprocess.Popen(cmd)
+    evicted = []
+
+    def forward(signum, frame):
+        evicted.append(signum)
+        proc.send_signal(signum)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, forward)
+
+    def send():
+        start = time.time()
+        try:
+            if send_checkpoint(args, number + 1, since):
+                return start
+        except Exception as e:
+            sys.stderr.write('checkpoint failed: {}\n'.format(e))
+        return None
+
+    deadline = time.time() + args.interval
+    while proc.poll() is None:
+        time.sleep(max(0, min(1, deadline - time.time())))
+        if time.time() < deadline or proc.poll() is not None:
+            continue
+        sent = send()
+        if sent is not None:
+            number += 1
+            since = sent
+        deadline = time.time() + args.interval
+    if evicted:
+        send()
+    # like a shell reports a command that was killed
+    return proc.returncode if proc.returncode >= 0 \
+        else 128 - proc.returncode
+
+
+def restore(args):
+    """Restore the outputs of an earlier run of a job from its checkpoints
+
+    Restored files count as modified now, such that they are outputs of
+    this run too.
+    """
+    count_file = op.join(args.workdir, 'stamps', 'checkpoint_count')
+    try:
+        chirp_fetch(args.chirp, 'checkpoint_count', count_file)
+    except RuntimeError:
+        # no checkpoint, a first run
+        return 0
+    with open(count_file) as f:
+        count = int(f.read().strip() or 0)
+    archive = op.join(args.workdir, 'checkpoint')
+    now = time.time()
+    for i in range(1, count + 1):
+        chirp_fetch(args.chirp, 'checkpoint_{:d}'.format(i), archive)
+        for path in extract_archive(archive, args.dest):
+            os.utime(path, (now, now))
+        os.unlink(archive)
+    sys.stdout.write('restored {:d} checkpoints\n'.format(count))
+    return 0
+
+
+def stage(args):
+    """Move files (listed one per line) into a staging directory"""
+    with open(args.filelist) as f:
+        paths = [l.rstrip('\n') for l in f if l.strip()]
+    for p in paths:
+        dst = op.join(args.dest, p)
+        makedirs(op.dirname(dst))
+        # same file system, nothing is copied
+        os.rename(op.join(args.source, p), dst)
+    return 0
+
+
+# hashes of the git-annex backends a checksum can be recorded for
+backend_hashes = {
+    'MD5': 'md5',
+    'SHA1': 'sha1',
+    'SHA256': 'sha256',
+    'SHA512': 'sha512',
+}
+
+
+def checksum_file(path, hash_name):
+    """Return a manifest entry for a file or symlink, without its path
+
+    Besides the size, the entry has the hash of the content (named after
+    the hash), and the ID git would give the content as a blob
+    (`gitsha`), all computed in a single pass.
+    """
+    if op.islink(path):
+        target = os.readlink(path)
+        if not isinstance(target, bytes):
+            target = target.encode('utf-8')
+        gitsha = hashlib.sha1(
+            'blob {:d}\0'.format(len(target)).encode('ascii') + target)
+        return dict(symlink=True, size=len(target), gitsha=gitsha.hexdigest())
+    size = os.stat(path).st_size
+    gitsha = hashlib.sha1('blob {:d}\0'.format(size).encode('ascii'))
+    h = hashlib.new(hash_name)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            gitsha.update(chunk)
+            h.update(chunk)
+    return {'size': size, 'gitsha': gitsha.hexdigest(),
+            hash_name: h.hexdigest()}
+
+
+def checksum(args):
+    """Write a manifest with checksums of files (listed one per line)"""
+    backend = args.backend[:-1] if args.backend.endswith('E') \
+        else args.backend
+    hash_name = backend_hashes.get(backend, 'md5')
+    with open(args.filelist) as f:
+        paths = [l.rstrip('\n') for l in f if l.strip()]
+    entries = []
+
+    def add(p):
+        entry = checksum_file(op.join(args.source, p), hash_name)
+        entry['path'] = op.normpath(p)
+        entries.append(entry)
+
+    errors = run_parallel(add, paths, args.jobs)
+    for p, exc in errors:
+        sys.stderr.write('{}: {}\n'.format(p, exc))
+    with open(args.manifest, 'w') as f:
+        for e in sorted(entries, key=lambda e: e['path']):
+            f.write(json.dumps(e, sort_keys=True) + '\n')
+    args.counts = dict(
+        files=len(entries), bytes=sum(e['size'] for e in entries))
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='datalad-htcondor job helper')
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+    # for subcommands that can report how long they took
+    timing = argparse.ArgumentParser(add_help=False)
+    timing.add_argument(
+        '--timing',
+        help='file to record the start and end of the subcommand in, with '
+             'the number of files and bytes it processed')
+
+    p = subparsers.add_parser(
+        'fetch', parents=[timing],
+        help='obtain the input files listed in a manifest')
+    p.add_argument('manifest', help='input file manifest')
+    p.add_argument('dest', help='directory to place the files in')
+    p.add_argument(
+        '--source', default='',
+        help='location of the dataset on the submit host, with a trailing '
+             'path separator. Manifest entries can declare an absolute '
+             '`source` location instead.')
+    p.add_argument(
+        '--chirp', default='condor_chirp',
+        help='condor_chirp executable')
+    p.add_argument(
+        '-J', '--jobs', type=int, default=4,
+        help='number of concurrent transfers')
+    p.add_argument(
+        '--cache',
+        help='node-local cache directory for file content, '
+             'shared by all jobs')
+    p.add_argument(
+        '--cache-size', type=int, default=10 * 1024 ** 3,
+        help='maximum size of the cache in bytes')
+    p.add_argument(
+        '--skip-present', action='store_true',
+        help='do not fetch unmodified files whose content is already '
+             'present in the destination')
+    p.set_defaults(func=fetch)
+
+    p = subparsers.add_parser(
+        'annex-get',
+        help='obtain the input files listed in a manifest from a shallow '
+             'clone of the dataset and its annex remotes')
+    p.add_argument('manifest', help='input file manifest')
+    p.add_argument('dest', help='(empty) directory to clone the dataset into')
+    p.add_argument('--url', required=True, help='URL to clone from')
+    p.add_argument('--commit', required=True, help='commit to check out')
+    p.add_argument(
+        '-J', '--jobs', type=int, default=4,
+        help='number of concurrent transfers')
+    p.set_defaults(func=annex_get)
+
+    p = subparsers.add_parser(
+        'unbundle',
+        help='restore the git state of a dataset and its subdatasets from '
+             'git bundles')
+    p.add_argument(
+        'bundles',
+        help='JSON file with a list of the relative `path` of each '
+             '(sub)dataset, the `commit` to check out, and the `bundles` to '
+             'fetch it from')
+    p.add_argument('dest', help='(empty) directory to restore the dataset in')
+    p.set_defaults(func=unbundle)
+
+    p = subparsers.add_parser(
+        'link', parents=[timing],
+        help='make the input files listed in a manifest available from a '
+             'shared file system, without copying them where possible')
+    p.add_argument('manifest', help='input file manifest')
+    p.add_argument('dest', help='directory to place the files in')
+    p.add_argument(
+        '--source', default='',
+        help='location of the dataset, with a trailing path separator')
+    p.add_argument(
+        '-J', '--jobs', type=int, default=4,
+        help='number of files to process concurrently')
+    p.set_defaults(func=link)
+
+    p = subparsers.add_parser(
+        'stage',
+        help='move files into a staging directory')
+    p.add_argument('filelist', help='file with one relative path per line')
+    p.add_argument('source', help='directory the paths are relative to')
+    p.add_argument('dest', help='staging directory')
+    p.set_defaults(func=stage)
+
+    p = subparsers.add_parser(
+        'collect', parents=[timing],
+        help='determine the outputs of a job')
+    p.add_argument('source', help='dataset directory the job ran in')
+    p.add_argument('filelist', help='file to write the output paths to')
+    p.add_argument(
+        '--globs',
+        help='file with NUL-terminated output globs, relative to `source`')
+    p.add_argument(
+        '--inputs', help='input file manifest, inputs are not outputs')
+    p.add_argument(
+        '--newer', help='only files modified after this one are outputs')
+    p.add_argument(
+        '--report', help='file to write the number of files and bytes to')
+    p.set_defaults(func=collect)
+
+    p = subparsers.add_parser(
+        'pack', parents=[timing],
+        help='pack files into a tar archive')
+    p.add_argument('filelist', help='file with one relative path per line')
+    p.add_argument('source', help='directory the paths are relative to')
+    p.add_argument('output', help='archive file to write')
+    p.add_argument(
+        '--compression', default='gzip',
+        choices=('none', 'gzip', 'zstd', 'auto'),
+        help="""compression of the archive, 'auto' skips compression of
+        outputs that are mostly compressed already""")
+    p.add_argument(
+        '--threads', type=int, default=0,
+        help='number of compression threads, 0 uses all cores')
+    p.set_defaults(func=pack)
+
+    p = subparsers.add_parser(
+        'checkpoint',
+        help='run a command, and periodically send its outputs back')
+    p.add_argument(
+        '--chirp', required=True, help='path to the condor_chirp binary')
+    p.add_argument(
+        '--interval', type=float, required=True,
+        help='seconds between checkpoints')
+    p.add_argument(
+        '--compression', default='gzip',
+        choices=('none', 'gzip', 'zstd', 'auto'),
+        help='compression of the checkpoint archives')
+    p.add_argument(
+        '--workdir', required=True, help='execute directory of the job')
+    p.add_argument(
+        '--dataset', required=True, help='dataset directory the job runs in')
+    p.add_argument('cmd', nargs=argparse.REMAINDER, help='command to run')
+    p.set_defaults(func=checkpoint)
+
+    p = subparsers.add_parser(
+        'restore',
+        help='restore the outputs of an earlier run from its checkpoints')
+    p.add_argument(
+        '--chirp', required=True, help='path to the condor_chirp binary')
+    p.add_argument(
+        '--workdir', required=True, help='execute directory of the job')
+    p.add_argument('dest', help='dataset directory to restore outputs in')
+    p.set_defaults(func=restore)
+
+    p = subparsers.add_parser(
+        'checksum', parents=[timing],
+        help='record checksums of files, to identify unchanged outputs')
+    p.add_argument('filelist', help='file with one relative path per line')
+    p.add_argument('source', help='directory the paths are relative to')
+    p.add_argument('manifest', help='manifest file to write')
+    p.add_argument(
+        '--backend', default='MD5E',
+        help='git-annex backend the checksum must match')
+    p.add_argument(
+        '--jobs', type=int, default=4,
+        help='number of files to process in parallel')
+    p.set_defaults(func=checksum)
+
+    args = parser.parse_args(argv)
+    timing = getattr(args, 'timing', None)
+    if timing:
+        record_event(timing, args.cmd + '_start')
+    ret = args.func(args)
+    if timing:
+        record_event(timing, args.cmd + '_end', **getattr(args, 'counts', {}))
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
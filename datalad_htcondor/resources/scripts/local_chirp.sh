@@ -0,0 +1,28 @@
+#!/bin/sh
+
+# condor_chirp stand-in of the local execution backend. Relative paths
+# on the submit side are relative to the job's initial dir, like with
+# HTCondor
+
+set -e -u
+
+remote() {
+  case "$1" in
+    /*) printf '%s' "$1" ;;
+    *) printf '%s/%s' "${DATALAD_HTC_LOCAL_IWD}" "$1" ;;
+  esac
+}
+
+cmd="$1"
+shift
+case "$cmd" in
+  fetch)
+    cp "$(remote "$1")" "$2" ;;
+  put)
+    # options (e.g. -mode) are of no relevance here
+    while [ $# -gt 2 ]; do shift; done
+    cp "$1" "$(remote "$2")" ;;
+  *)
+    echo "condor_chirp: '$cmd' is not supported by the local backend" >&2
+    exit 1 ;;
+esac
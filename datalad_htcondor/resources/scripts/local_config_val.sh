@@ -0,0 +1,11 @@
+#!/bin/sh
+
+# condor_config_val stand-in of the local execution backend, only reports
+# where to find the other stand-ins
+
+case "$1" in
+  LIBEXEC) dirname "$0" ;;
+  *)
+    echo "condor_config_val: '$1' is not known to the local backend" >&2
+    exit 1 ;;
+esac
@@ -8,44 +8,79 @@ set -e -u
 wdir="$(readlink -f .)"
 printf "postflight" > "${wdir}/status"
 
-# TODO if outputfile specification is available in the exec dir
-# loop over it and prepare a return package. If not, return everything
-# that has changes
-prep_stamp="${wdir}/stamps/prep_complete"
+# record the time of an event of the job's lifecycle
+stamp() {
+  printf '{"event": "%s", "time": %s}\n' "$1" "$(date +%s.%N)" \
+    >> "${wdir}/stamps/timing"
+}
+stamp payload_end
+stamp postflight_start
 
-# this next bit is not working
-# it is intended to build an expression
-# ( -path thisglob -o -path thatglob )
-# for the find call below to match only desired outputs
-# but I cannot get the quoting right to prevent the
-# globs from being expanded to early, but still have
-# find be able to act on them....arrrrgh
-#selector=""
-#if [ -f "${wdir}/output_globs" ]; then
-#  while IFS= read -rd '' globexp; do
-#    if [ -n "${selector}" ]; then
-#      selector="${selector} -o"
-#    fi
-#    selector="${selector} -path '${globexp}'"
-#  done < "${wdir}/output_globs"
-#fi
+prep_stamp="${wdir}/stamps/prep_complete"
+python_exec="$(command -v python3 || command -v python || true)"
 
 # TODO check what reference point the output globs have and
-# run `find` in that directory
+# evaluate them in that directory
 # for now assume it is the dataset root
 cd dataset
+: > "${wdir}/stamps/togethome"
 if [ -f "$prep_stamp" ]; then
-  # intentionally use no starting point
-  # TODO this is missing the selector expression
-  # that is built (broken) above
-  find \
-	  \( -type f -o -type l \) \
-    -newer "$prep_stamp" \
-    > "${wdir}/stamps/togethome"
+  if [ -n "${python_exec}" ]; then
+    # only look where the output globs point to, if there are any, and
+    # never return inputs that were merely touched
+    set -- --newer "$prep_stamp"
+    [ -f "${wdir}/output_globs" ] && set -- "$@" --globs "${wdir}/output_globs"
+    [ -f "${wdir}/input_files" ] && set -- "$@" --inputs "${wdir}/input_files"
+    "${python_exec}" "${wdir}/htchelper.py" collect "$@" \
+      --timing "${wdir}/stamps/timing" \
+      --report "${wdir}/stamps/collected" \
+      . "${wdir}/stamps/togethome"
+  else
+    # everything that has changes, the dataset may be a clone, git
+    # internals are not an output
+    find \
+      -name .git -prune -o \
+      \( -type f -o -type l \) \
+      -newer "$prep_stamp" \
+      -print \
+      > "${wdir}/stamps/togethome"
+  fi
 fi
 
-[ -s "${wdir}/stamps/togethome" ] && tar \
-  --files-from "${wdir}/stamps/togethome" \
-  -czf "${wdir}/output" || touch "${wdir}/output"
+# checksums of all outputs, for the merge to skip those that did not change
+# (an empty manifest makes it consider all outputs as changed)
+: > "${wdir}/output_files"
+[ -s "${wdir}/stamps/togethome" ] && \
+  "${python_exec}" "${wdir}/htchelper.py" \
+    checksum --backend "${DATALAD_HTC_ANNEX_BACKEND:-MD5E}" \
+    --timing "${wdir}/stamps/timing" \
+    "${wdir}/stamps/togethome" . "${wdir}/output_files" || \
+  : > "${wdir}/output_files"
+
+if [ "${DATALAD_HTC_SHARED_FS:-no}" = yes ]; then
+  # the execute dir is the job dir on the submission host, move the
+  # results into a staging area, there is no need to pack them up
+  mkdir "${wdir}/output"
+  [ -s "${wdir}/stamps/togethome" ] && \
+    "${python_exec}" "${wdir}/htchelper.py" \
+      stage "${wdir}/stamps/togethome" . "${wdir}/output"
+  # the input view is of no use anymore
+  cd "${wdir}"
+  rm -rf dataset
+else
+  if [ ! -s "${wdir}/stamps/togethome" ]; then
+    touch "${wdir}/output"
+  elif [ -n "${python_exec}" ]; then
+    # HTCondor sets OMP_NUM_THREADS to the number of cores of the slot
+    "${python_exec}" "${wdir}/htchelper.py" pack \
+      --timing "${wdir}/stamps/timing" \
+      --compression "${DATALAD_HTC_OUTPUT_COMPRESSION:-gzip}" \
+      --threads "${OMP_NUM_THREADS:-0}" \
+      "${wdir}/stamps/togethome" . "${wdir}/output"
+  else
+    tar --files-from "${wdir}/stamps/togethome" -czf "${wdir}/output"
+  fi
+fi
 
+stamp postflight_end
 printf "completed" > "${wdir}/status"
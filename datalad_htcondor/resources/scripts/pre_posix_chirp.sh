@@ -11,24 +11,73 @@ printf "preflight" > status
 mkdir stamps
 mkdir dataset
 
-# if there is no input spec we can go home early
-if [ ! -f input_files ]; then
-  printf "preflight_completed" > status
+# record the time of an event of the job's lifecycle
+stamp() {
+  printf '{"event": "%s", "time": %s}\n' "$1" "$(date +%s.%N)" \
+    >> stamps/timing
+}
+stamp preflight_start
+
+chirp_exec="$(condor_config_val LIBEXEC)/condor_chirp"
+python_exec="$(command -v python3 || command -v python)"
+
+fetch() {
+  if [ -n "${DATALAD_HTC_NODE_CACHE:-}" ]; then
+    # go through the node-local content cache
+    set -- \
+      --cache "${DATALAD_HTC_NODE_CACHE}" \
+      --cache-size "${DATALAD_HTC_NODE_CACHE_SIZE}" \
+      "$@"
+  fi
+  "${python_exec}" htchelper.py fetch \
+    --timing stamps/timing \
+    --chirp "${chirp_exec}" \
+    --jobs "${DATALAD_HTC_FETCH_JOBS:-4}" \
+    "$@"
+}
+
+# anything that is modified after this stamp is an output
+prep_complete() {
   touch stamps/prep_complete
-  exit 0
+  if [ "${DATALAD_HTC_CHECKPOINT_INTERVAL:-0}" != 0 ]; then
+    # outputs of an earlier, evicted run of this job
+    "${python_exec}" htchelper.py restore \
+      --chirp "${chirp_exec}" --workdir . dataset
+  fi
+  stamp preflight_end
+  printf "preflight_completed" > status
+}
+
+# container image, if it is not transferred by condor
+if [ -f container_files ]; then
+  fetch container_files .
 fi
 
-chirp_exec="$(condor_config_val LIBEXEC)/condor_chirp"
+# git state of the dataset and its subdatasets, if it was sent along
+if [ -f bundles.json ]; then
+  "${python_exec}" htchelper.py unbundle bundles.json dataset
+fi
 
-# with this preflight script we can only handle path locations
-# no URLs
+# if there is no (or an empty) input spec we can go home early
+if [ ! -s input_files ]; then
+  prep_complete
+  exit 0
+fi
+
+# chirp can only handle path locations, no URLs
 dspath_prefix="$(cat source_dataset_location)"
 
-# obtain input files
-while IFS= read -rd '' file; do
-  mkdir -p dataset/"$(dirname ${file:${#dspath_prefix}})"
-  "${chirp_exec}" fetch "${file}" dataset/"${file:${#dspath_prefix}}"
-done < input_files
+if [ "${DATALAD_HTC_ANNEX_GET:-no}" = yes ]; then
+  # clone the dataset and get annexed inputs from its remotes, directly
+  # on this node, rather than through the submit host
+  "${python_exec}" htchelper.py annex-get \
+    --url "${DATALAD_HTC_CLONE_URL}" \
+    --commit "$(cat source_dataset_commit)" \
+    --jobs "${DATALAD_HTC_FETCH_JOBS:-4}" \
+    input_files dataset
+fi
+
+# obtain (remaining) input files, several at a time
+fetch --skip-present --source "${dspath_prefix}" input_files dataset
 
-printf "preflight_completed" > status
-touch stamps/prep_complete
+prep_complete
@@ -0,0 +1,36 @@
+#!/bin/bash
+
+# pre-flight script for preparing the execution dir -- shared file system
+# version. The execute dir is the job dir in the submission pack, and
+# input files are taken straight from the dataset, based on a list
+# that the job supplied
+
+set -e -u
+
+printf "preflight" > status
+# minimum input/output setup
+# the job may run again in the same dir (e.g. after an eviction)
+rm -rf stamps dataset output
+mkdir stamps
+mkdir dataset
+
+# record the time of an event of the job's lifecycle
+stamp() {
+  printf '{"event": "%s", "time": %s}\n' "$1" "$(date +%s.%N)" \
+    >> stamps/timing
+}
+stamp preflight_start
+
+if [ -s input_files ]; then
+  python_exec="$(command -v python3 || command -v python)"
+  # a view of the inputs that avoids copying content where possible
+  "${python_exec}" htchelper.py link \
+    --timing stamps/timing \
+    --source "$(cat source_dataset_location)" \
+    --jobs "${DATALAD_HTC_FETCH_JOBS:-4}" \
+    input_files dataset
+fi
+
+stamp preflight_end
+printf "preflight_completed" > status
+touch stamps/prep_complete
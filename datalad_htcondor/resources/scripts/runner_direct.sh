@@ -6,4 +6,20 @@ set -u -e
 # run in root of dataset
 cd dataset
 
+# the payload runs until the postflight starts
+printf '{"event": "payload_start", "time": %s}\n' "$(date +%s.%N)" \
+  >> ../stamps/timing
+
+if [ "${DATALAD_HTC_CHECKPOINT_INTERVAL:-0}" != 0 ] && \
+    [ "${DATALAD_HTC_SHARED_FS:-no}" != yes ]; then
+  # periodically send outputs back, an evicted job can resume from there
+  exec "$(command -v python3 || command -v python)" ../htchelper.py \
+    checkpoint \
+    --chirp "$(condor_config_val LIBEXEC)/condor_chirp" \
+    --interval "${DATALAD_HTC_CHECKPOINT_INTERVAL}" \
+    --compression "${DATALAD_HTC_OUTPUT_COMPRESSION:-gzip}" \
+    --workdir .. --dataset . \
+    -- "$@"
+fi
+
 exec "$@"
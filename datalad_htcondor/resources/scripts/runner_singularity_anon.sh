@@ -9,10 +9,29 @@ set -u -e
 HOME="$(readlink -f .)"
 export HOME
 
+# the payload runs until the postflight starts
+printf '{"event": "payload_start", "time": %s}\n' "$(date +%s.%N)" \
+  >> stamps/timing
+
 # have an artificial home for the nobody user and make payload
 # run in the root of the dataset inside the container
-singularity exec \
+set -- singularity exec \
   --containall -H "$HOME" \
   -B "$(readlink -f dataset)":"/dataset" \
   --pwd "/dataset" \
   "$@"
+
+if [ "${DATALAD_HTC_CHECKPOINT_INTERVAL:-0}" != 0 ] && \
+    [ "${DATALAD_HTC_SHARED_FS:-no}" != yes ]; then
+  # periodically send outputs back (from outside the container), an
+  # evicted job can resume from there
+  set -- "$(command -v python3 || command -v python)" htchelper.py \
+    checkpoint \
+    --chirp "$(condor_config_val LIBEXEC)/condor_chirp" \
+    --interval "${DATALAD_HTC_CHECKPOINT_INTERVAL}" \
+    --compression "${DATALAD_HTC_OUTPUT_COMPRESSION:-gzip}" \
+    --workdir . --dataset dataset \
+    -- "$@"
+fi
+
+exec "$@"
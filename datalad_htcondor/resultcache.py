@@ -0,0 +1,206 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Outputs of earlier jobs, to not run an identical job again
+
+A job is identified by a key computed from everything that determines its
+outputs: the expanded command, the content of its inputs, the container
+image it runs in, and the job configuration. When the results of a job
+are merged, its output archive is kept in the cache under this key. A
+later job with the same key is not submitted, its job dir receives the
+cached outputs instead.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import tempfile
+import time
+from six import text_type
+
+
+lgr = logging.getLogger('datalad.htcondor.resultcache')
+
+
+# job configuration settings that do not affect the outputs of a job
+neutral_settings = (
+    'backend',
+    'fetch_jobs',
+    'local_workers',
+    'node_cache',
+    'node_cache_size',
+    'output_compression',
+    'request_cpus',
+    'request_disk',
+    'request_margin',
+    'request_memory',
+    'result_cache_size',
+)
+
+# what is kept of a job: its output archive, and the checksums of its
+# outputs, if there are any
+cached_files = ('output', 'output_files')
+
+
+def get_cache_key(cmd, pwd, outputs, inputs, container=None, commit=None,
+                  jobcfg=None):
+    """Return the key of a job
+
+    Parameters
+    ----------
+    cmd : str
+      Fully expanded command.
+    pwd : str
+      Directory the command runs in, relative to the dataset root.
+    outputs : list
+      Output globs.
+    inputs : list
+      (path, content identifier) tuples of all input files.
+    container : str, optional
+      Content key of the container image.
+    commit : str, optional
+      Commit of the dataset, for jobs that see its entire content, not
+      just their inputs.
+    jobcfg : dict, optional
+      Job configuration settings.
+
+    Returns
+    -------
+    str
+    """
+    props = dict(
+        cmd=cmd,
+        pwd=pwd,
+        outputs=sorted(outputs or []),
+        inputs=sorted(inputs),
+        container=container,
+        commit=commit,
+        jobcfg={k: v for k, v in (jobcfg or {}).items()
+                if k not in neutral_settings},
+    )
+    return hashlib.sha256(
+        json.dumps(props, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache(object):
+    """Outputs of earlier jobs, by job key
+
+    Entries are never modified once they are in the cache, and are placed
+    in job dirs via hardlinks (or copies), hence removing them from the
+    cache does not affect any job dir.
+
+    Layout::
+
+      <root>/<key>/output        output archive of a job
+      <root>/<key>/output_files  checksums of its outputs (optional)
+
+    The modification time of an entry's directory is the last time it was
+    used.
+
+    Parameters
+    ----------
+    root : Path
+    maxsize : int
+      Size in bytes the cache is trimmed to, least recently used entries
+      first.
+    """
+    def __init__(self, root, maxsize):
+        self.root = root
+        self.maxsize = maxsize
+
+    def get(self, key, jdir):
+        """Place the cached outputs of a job in a job dir, if there are any
+
+        Returns
+        -------
+        bool
+          Whether the outputs were found in the cache.
+        """
+        entry = self.root / key
+        if not entry.is_dir():
+            return False
+        try:
+            for name in cached_files:
+                if name == 'output' or (entry / name).exists():
+                    _link_file(text_type(entry / name),
+                               text_type(jdir / name))
+            os.utime(text_type(entry), None)
+        except (IOError, OSError) as e:
+            # e.g. evicted in the meantime
+            lgr.debug('Cannot use cached outputs %s: %s', entry, e)
+            for name in cached_files:
+                if op.lexists(text_type(jdir / name)):
+                    os.unlink(text_type(jdir / name))
+            return False
+        return True
+
+    def put(self, key, jdir):
+        """Keep the outputs of a job, and evict what exceeds the size limit
+
+        Only output archives are kept, not outputs a job placed in its
+        job dir directly.
+        """
+        if not (jdir / 'output').is_file():
+            return
+        entry = self.root / key
+        if entry.exists():
+            os.utime(text_type(entry), None)
+            return
+        if not self.root.exists():
+            self.root.mkdir(parents=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=text_type(self.root))
+        try:
+            for name in cached_files:
+                if (jdir / name).exists():
+                    _link_file(text_type(jdir / name), op.join(tmp, name))
+            # atomic, even if another merge just did the same
+            os.rename(tmp, text_type(entry))
+        except OSError as e:
+            lgr.debug('Cannot keep the outputs of %s: %s', jdir, e)
+        finally:
+            if op.lexists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until within size limit"""
+        entries = []
+        total = 0
+        for entry in self.root.iterdir():
+            try:
+                if entry.name.startswith('.tmp_'):
+                    # leftovers of an interrupted merge
+                    if entry.stat().st_mtime < time.time() - 24 * 3600:
+                        shutil.rmtree(text_type(entry), ignore_errors=True)
+                    continue
+                size = sum((entry / name).stat().st_size
+                           for name in cached_files
+                           if (entry / name).exists())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except OSError:
+                # removed by someone else
+                continue
+            total += size
+        for used, size, entry in sorted(entries):
+            if total <= self.maxsize:
+                break
+            shutil.rmtree(text_type(entry), ignore_errors=True)
+            total -= size
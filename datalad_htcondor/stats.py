@@ -0,0 +1,171 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Resource usage of past jobs, to size the resource requests of new ones
+
+Unlike the catalog, these statistics are not a mirror of what is on disk,
+they outlive the submissions they were gathered from.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import hashlib
+import logging
+import math
+import sqlite3
+import time
+from six import text_type
+
+
+lgr = logging.getLogger('datalad.htcondor.stats')
+
+
+# bump whenever the schema changes, past statistics are discarded then
+schema_version = 1
+
+_schema = """\
+CREATE TABLE runs (
+    signature TEXT NOT NULL,
+    submission TEXT NOT NULL,
+    job INTEGER NOT NULL,
+    cluster INTEGER NOT NULL,
+    recorded REAL,
+    runtime REAL,
+    memory INTEGER,
+    disk INTEGER,
+    cpus REAL,
+    input_bytes INTEGER,
+    output_bytes INTEGER,
+    PRIMARY KEY (submission, job, cluster)
+);
+CREATE INDEX runs_signature ON runs(signature, recorded);
+"""
+
+# number of most recent runs of a command that requests are based on
+max_runs = 50
+
+
+def get_signature(cmd):
+    """Return the signature of a command (template)
+
+    All jobs of a submission, and of any other submission of the same
+    command, share a signature.
+    """
+    return hashlib.md5(text_type(cmd or u'').encode('utf-8')).hexdigest()
+
+
+def propose_requests(runs, input_bytes, margin):
+    """Return resource requests for a job, based on past runs of its command
+
+    Parameters
+    ----------
+    runs : list
+      Records of past runs, as returned by `StatsStore.get_runs()`.
+    input_bytes : int
+      Size of the inputs that the job transfers itself, i.e. that
+      HTCondor does not know about.
+    margin : float
+      Factor to apply to what was used at most, to not run out.
+
+    Returns
+    -------
+    dict
+      HTCondor submit commands (`request_cpus`, `request_memory` in MB,
+      `request_disk` in KB) with their values, for anything that can be
+      estimated.
+    """
+    requests = {}
+    memory = [r['memory'] for r in runs if r['memory']]
+    if memory:
+        requests['request_memory'] = int(math.ceil(max(memory) * margin))
+    cpus = [r['cpus'] for r in runs if r['cpus']]
+    if cpus:
+        requests['request_cpus'] = max(1, int(round(max(cpus))))
+    # what a job needs on top of its inputs, i.e. for outputs and any
+    # temporary files
+    extra = [
+        max(0, r['disk'] * 1024 - (r['input_bytes'] or 0)) if r['disk']
+        else r['output_bytes']
+        for r in runs if r['disk'] or r['output_bytes']]
+    disk = (input_bytes or 0) + (max(extra) if extra else 0)
+    if disk:
+        requests['request_disk'] = int(math.ceil(disk * margin / 1024.))
+    return requests
+
+
+class StatsStore(object):
+    """Resource usage of past jobs, by the signature of their command
+
+    The statistics live in an SQLite database in the submissions directory.
+
+    Parameters
+    ----------
+    submissions_dir : Path
+      Directory with all submissions of a dataset.
+    """
+    filename = 'stats.sqlite'
+
+    def __init__(self, submissions_dir):
+        submissions_dir.mkdir(parents=True, exist_ok=True)
+        path = submissions_dir / self.filename
+        self._db = sqlite3.connect(text_type(path), timeout=60)
+        self._db.row_factory = sqlite3.Row
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != schema_version:
+            lgr.debug('Initializing job statistics at %s', path)
+            self._db.executescript(
+                'DROP TABLE IF EXISTS runs;\n' +
+                _schema +
+                'PRAGMA user_version = {:d};\n'.format(schema_version))
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, signature, submission, job, cluster, **usage):
+        """Record the resource usage of a job
+
+        A job that runs again (in another cluster) adds another record.
+
+        Parameters
+        ----------
+        signature : str
+          As returned by `get_signature()`.
+        submission : str
+        job : int
+        cluster : int
+        **usage
+          Any of `runtime` (seconds), `memory` (MB), `disk` (KB), `cpus`,
+          `input_bytes` and `output_bytes`.
+        """
+        props = dict(
+            usage,
+            signature=signature,
+            submission=submission,
+            job=job,
+            cluster=cluster,
+            recorded=time.time())
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO runs ({}) VALUES ({})'.format(
+                    ', '.join(props),
+                    ', '.join('?' for p in props)),
+                list(props.values()))
+
+    def get_runs(self, signature, limit=max_runs):
+        """Return the records of the most recent runs of a command"""
+        return [dict(r) for r in self._db.execute(
+            'SELECT * FROM runs WHERE signature = ? '
+            'ORDER BY recorded DESC LIMIT ?',
+            (signature, limit))]
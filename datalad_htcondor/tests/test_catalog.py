@@ -0,0 +1,53 @@
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    assert_result_count,
+    with_tempfile,
+    eq_,
+)
+from datalad_htcondor.catalog import Catalog
+from datalad_htcondor.htcprepare import get_submissions_dir
+
+
+@with_tempfile
+def test_catalog(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in.txt').write_text(u'12345')
+    ds.rev_save()
+    res = ds.htc_prepare(
+        cmd='bash -c "cat in.txt > {name}"',
+        inputs=['in.txt'],
+        jobs=[dict(name=n) for n in ('one', 'two', 'three')],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    catalog_path = get_submissions_dir(ds) / Catalog.filename
+    assert catalog_path.exists()
+
+    res = ds.htc_results('list', submission=submission)
+    # the submission and all its jobs
+    assert_result_count(res, 4)
+    assert_result_count(res, 3, state='prepared', input_bytes=5)
+
+    # job state reported by the execute side is picked up
+    (submission_dir / 'job_1' / 'status').write_text(u'completed')
+    res = ds.htc_results('list', state='completed')
+    assert_result_count(res, 1)
+    eq_(res[0]['job'], 1)
+    assert_result_count(
+        ds.htc_results('list', command='*> two*'), 1, job=1)
+    assert_result_count(ds.htc_results('list', newer_than='1h'), 3)
+    assert_result_count(ds.htc_results('list', older_than='1h'), 0)
+
+    # removal is reflected
+    assert_result_count(
+        ds.htc_results('remove', submission=submission, state='completed'),
+        1, action='htc_result_remove', status='ok')
+    assert_result_count(ds.htc_results('list', submission=submission), 3)
+
+    # recovery from a lost catalog
+    catalog_path.unlink()
+    assert_result_count(ds.htc_results('rebuild'), 1, status='ok')
+    res = ds.htc_results('list', submission=submission)
+    assert_result_count(res, 3)
+    assert_result_count(res, 2, state='prepared', input_bytes=5)
@@ -1,5 +1,14 @@
+import io
+import json
+import os
+import os.path as op
+import stat
+import subprocess
+import tarfile
 import time
 
+from six import text_type
+
 from datalad.api import (
     rev_create as create,
     containers_add,
@@ -17,9 +26,17 @@ from datalad.tests.utils import (
     eq_,
     assert_status,
     assert_in,
+    ok_,
+)
+from datalad.utils import (
+    chpwd,
+    on_windows,
+)
+from datalad_htcondor.htcprepare import (
+    get_singularity_jobspec,
+    get_submissions_dir,
+    shard_by_size,
 )
-from datalad.utils import on_windows
-from datalad_htcondor.htcprepare import get_singularity_jobspec
 
 
 # TODO implement job submission helper
@@ -41,11 +58,11 @@ def test_basic(path):
     # TODO it is a shame that we cannot pass pathobj through datalad yet
     submission_dir = ut.Path(res[-1]['path'])
     # no input_files spec was written
-    assert not (submission_dir / 'input_files').exists()
+    assert not (submission_dir / 'job_0' / 'input_files').exists()
     # we gotta wait till the results are in
-    while not (submission_dir / 'job_0' / 'logs' / 'err').exists():
-        time.sleep(1)
-    time.sleep(2)
+    assert_status(
+        'ok',
+        ds.htc_results('wait', submission=res[-1]['submission'], job=0))
     assert (submission_dir / 'job_0' / 'output').exists()
 
     # add some content to the dataset and run again
@@ -65,14 +82,10 @@ def test_basic(path):
     )
     submission = res[-1]['submission']
     submission_dir = ut.Path(res[-1]['path'])
-    assert (submission_dir / 'input_files').exists()
+    assert (submission_dir / 'job_0' / 'input_files').exists()
     # we gotta wait till the results are in
-    while not (ds.htc_results(
-            'list',
-            submission=submission,
-            job=0,
-            return_type='item-or-list')['state'] == 'completed'):
-        time.sleep(2)
+    assert_status(
+        'ok', ds.htc_results('wait', submission=submission, job=0))
     assert (submission_dir / 'job_0' / 'output').exists()
 
     # now apply the results to the original dataset
@@ -89,3 +102,561 @@ def test_basic(path):
     assert_in('myfile1.txt', ls_dump)
     assert_in('myfile2.txt', ls_dump)
 
+
+
+@with_tempfile
+def test_multijob(path):
+    ds = Dataset(path).rev_create()
+    for s in ('sub1', 'sub2', 'sub3'):
+        (ds.pathobj / s).mkdir()
+        (ds.pathobj / s / 'data.txt').write_text(s)
+    ds.rev_save()
+    res = ds.htc_prepare(
+        cmd='bash -c "ls -laR {subject} > {subject}/here"',
+        inputs=['sub1'],
+        jobs=[dict(subject=s, inputs=[s], outputs=['{}/here'.format(s)])
+              for s in ('sub1', 'sub2', 'sub3')],
+    )
+    assert_result_count(res, 1, action='htc_prepare', jobs=3)
+    submission_dir = ut.Path(res[-1]['path'])
+    # shared files exist only once
+    for f in ('pre.sh', 'post.sh', 'runner.sh', 'cluster.submit', 'jobs'):
+        assert (submission_dir / f).exists()
+    jobs = (submission_dir / 'jobs').read_text().splitlines()
+    eq_(len(jobs), 3)
+    eq_(jobs[1], u"1, 'bash' '-c' 'ls -laR sub2 > sub2/here'")
+    for i, s in enumerate(('sub1', 'sub2', 'sub3')):
+        jdir = submission_dir / 'job_{}'.format(i)
+        assert (jdir / 'logs').is_dir()
+        inputs = [json.loads(l)['path']
+                  for l in (jdir / 'input_files').read_text().splitlines()]
+        # common input plus the job-specific one
+        eq_(sorted(inputs),
+            sorted(set(op.join(d, 'data.txt') for d in ('sub1', s))))
+        eq_((jdir / 'output_globs').read_text(), u'{}/here\0'.format(s))
+    # jobs can be addressed by index
+    assert_result_count(
+        ds.htc_results('list', submission=res[-1]['submission'], job=[0, 2]),
+        2)
+
+
+def test_shard_by_size():
+    items = [(s, 'f{}'.format(s)) for s in (10, 1, 7, 3, 3, 2, 9)]
+    shards = shard_by_size(items, nshards=3)
+    eq_(len(shards), 3)
+    sizes = dict((i, s) for s, i in items)
+    eq_(sorted(sum(sizes[i] for i in s) for s in shards), [11, 12, 12])
+    # never more shards than items
+    eq_(len(shard_by_size(items[:2], nshards=5)), 2)
+    # number of shards from target size
+    eq_(len(shard_by_size(items, shard_size=12)), 3)
+
+
+@with_tempfile
+def test_sharding(path):
+    ds = Dataset(path).rev_create()
+    for i, size in enumerate((100, 10, 60, 50)):
+        (ds.pathobj / 'f{}.dat'.format(i)).write_text(u'x' * size)
+    ds.rev_save()
+    res = ds.htc_prepare(
+        cmd='cat {shard} > out_{shard_index}',
+        inputs=['f*.dat'],
+        shards=2,
+    )
+    assert_result_count(res, 1, action='htc_prepare', jobs=2)
+    submission_dir = ut.Path(res[-1]['path'])
+    jobs = (submission_dir / 'jobs').read_text().splitlines()
+    # balanced by size, largest files first
+    eq_(jobs[0], u"0, 'cat' 'f0.dat' 'f1.dat' '>' 'out_0'")
+    eq_(jobs[1], u"1, 'cat' 'f2.dat' 'f3.dat' '>' 'out_1'")
+    manifest = [json.loads(l)
+                for l in (submission_dir / 'job_1' / 'input_files').read_text(
+                ).splitlines()]
+    eq_([(r['path'], r['size']) for r in manifest],
+        [('f2.dat', 60), ('f3.dat', 50)])
+    # annexed files come with their key
+    assert all(r['key'].startswith('MD5E-s') for r in manifest)
+
+
+@with_tempfile
+def test_sharedfs(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in.txt').write_text(u'input')
+    ds.rev_save()
+    res = ds.htc_prepare(
+        cmd='bash -c "cat in.txt > out.txt"',
+        inputs=['in.txt'],
+        outputs=['out.txt'],
+        jobcfg='sharedfs',
+    )
+    assert_result_count(res, 1, action='htc_prepare')
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    submit = (submission_dir / 'cluster.submit').read_text()
+    assert_in(u'should_transfer_files = NO', submit)
+    assert u'transfer_input_files' not in submit
+    jdir = submission_dir / 'job_0'
+    # all files a job needs are in its job dir
+    for f in ('pre.sh', 'post.sh', 'htchelper.py', 'source_dataset_location',
+              'input_files'):
+        assert (jdir / f).exists()
+    eq_((submission_dir / 'pre.sh').read_text().count(u'htchelper.py link'),
+        1)
+
+    # fake the staged results of a job
+    (jdir / 'output').mkdir()
+    (jdir / 'output' / 'out.txt').write_text(u'input')
+    (jdir / 'status').write_text(u'completed')
+    assert_status(
+        'ok',
+        ds.htc_results('merge', submission=submission, job=0))
+    eq_((ds.pathobj / 'out.txt').read_text(), u'input')
+    assert not jdir.exists()
+    assert_repo_status(ds.path)
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_sharedfs_singularity_checkpoint(path, work):
+    ds = Dataset(path).rev_create()
+    ds.config.add('datalad.htcondor.jobcfg.sharedfs.checkpoint-interval',
+                  '60', where='local')
+    # an image, as far as the cached detection is concerned, no
+    # singularity needed
+    image = op.join(work, 'image.simg')
+    with open(image, 'wb') as f:
+        f.write(b'hsqs')
+    st = os.stat(image)
+    cache = get_submissions_dir(ds) / 'singularity_images.json'
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    cache.write_text(text_type(json.dumps({
+        op.realpath(image): dict(
+            stat=[st.st_ino, st.st_size, st.st_mtime], image=True)})))
+    res = ds.htc_prepare(
+        cmd='{} bash -c "echo out > out.txt"'.format(image),
+        outputs=['out.txt'],
+        jobcfg='sharedfs',
+    )
+    submission_dir = ut.Path(res[-1]['path'])
+    submit = (submission_dir / 'cluster.submit').read_text()
+    assert_in(u"DATALAD_HTC_SHARED_FS='yes'", submit)
+    assert_in(u"DATALAD_HTC_CHECKPOINT_INTERVAL='60'", submit)
+    # run the runner with a stand-in for singularity, it must not try
+    # to send checkpoints back
+    work = ut.Path(work)
+    (work / 'stamps').mkdir()
+    (work / 'dataset').mkdir()
+    (work / 'bin').mkdir()
+    (work / 'bin' / 'singularity').write_text(
+        u'#!/bin/sh\necho "$@" > "{}"\n'.format(work / 'singularity_args'))
+    (work / 'bin' / 'singularity').chmod(stat.S_IRWXU)
+    env = dict(
+        os.environ,
+        PATH=os.pathsep.join([str(work / 'bin'), os.environ['PATH']]),
+        DATALAD_HTC_SHARED_FS='yes',
+        DATALAD_HTC_CHECKPOINT_INTERVAL='60')
+    eq_(0, subprocess.call(
+        ['sh', str(submission_dir / 'runner.sh'), 'singularity.simg',
+         'bash', '-c', 'true'],
+        cwd=str(work), env=env))
+    ok_((work / 'singularity_args').read_text().startswith(u'exec '))
+
+
+def _fake_job_output(jdir, files, links=None):
+    """Put a completed job's output archive in place"""
+    with tarfile.open(str(jdir / 'output'), 'w:gz') as tar:
+        for name, target in (links or {}).items():
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    (jdir / 'status').write_text(u'completed')
+
+
+@with_tempfile
+def test_watch(path):
+    ds = Dataset(path).rev_create()
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        jobs=[dict(name=n) for n in ('one', 'two', 'three', 'four')],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    for i, name in enumerate(('one', 'two')):
+        _fake_job_output(
+            submission_dir / 'job_{}'.format(i),
+            {'./{}'.format(name): name.encode() + b'\n'})
+    # leftover of an interrupted extraction
+    (submission_dir / 'job_1' / 'output.extracting').mkdir()
+    # a job output that tries to escape the dataset
+    _fake_job_output(submission_dir / 'job_2', {'../evil': b'evil'})
+    # a job that never completes
+    (submission_dir / 'job_3' / 'status').write_text(u'preflight')
+
+    res = ds.htc_results(
+        'watch', submission=submission, workers=2, timeout=10,
+        on_failure='ignore')
+    assert_result_count(res, 2, action='htc_results_merge', status='ok')
+    assert_result_count(
+        res, 1, action='htc_result_merge', status='error', job=2)
+    assert_result_count(
+        res, 1, action='htc_result_watch', status='error', job=3)
+    for name in ('one', 'two'):
+        eq_((ds.pathobj / name).read_text(), name + u'\n')
+    assert not op.lexists(op.join(op.dirname(ds.path), 'evil'))
+    assert_repo_status(ds.path)
+    # nothing left to merge
+    assert_result_count(
+        ds.htc_results('list', submission=submission, state='completed'),
+        1, job=2)
+
+
+@with_tempfile
+def test_merge_symlink_escape(path):
+    ds = Dataset(path).rev_create()
+    res = ds.htc_prepare(
+        cmd='bash -c "ln -s ../.. link; echo evil > link/evil"',
+        jobs=[dict(name=n) for n in ('one', 'two')],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    outside = op.dirname(ds.path)
+    # a link out of the dataset, and a file written through it
+    _fake_job_output(
+        submission_dir / 'job_0', {'./link/evil': b'evil'},
+        links={'./link': '../..'})
+    # a file written through a link that is in the dataset already
+    (ds.pathobj / 'there').symlink_to(outside)
+    ds.rev_save()
+    _fake_job_output(submission_dir / 'job_1', {'./there/evil': b'evil'})
+    res = ds.htc_results(
+        'watch', submission=submission, timeout=10, on_failure='ignore')
+    assert_result_count(res, 1, action='htc_result_merge', status='error',
+                        job=0)
+    assert_result_count(res, 1, action='htc_result_merge', status='error',
+                        job=1)
+    assert_result_count(res, 0, action='htc_results_merge', status='ok')
+    for p in (outside, op.dirname(outside)):
+        assert not op.lexists(op.join(p, 'evil'))
+    assert not (submission_dir / 'job_0' / 'output.staged').exists()
+
+
+@with_tempfile
+def test_batch_merge(path):
+    ds = Dataset(path).rev_create()
+    names = ('one', 'two', 'three')
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in names],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    for i, name in enumerate(names):
+        _fake_job_output(
+            submission_dir / 'job_{}'.format(i),
+            {'./{}'.format(name): name.encode() + b'\n'})
+    start_commit = ds.repo.get_hexsha()
+    res = ds.htc_results('merge', submission=submission, batch=True)
+    assert_result_count(res, 3, action='htc_results_merge', status='ok')
+    for name in names:
+        eq_((ds.pathobj / name).read_text(), name + u'\n')
+    # a single commit for all jobs
+    eq_(ds.repo.get_hexsha('HEAD~1'), start_commit)
+    assert_repo_status(ds.path)
+    msg = ds.repo.repo.head.commit.message
+    assert_in(u'"htcondor"', msg)
+    assert_in(u'echo three > three', msg)
+
+
+@with_tempfile
+def test_batch_merge_invalid(path):
+    ds = Dataset(path).rev_create()
+    names = ('one', 'two', 'three')
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in names],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    for i, name in enumerate(names):
+        _fake_job_output(
+            submission_dir / 'job_{}'.format(i),
+            {'./{}'.format(name): name.encode() + b'\n'})
+    # invalid outputs are found before the dataset is modified
+    _fake_job_output(submission_dir / 'job_1', {'../evil': b'evil'})
+    res = ds.htc_results(
+        'merge', submission=submission, batch=True, on_failure='ignore')
+    assert_result_count(res, 1, action='htc_result_merge', status='error',
+                        job=1)
+    assert_result_count(res, 2, action='htc_results_merge', status='ok')
+    for name in ('one', 'three'):
+        eq_((ds.pathobj / name).read_text(), name + u'\n')
+    assert not op.lexists(op.join(path, 'two'))
+    assert not op.lexists(op.join(op.dirname(path), 'evil'))
+    assert_repo_status(ds.path)
+    # the failed job is still there
+    assert_result_count(
+        ds.htc_results('list', submission=submission), 1, job=1)
+
+
+@with_tempfile
+def test_worktree_merge(path):
+    ds = Dataset(path).rev_create()
+    names = ('one', 'two', 'three')
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in names],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    for i, name in enumerate(names):
+        _fake_job_output(
+            submission_dir / 'job_{}'.format(i),
+            {'./{}'.format(name): name.encode() + b'\n'})
+    start_commit = ds.repo.get_hexsha()
+    res = ds.htc_results(
+        'merge', submission=submission, worktree=True, workers=3)
+    assert_result_count(res, 3, action='htc_results_merge', status='ok')
+    for name in names:
+        eq_((ds.pathobj / name).read_text(), name + u'\n')
+    # one commit per job, merged at once
+    eq_(len(ds.repo.repo.head.commit.parents), 3)
+    for parent in ds.repo.repo.head.commit.parents:
+        eq_(parent.parents[0].hexsha, start_commit)
+    assert_repo_status(ds.path)
+    # no worktree is left behind
+    eq_(len(ds.repo.repo.git.worktree('list').splitlines()), 1)
+
+
+@with_tempfile
+def test_worktree_merge_existing(path):
+    ds = Dataset(path).rev_create(text_no_annex=True)
+    (ds.pathobj / 'sub').mkdir()
+    (ds.pathobj / 'sub' / 'text').write_text(u'old\n')
+    (ds.pathobj / 'sub' / 'data.dat').write_bytes(b'old\0')
+    ds.rev_save()
+    assert op.islink(op.join(path, 'sub', 'data.dat'))
+    for content, batch in ((b'new', False), (b'newer', True)):
+        # output globs are relative to where the command was prepared
+        with chpwd(op.join(path, 'sub')):
+            res = ds.htc_prepare(
+                cmd='bash -c "echo %s > {name}"' % content.decode(),
+                outputs=['{name}'],
+                jobs=[dict(name=n) for n in ('text', 'data.dat')],
+            )
+        submission = res[-1]['submission']
+        submission_dir = ut.Path(res[-1]['path'])
+        _fake_job_output(
+            submission_dir / 'job_0', {'./sub/text': content + b'\n'})
+        _fake_job_output(
+            submission_dir / 'job_1', {'./sub/data.dat': content + b'\0'})
+        res = ds.htc_results(
+            'merge', submission=submission, worktree=True, workers=2,
+            batch=batch)
+        assert_result_count(res, 2, action='htc_results_merge', status='ok')
+        eq_((ds.pathobj / 'sub' / 'text').read_bytes(), content + b'\n')
+        assert not op.islink(op.join(path, 'sub', 'text'))
+        eq_((ds.pathobj / 'sub' / 'data.dat').read_bytes(), content + b'\0')
+        assert op.islink(op.join(path, 'sub', 'data.dat'))
+        assert ds.repo.file_has_content('sub/data.dat')
+    assert_repo_status(ds.path)
+
+
+@with_tempfile
+def test_partial_merge(path):
+    ds = Dataset(path).rev_create()
+    res = ds.htc_prepare(
+        cmd='bash -c "echo partial > out; sleep 100; echo final > out"',
+        outputs=['out'],
+    )
+    submission = res[-1]['submission']
+    jdir = ut.Path(res[-1]['path']) / 'job_0'
+    # a running job sent a checkpoint back
+    with tarfile.open(str(jdir / 'checkpoint_1'), 'w:gz') as tar:
+        info = tarfile.TarInfo('./out')
+        info.size = 8
+        tar.addfile(info, io.BytesIO(b'partial\n'))
+    (jdir / 'checkpoint_count').write_text(u'1')
+    (jdir / 'status').write_text(u'preflight_completed')
+    assert_result_count(
+        ds.htc_results('list', submission=submission),
+        1, job=0, checkpoints=1)
+    assert_result_count(
+        ds.htc_results('merge', submission=submission, partial=True),
+        1, action='htc_result_merge', status='ok', checkpoint=1)
+    eq_((ds.pathobj / 'out').read_text(), u'partial\n')
+    assert_repo_status(ds.path)
+    assert_in(u'partial results', ds.repo.repo.head.commit.message)
+    # the job remains, nothing new to merge
+    assert jdir.exists()
+    assert_result_count(
+        ds.htc_results('merge', submission=submission, partial=True),
+        1, action='htc_result_merge', status='notneeded')
+    # the final results replace the partial ones
+    _fake_job_output(jdir, {'./out': b'final\n'})
+    assert_status(
+        'ok', ds.htc_results('merge', submission=submission))
+    eq_((ds.pathobj / 'out').read_text(), u'final\n')
+    assert not jdir.exists()
+
+
+def _fake_job_log(jdir, events):
+    """Write an HTCondor user log with the given (code, text) events"""
+    with (jdir / 'logs' / 'log').open('w') as f:
+        for code, text in events:
+            f.write(u'{:03d} (123.{:03d}.000) 01/01 00:00:00 {}\n...\n'.format(
+                code, int(jdir.name[4:]), text))
+
+
+@with_tempfile
+def test_wait_ended(path):
+    ds = Dataset(path).rev_create()
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in ('one', 'two', 'three')],
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    _fake_job_log(submission_dir / 'job_0', [
+        (0, 'Job submitted'), (12, 'Job was held.')])
+    _fake_job_log(submission_dir / 'job_1', [
+        (0, 'Job submitted'), (9, 'Job was aborted.')])
+    # job_2 was never submitted
+    start = time.time()
+    res = ds.htc_results(
+        'wait', submission=submission, timeout=60, on_failure='ignore')
+    # none of the jobs is waited for
+    ok_(time.time() - start < 60)
+    assert_result_count(res, 3, action='htc_result_wait', status='error')
+    eq_({r['job']: r['message'][1] for r in res},
+        {0: 'job is held', 1: 'job ended', 2: 'job was never submitted'})
+
+
+@with_tempfile
+def test_resubmit(path):
+    ds = Dataset(path).rev_create()
+    names = ('one', 'two', 'three')
+    res = ds.htc_prepare(
+        cmd='bash -c "echo {name} > {name}"',
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in names],
+        jobcfg='local',
+    )
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    jdirs = [submission_dir / 'job_{}'.format(i) for i in range(3)]
+    _fake_job_output(jdirs[0], {'./one': b'one\n'})
+    _fake_job_log(jdirs[0], [
+        (0, 'Job submitted'),
+        (5, 'Job terminated.\n(1) Normal termination (return value 0)')])
+    _fake_job_log(jdirs[1], [(0, 'Job submitted'), (9, 'Job was aborted.')])
+    # ended, but the outputs never came back
+    _fake_job_log(jdirs[2], [
+        (0, 'Job submitted'),
+        (5, 'Job terminated.\n(1) Normal termination (return value 0)')])
+    (jdirs[2] / 'status').write_text(u'preflight')
+
+    res = ds.htc_results('resubmit', submission=submission)
+    assert_result_count(
+        res, 1, action='htc_result_resubmit', status='notneeded', job=0)
+    assert_result_count(
+        res, 1, action='htc_result_resubmit', status='ok', job=1,
+        reason='aborted')
+    assert_result_count(
+        res, 1, action='htc_result_resubmit', status='ok', job=2,
+        reason='incomplete')
+    # only the failed jobs were queued again
+    eq_((submission_dir / 'jobs_resubmit_1').read_text().splitlines(),
+        [l for l in (submission_dir / 'jobs').read_text().splitlines()
+         if l.split(',')[0] in ('1', '2')])
+    assert_in(u'from jobs_resubmit_1',
+              (submission_dir / 'resubmit_1.submit').read_text())
+    # the completed job was left alone, the earlier attempts are kept
+    assert (jdirs[0] / 'output').exists()
+    assert not (jdirs[0] / 'attempt_1').exists()
+    for jdir in jdirs[1:]:
+        assert (jdir / 'attempt_1' / 'logs' / 'log').exists()
+
+    assert_status(
+        'ok', ds.htc_results('wait', submission=submission))
+    assert_status(
+        'ok', ds.htc_results('merge', submission=submission))
+    for name in names:
+        eq_((ds.pathobj / name).read_text(), name + u'\n')
+    assert_repo_status(ds.path)
+
+
+@with_tempfile
+def test_result_cache_failed_watch(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in.txt').write_text(u'input\n')
+    ds.rev_save()
+    cmd = 'bash -c "cat in.txt > {name}; exit 1"'
+    res = ds.htc_prepare(
+        cmd=cmd, inputs=['in.txt'], outputs=['{name}'],
+        jobs=[dict(name='one')])
+    submission_dir = ut.Path(res[-1]['path'])
+    _fake_job_output(submission_dir / 'job_0', {'./one': b'input\n'})
+    _fake_job_log(submission_dir / 'job_0', [
+        (0, 'Job submitted'),
+        (5, 'Job terminated.\n(1) Normal termination (return value 1)')])
+    assert_result_count(
+        ds.htc_results(
+            'watch', submission=res[-1]['submission'], timeout=10),
+        1, action='htc_results_merge', status='ok')
+    # the outputs of a failed job are not reused
+    res = ds.htc_prepare(
+        cmd=cmd, inputs=['in.txt'], outputs=['{name}'],
+        jobs=[dict(name='one')])
+    eq_(res[-1]['cached_jobs'], [])
+
+
+@with_tempfile
+def test_result_cache(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in.txt').write_text(u'input\n')
+    ds.rev_save()
+    cmd = 'bash -c "cat in.txt > {name}"'
+    res = ds.htc_prepare(
+        cmd=cmd, inputs=['in.txt'], outputs=['{name}'],
+        jobs=[dict(name=n) for n in ('one', 'two')])
+    eq_(res[-1]['cached_jobs'], [])
+    submission_dir = ut.Path(res[-1]['path'])
+    _fake_job_output(submission_dir / 'job_0', {'./one': b'input\n'})
+    assert_status('ok', ds.htc_results(
+        'merge', submission=res[-1]['submission'], job=0))
+
+    # the same job again is not run again, its outputs are in place
+    res = ds.htc_prepare(
+        cmd=cmd, inputs=['in.txt'], outputs=['{name}'],
+        jobs=[dict(name=n) for n in ('one', 'two')])
+    eq_(res[-1]['cached_jobs'], [0])
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    eq_([l.split(',')[0]
+         for l in (submission_dir / 'jobs').read_text().splitlines()],
+        ['1'])
+    assert_result_count(
+        ds.htc_results('list', submission=submission, state='completed'),
+        1, job=0)
+    assert_result_count(
+        ds.htc_results('merge', submission=submission, job=0),
+        1, action='htc_results_merge', status='ok')
+    eq_((ds.pathobj / 'one').read_text(), u'input\n')
+    assert_repo_status(ds.path)
+
+    # different inputs make a different job
+    (ds.pathobj / 'in.txt').write_text(u'other\n')
+    ds.rev_save()
+    res = ds.htc_prepare(
+        cmd=cmd, inputs=['in.txt'], outputs=['{name}'],
+        jobs=[dict(name='one')])
+    eq_(res[-1]['cached_jobs'], [])
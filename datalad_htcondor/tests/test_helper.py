@@ -0,0 +1,488 @@
+import io
+import json
+import os
+import os.path as op
+import stat
+import subprocess
+import sys
+import tarfile
+import threading
+
+from six import text_type
+
+from pkg_resources import resource_filename
+
+from datalad.tests.utils import (
+    with_tempfile,
+    eq_,
+    assert_false,
+    ok_,
+)
+import datalad_revolution.utils as ut
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+
+from datalad_htcondor.htcprepare import (
+    get_git_bundles,
+    _get_input_records,
+    _write_input_manifest,
+)
+from datalad_htcondor.ingest import open_archive
+
+
+helper = resource_filename('datalad_htcondor', 'resources/scripts/htchelper.py')
+
+
+def make_fake_chirp(path, log=None):
+    """Create a local stand-in for `condor_chirp fetch`"""
+    script = ut.Path(path)
+    script.write_text(u"""\
+#!/bin/sh
+[ "$1" = fetch ] || exit 1
+{}cp "$2" "$3"
+""".format('echo "$2" >> "{}"; '.format(log) if log else ''))
+    script.chmod(stat.S_IRWXU)
+    return str(script)
+
+
+def run_helper(*args):
+    return subprocess.call([sys.executable, helper] + list(args))
+
+
+def write_manifest(path, records):
+    with open(path, 'w') as f:
+        for r in records:
+            f.write(json.dumps(r) + '\n')
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_fetch(src, dst):
+    src = ut.Path(src)
+    dst = ut.Path(dst)
+    files = ['one', op.join('sub', 'two'), op.join('sub', 'deep', 'three')]
+    for i, f in enumerate(files):
+        (src / f).parent.mkdir(parents=True, exist_ok=True)
+        (src / f).write_text(u'x' * i)
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path=f, size=i) for i, f in enumerate(files)])
+    log = str(dst / 'chirp.log')
+    chirp = make_fake_chirp(str(dst / 'chirp'), log=log)
+    eq_(0, run_helper(
+        'fetch', '--chirp', chirp, '--source', str(src) + os.sep,
+        '--jobs', '1', str(dst / 'input_files'), str(dst / 'dataset')))
+    for i, f in enumerate(files):
+        eq_((dst / 'dataset' / f).read_text(), u'x' * i)
+    # largest files are requested first
+    eq_(ut.Path(log).read_text().splitlines(),
+        [str(src / f) for f in reversed(files)])
+
+    # failure is reported
+    write_manifest(
+        str(dst / 'input_files'), [dict(path='nothere', size=0)])
+    ok_(run_helper(
+        'fetch', '--chirp', chirp, '--source', str(src) + os.sep,
+        str(dst / 'input_files'), str(dst / 'dataset')) != 0)
+    assert_false((dst / 'dataset' / 'nothere').exists())
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_fetch_dedup(src, dst):
+    src = ut.Path(src)
+    dst = ut.Path(dst)
+    files = ['one', 'two', op.join('sub', 'three'), 'four']
+    for f in files:
+        (src / f).parent.mkdir(parents=True, exist_ok=True)
+        (src / f).write_text(u'same')
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path=f, size=4, key='MD5E-s4--b3e0d0a5ad4bd5bd6dd2b5fb7d3d5bf1')
+         for f in files[:3]] +
+        # no key, no deduplication
+        [dict(path=files[3], size=4)])
+    log = str(dst / 'chirp.log')
+    eq_(0, run_helper(
+        'fetch', '--chirp', make_fake_chirp(str(dst / 'chirp'), log=log),
+        '--source', str(src) + os.sep,
+        str(dst / 'input_files'), str(dst / 'dataset')))
+    for f in files:
+        eq_((dst / 'dataset' / f).read_text(), u'same')
+    # one transfer per key, plus one for the file without a key
+    eq_(sorted(ut.Path(log).read_text().splitlines()),
+        sorted([str(src / 'one'), str(src / 'four')]))
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_fetch_node_cache(src, dst):
+    src = ut.Path(src)
+    dst = ut.Path(dst)
+    cache = dst / 'cache'
+    (src / 'small').write_text(u'x' * 10)
+    (src / 'big').write_text(u'x' * 100)
+    (src / 'other').write_text(u'y' * 100)
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path='small', size=10, key='MD5E-s10--small'),
+         dict(path='big', size=100, key='MD5E-s100--big'),
+         # a git blob is cached too
+         dict(path='other', size=100, gitsha='0123abc')])
+    log = str(dst / 'chirp.log')
+    chirp = make_fake_chirp(str(dst / 'chirp'), log=log)
+
+    def fetch(job, *args):
+        return run_helper(
+            'fetch', '--chirp', chirp, '--source', str(src) + os.sep,
+            '--cache', str(cache), *(args + (
+                str(dst / 'input_files'), str(dst / job))))
+
+    eq_(0, fetch('job1'))
+    eq_(len(ut.Path(log).read_text().splitlines()), 3)
+    # a second job on the same node does not transfer anything
+    eq_(0, fetch('job2'))
+    eq_(len(ut.Path(log).read_text().splitlines()), 3)
+    for job in ('job1', 'job2'):
+        eq_((dst / job / 'big').read_text(), u'x' * 100)
+        eq_((dst / job / 'other').read_text(), u'y' * 100)
+        # cache content cannot be modified via a job's files
+        assert_false(os.stat(str(dst / job / 'big')).st_mode & stat.S_IWUSR)
+    eq_(len(list((cache / 'objects').iterdir())), 3)
+
+    # a cache that is too small keeps the most recently used objects
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path='small', size=10, key='MD5E-s10--small')])
+    eq_(0, fetch('job3', '--cache-size', '50'))
+    eq_([p.name for p in (cache / 'objects').iterdir()], ['MD5E-s10--small'])
+    # content in jobs is not affected by eviction
+    eq_((dst / 'job2' / 'big').read_text(), u'x' * 100)
+
+    # concurrent jobs sharing a cache
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path=p, size=100, key='MD5E-s100--{}'.format(p))
+         for p in ('big', 'other')])
+    procs = [
+        subprocess.Popen([
+            sys.executable, helper, 'fetch', '--chirp', chirp,
+            '--source', str(src) + os.sep, '--cache', str(cache),
+            str(dst / 'input_files'), str(dst / 'cjob{}'.format(i))])
+        for i in range(4)]
+    eq_([p.wait() for p in procs], [0] * 4)
+    for i in range(4):
+        eq_((dst / 'cjob{}'.format(i) / 'other').read_text(), u'y' * 100)
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_link(src, dst):
+    src = ut.Path(src)
+    dst = ut.Path(dst)
+    (src / 'sub').mkdir()
+    (src / 'sub' / 'plain').write_text(u'plain')
+    # stand-in for an annex object
+    (src / 'object').write_text(u'annexed')
+    (src / 'object').chmod(stat.S_IRUSR)
+    (src / 'annexed').symlink_to('object')
+    write_manifest(
+        str(dst / 'input_files'),
+        [dict(path=op.join('sub', 'plain'), size=5),
+         dict(path='annexed', size=7)])
+    eq_(0, run_helper(
+        'link', '--source', str(src) + os.sep,
+        str(dst / 'input_files'), str(dst / 'dataset')))
+    eq_((dst / 'dataset' / 'sub' / 'plain').read_text(), u'plain')
+    eq_((dst / 'dataset' / 'annexed').read_text(), u'annexed')
+    # the content is there, not a link to the dataset
+    assert_false((dst / 'dataset' / 'annexed').is_symlink())
+    # modifying a writable input does not touch the dataset
+    (dst / 'dataset' / 'sub' / 'plain').write_text(u'changed')
+    eq_((src / 'sub' / 'plain').read_text(), u'plain')
+
+
+@with_tempfile(mkdir=True)
+def test_stage(path):
+    path = ut.Path(path)
+    (path / 'work' / 'sub').mkdir(parents=True)
+    for f in ('one', op.join('sub', 'two')):
+        (path / 'work' / f).write_text(u'content')
+    (path / 'togethome').write_text(u'./one\n./sub/two\n')
+    eq_(0, run_helper(
+        'stage', str(path / 'togethome'), str(path / 'work'),
+        str(path / 'output')))
+    for f in ('one', op.join('sub', 'two')):
+        eq_((path / 'output' / f).read_text(), u'content')
+        assert_false((path / 'work' / f).exists())
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_annex_get(path, dst):
+    ds = Dataset(path).rev_create()
+    for f in ('one.dat', 'two.dat', 'modified.dat'):
+        (ds.pathobj / f).write_text(f)
+    ds.rev_save()
+    (ds.pathobj / 'modified.dat').unlink()
+    (ds.pathobj / 'modified.dat').write_text(u'changed')
+    dst = ut.Path(dst)
+    _write_input_manifest(
+        ds, dst / 'input_files',
+        _get_input_records(ds, [text_type(ds.pathobj / f)
+                                for f in ('one.dat', 'modified.dat')]))
+
+    def annex_get(url, job):
+        (dst / job).mkdir()
+        eq_(0, run_helper(
+            'annex-get', '--url', url, '--commit', ds.repo.get_hexsha(),
+            str(dst / 'input_files'), str(dst / job)))
+
+    # the dataset itself stands in for a remote
+    annex_get('file://' + ds.path, 'job1')
+    eq_((dst / 'job1' / 'one.dat').read_text(), u'one.dat')
+    # only the inputs are obtained
+    assert_false((dst / 'job1' / 'two.dat').exists())
+    # the rest is left for the fallback
+    log = str(dst / 'chirp.log')
+    eq_(0, run_helper(
+        'fetch', '--chirp', make_fake_chirp(str(dst / 'chirp'), log=log),
+        '--source', ds.path + os.sep, '--skip-present',
+        str(dst / 'input_files'), str(dst / 'job1')))
+    eq_(ut.Path(log).read_text().splitlines(),
+        [str(ds.pathobj / 'modified.dat')])
+    eq_((dst / 'job1' / 'modified.dat').read_text(), u'changed')
+
+    # without a usable remote nothing is left behind
+    annex_get('file://' + str(dst / 'nothere'), 'job2')
+    eq_(list((dst / 'job2').iterdir()), [])
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_unbundle(path, dst):
+    ds = Dataset(path).rev_create()
+    sub = ds.rev_create('sub')
+    (sub.pathobj / 'file.txt').write_text(u'content')
+    ds.rev_save(recursive=True)
+    bundle_dir = ut.Path(dst) / 'bundles'
+    bundles = get_git_bundles(ds.repo, bundle_dir)
+    eq_(len(bundles), 1)
+    # bundles are reused
+    eq_(get_git_bundles(ds.repo, bundle_dir), bundles)
+    # a new commit gets an incremental bundle
+    (ds.pathobj / 'new.txt').write_text(u'new')
+    ds.rev_save()
+    bundles = get_git_bundles(ds.repo, bundle_dir)
+    eq_(len(bundles), 2)
+    ok_(bundles[1].stat().st_size < bundles[0].stat().st_size)
+
+    spec = ut.Path(dst) / 'bundles.json'
+    spec.write_text(text_type(json.dumps([
+        dict(path='.', commit=ds.repo.get_hexsha(),
+             bundles=[text_type(b) for b in bundles]),
+        dict(path='sub', commit=sub.repo.get_hexsha(),
+             bundles=[text_type(b) for b in get_git_bundles(
+                 sub.repo, ut.Path(dst) / 'subbundles')]),
+    ])))
+    job = ut.Path(dst) / 'job'
+    job.mkdir()
+    eq_(0, run_helper('unbundle', str(spec), str(job)))
+    eq_(Dataset(str(job)).repo.get_hexsha(), ds.repo.get_hexsha())
+    eq_(Dataset(str(job / 'sub')).repo.get_hexsha(), sub.repo.get_hexsha())
+    # the worktree is checked out
+    ok_(op.lexists(str(job / 'new.txt')))
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_git_bundles_concurrent(path, dst):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'file.txt').write_text(u'content')
+    ds.rev_save()
+    commit = ds.repo.get_hexsha()
+    # independent caches of the same repository, bundled at once
+    dirs = [ut.Path(dst) / 'bundles_{}'.format(i) for i in range(4)]
+    threads = [threading.Thread(target=get_git_bundles, args=(ds.repo, d))
+               for d in dirs]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for d in dirs:
+        bundle, = d.glob('*.bundle')
+        heads = subprocess.check_output(
+            ['git', 'bundle', 'list-heads', str(bundle)],
+            cwd=ds.path).decode().split()
+        eq_(heads[0], commit)
+    # no private ref is left behind
+    eq_(ds.repo.repo.git.for_each_ref('refs/datalad-htc/'), '')
+
+
+@with_tempfile(mkdir=True)
+def test_checksum(path):
+    path = ut.Path(path)
+    (path / 'work' / 'sub').mkdir(parents=True)
+    (path / 'work' / 'one').write_text(u'content')
+    (path / 'work' / 'sub' / 'link').symlink_to('../one')
+    (path / 'togethome').write_text(u'./one\n./sub/link\n')
+    eq_(0, run_helper(
+        'checksum', '--backend', 'SHA256E', str(path / 'togethome'),
+        str(path / 'work'), str(path / 'output_files')))
+    entries = [json.loads(l)
+               for l in (path / 'output_files').read_text().splitlines()]
+    eq_([e['path'] for e in entries], ['one', op.join('sub', 'link')])
+    eq_(entries[0]['size'], 7)
+    eq_(entries[0]['sha256'],
+        'ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73')
+    # what `git hash-object` reports
+    eq_(entries[0]['gitsha'], '6b584e8ece562ebffc15d38808cd6b98fc3d97ea')
+    ok_(entries[1]['symlink'])
+    eq_(entries[1]['gitsha'], '747114a450d58abbc34db00775fb7ca3c379a423')
+
+
+@with_tempfile(mkdir=True)
+def test_collect(path):
+    path = ut.Path(path)
+    work = path / 'dataset'
+    for d in ('in', 'out/sub', 'other', '.git'):
+        (work / d).mkdir(parents=True)
+    (work / 'in' / 'data').write_text(u'input')
+    (work / 'in' / 'inplace').write_text(u'input')
+    (path / 'stamp').write_text(u'')
+    stamp_time = os.stat(str(path / 'stamp')).st_mtime
+    # everything below is modified after the job started
+    for f in ('in/data', 'in/inplace', 'out/one', 'out/sub/two', 'other/x',
+              '.git/index'):
+        (work / f).write_text(u'output')
+        os.utime(str(work / f), (stamp_time + 10, stamp_time + 10))
+    write_manifest(
+        str(path / 'input_files'),
+        [dict(path='in/data'), dict(path='in/inplace')])
+
+    # without globs, anything but inputs and git internals
+    eq_(0, run_helper(
+        'collect', '--newer', str(path / 'stamp'),
+        '--inputs', str(path / 'input_files'),
+        '--report', str(path / 'report'),
+        str(work), str(path / 'togethome')))
+    eq_((path / 'togethome').read_text().splitlines(),
+        ['./other/x', './out/one', './out/sub/two'])
+    eq_(json.loads((path / 'report').read_text()), dict(files=3, bytes=18))
+
+    # globs narrow it down, an input named by a glob is an output
+    (path / 'globs').write_text(u'out\0in/inp*\0../escape\0')
+    eq_(0, run_helper(
+        'collect', '--newer', str(path / 'stamp'),
+        '--inputs', str(path / 'input_files'),
+        '--globs', str(path / 'globs'),
+        str(work), str(path / 'togethome')))
+    eq_((path / 'togethome').read_text().splitlines(),
+        ['./in/inplace', './out/one', './out/sub/two'])
+
+
+@with_tempfile(mkdir=True)
+def test_pack(path):
+    path = ut.Path(path)
+    (path / 'work' / 'sub').mkdir(parents=True)
+    (path / 'work' / 'sub' / 'data.txt').write_text(u'text ' * 1000)
+    (path / 'togethome').write_text(u'./sub/data.txt\n')
+    # whatever the compression, the merge side can read it (zstd falls
+    # back on gzip, if it is not available)
+    for compression in ('none', 'gzip', 'zstd', 'auto'):
+        archive = path / 'output_{}'.format(compression)
+        eq_(0, run_helper(
+            'pack', '--compression', compression, str(path / 'togethome'),
+            str(path / 'work'), str(archive)))
+        with open_archive(archive) as tar:
+            eq_([m.name for m in tar], ['./sub/data.txt'])
+    ok_((path / 'output_none').stat().st_size >
+        5 * (path / 'output_gzip').stat().st_size)
+    # compressed data is not compressed again
+    (path / 'work' / 'sub' / 'image.png').write_bytes(os.urandom(10000))
+    (path / 'togethome').write_text(u'./sub/data.txt\n./sub/image.png\n')
+    eq_(0, run_helper(
+        'pack', '--compression', 'auto', str(path / 'togethome'),
+        str(path / 'work'), str(path / 'output')))
+    with tarfile.open(str(path / 'output'), 'r:') as tar:
+        eq_(len(tar.getmembers()), 2)
+
+
+@with_tempfile(mkdir=True)
+def test_checkpoint(path):
+    path = ut.Path(path)
+    # the job dir on the submit host
+    remote = path / 'remote'
+    remote.mkdir()
+    chirp = path / 'chirp'
+    chirp.write_text(u"""\
+#!/bin/sh
+case "$1" in
+  fetch) cp "{remote}/$2" "$3";;
+  put) cp "$2" "{remote}/$3";;
+  *) exit 1;;
+esac
+""".format(remote=remote))
+    chirp.chmod(stat.S_IRWXU)
+    work = path / 'work'
+    (work / 'stamps').mkdir(parents=True)
+    (work / 'dataset').mkdir()
+    (work / 'stamps' / 'prep_complete').write_text(u'')
+    eq_(0, subprocess.call(
+        [sys.executable, helper, 'checkpoint', '--chirp', str(chirp),
+         '--interval', '0.5', '--workdir', str(work),
+         '--dataset', str(work / 'dataset'), '--',
+         'sh', '-c', 'echo partial > out; sleep 2'],
+        cwd=str(work / 'dataset')))
+    ok_((remote / 'checkpoint_count').exists())
+    # only new outputs make a checkpoint
+    eq_((remote / 'checkpoint_count').read_text(), u'1')
+
+    # an evicted job starts over with its checkpointed outputs
+    work = path / 'work2'
+    (work / 'stamps').mkdir(parents=True)
+    (work / 'dataset').mkdir()
+    (work / 'stamps' / 'prep_complete').write_text(u'')
+    eq_(0, run_helper(
+        'restore', '--chirp', str(chirp), '--workdir', str(work),
+        str(work / 'dataset')))
+    eq_((work / 'dataset' / 'out').read_text(), u'partial\n')
+    ok_(os.stat(str(work / 'dataset' / 'out')).st_mtime >=
+        os.stat(str(work / 'stamps' / 'prep_complete')).st_mtime)
+    # nothing to restore for a first run
+    (remote / 'checkpoint_count').unlink()
+    eq_(0, run_helper(
+        'restore', '--chirp', str(chirp), '--workdir', str(work),
+        str(work / 'dataset')))
+
+    # a checkpoint that writes outside of the dataset via a symlink
+    with tarfile.open(str(remote / 'checkpoint_1'), 'w') as tar:
+        info = tarfile.TarInfo('link')
+        info.type = tarfile.SYMTYPE
+        info.linkname = '..'
+        tar.addfile(info)
+        info = tarfile.TarInfo('link/evil')
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b'evil'))
+    (remote / 'checkpoint_count').write_text(u'1')
+    ok_(run_helper(
+        'restore', '--chirp', str(chirp), '--workdir', str(work),
+        str(work / 'dataset')) != 0)
+    assert_false((work / 'evil').exists())
+    assert_false(op.lexists(str(work / 'dataset' / 'link')))
+
+
+@with_tempfile(mkdir=True)
+def test_timing(path):
+    path = ut.Path(path)
+    (path / 'work').mkdir()
+    (path / 'work' / 'data.txt').write_text(u'text')
+    (path / 'togethome').write_text(u'./data.txt\n')
+    eq_(0, run_helper(
+        'pack', '--timing', str(path / 'timing'), str(path / 'togethome'),
+        str(path / 'work'), str(path / 'output')))
+    with (path / 'timing').open() as f:
+        events = [json.loads(l) for l in f]
+    eq_([e['event'] for e in events], ['pack_start', 'pack_end'])
+    ok_(events[0]['time'] <= events[1]['time'])
+    eq_(events[1]['files'], 1)
+    eq_(events[1]['bytes'], (path / 'output').stat().st_size)
@@ -0,0 +1,157 @@
+import io
+import os
+import os.path as op
+import subprocess
+import sys
+import tarfile
+
+from pkg_resources import resource_filename
+
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    assert_raises,
+    with_tempfile,
+    eq_,
+    ok_,
+)
+from datalad_htcondor.ingest import (
+    annex_extension,
+    get_unchanged_outputs,
+    goes_to_git,
+    ingest_archive,
+    safe_members,
+)
+
+
+helper = resource_filename('datalad_htcondor', 'resources/scripts/htchelper.py')
+
+
+def _make_archive(path, members, links=()):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            tar.addfile(info)
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+def test_annex_extension():
+    eq_(annex_extension('out/file.dat'), '.dat')
+    eq_(annex_extension('file.tar.gz'), '.tar.gz')
+    eq_(annex_extension('a.b.tar.gz'), '.tar.gz')
+    eq_(annex_extension('file.jpeg5'), '')
+    eq_(annex_extension('file'), '')
+    eq_(annex_extension('file.nii.gz', maxlen=2), '.gz')
+
+
+def test_goes_to_git():
+    ok_(not goes_to_git('unspecified', 10, b'text'))
+    ok_(goes_to_git('nothing', 10 ** 9, b'\0'))
+    # text2git
+    expr = '((mimeencoding=binary)and(largerthan=0))'
+    ok_(goes_to_git(expr, 10, b'some text'))
+    ok_(not goes_to_git(expr, 10, b'bin\0ary'))
+    ok_(goes_to_git('largerthan=100kb', 1024, b'\0'))
+    ok_(not goes_to_git('largerthan=100kb', 1024 ** 2, b''))
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_safe_members(path, root):
+    def _extract():
+        with tarfile.open(path) as tar:
+            tar.extractall(root, members=safe_members(tar, root))
+
+    for name in ('../escape', '/abs', 'sub/../../escape', '.git/config'):
+        _make_archive(path, [(name, b'bad')])
+        with tarfile.open(path) as tar:
+            assert_raises(ValueError, list, safe_members(tar, root))
+    _make_archive(path, [('sub/ok', b'good')])
+    with tarfile.open(path) as tar:
+        eq_([m.name for m in safe_members(tar, root)], ['sub/ok'])
+
+    outside = op.dirname(root)
+    # links that point outside, to write through them
+    for target in (outside, '..', 'sub/../..'):
+        _make_archive(path, [('link/escape', b'bad')],
+                      links=[('link', target)])
+        assert_raises(ValueError, _extract)
+        ok_(not op.lexists(op.join(outside, 'escape')))
+    # a link that is already there
+    os.symlink(outside, op.join(root, 'there'))
+    _make_archive(path, [('there/escape', b'bad')])
+    assert_raises(ValueError, _extract)
+    ok_(not op.lexists(op.join(outside, 'escape')))
+    # links within are fine
+    os.mkdir(op.join(root, 'sub'))
+    _make_archive(path, [('inside/new', b'good')], links=[('inside', 'sub')])
+    _extract()
+    with open(op.join(root, 'sub', 'new'), 'rb') as f:
+        eq_(f.read(), b'good')
+
+
+@with_tempfile
+@with_tempfile
+def test_ingest(path, archive):
+    ds = Dataset(path).rev_create(text_no_annex=True)
+    (ds.pathobj / 'out').mkdir()
+    (ds.pathobj / 'out' / 'old').write_text(u'old')
+    ds.rev_save()
+    _make_archive(archive, [
+        ('out/old', b'new text'),
+        ('out/one.dat', b'new\0binary'),
+        ('out/two.dat', b'new\0binary'),
+    ])
+    ingest_archive(ds, ut.Path(archive))
+    # text goes to git, binary content straight into the annex
+    ok_(not op.islink(op.join(path, 'out', 'old')))
+    eq_((ds.pathobj / 'out' / 'old').read_text(), u'new text')
+    for f in ('one.dat', 'two.dat'):
+        ok_(op.islink(op.join(path, 'out', f)))
+        eq_((ds.pathobj / 'out' / f).read_bytes(), b'new\0binary')
+        ok_(ds.repo.file_has_content('out/' + f))
+    ok_(ds.repo.get_file_key('out/one.dat').endswith('.dat'))
+    ds.rev_save()
+    ok_(not ds.repo.dirty)
+    # identical content is only stored once
+    eq_(len(list(ds.pathobj.glob('.git/annex/objects/*/*/*/*'))), 1)
+
+    _make_archive(archive, [('../escape', b'bad')])
+    assert_raises(ValueError, ingest_archive, ds, ut.Path(archive))
+    ok_(not op.lexists(op.join(op.dirname(path), 'escape')))
+    _make_archive(archive, [('out/link/escape', b'bad')],
+                  links=[('out/link', '../..')])
+    assert_raises(ValueError, ingest_archive, ds, ut.Path(archive))
+    ok_(not op.lexists(op.join(op.dirname(path), 'escape')))
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_unchanged_outputs(path, work):
+    ds = Dataset(path).rev_create(text_no_annex=True)
+    for f, content in (('same.dat', u'same\0'), ('same.txt', u'same'),
+                       ('changed.dat', u'old\0'), ('changed.txt', u'old'),
+                       ('modified.txt', u'same')):
+        (ds.pathobj / f).write_text(content)
+    ds.rev_save()
+    # locally modified, must be replaced
+    (ds.pathobj / 'modified.txt').write_text(u'local')
+    work = ut.Path(work)
+    for f, content in (('same.dat', u'same\0'), ('same.txt', u'same'),
+                       ('changed.dat', u'new\0'), ('changed.txt', u'new'),
+                       ('modified.txt', u'same'), ('new.txt', u'new')):
+        (work / f).write_text(content)
+    (work / 'togethome').write_text(u''.join(
+        './{}\n'.format(f) for f in ('same.dat', 'same.txt', 'changed.dat',
+                                    'changed.txt', 'modified.txt',
+                                    'new.txt')))
+    eq_(0, subprocess.call([
+        sys.executable, helper, 'checksum', str(work / 'togethome'),
+        str(work), str(work / 'output_files')]))
+    eq_(get_unchanged_outputs(ds, work / 'output_files'),
+        {'same.dat', 'same.txt'})
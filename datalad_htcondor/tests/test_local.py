@@ -0,0 +1,92 @@
+import tarfile
+
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+from datalad_revolution.tests.utils import (
+    assert_repo_status,
+)
+from datalad.tests.utils import (
+    assert_in,
+    assert_raises,
+    assert_result_count,
+    assert_status,
+    with_tempfile,
+    eq_,
+    ok_,
+)
+from datalad_htcondor.htcprepare import quote_condor_args
+from datalad_htcondor.local import (
+    read_submit_file,
+    split_condor_args,
+)
+
+
+def test_split_condor_args():
+    for args in (['bash', '-c', 'echo "it\'s" > out'],
+                 ['a b', '', "''"],
+                 []):
+        eq_(split_condor_args('"{}"'.format(quote_condor_args(args))), args)
+    eq_(split_condor_args("A='1' B='x y'"), ['A=1', 'B=x y'])
+    assert_raises(ValueError, split_condor_args, "'open")
+
+
+@with_tempfile(mkdir=True)
+def test_read_submit_file(path):
+    path = ut.Path(path)
+    (path / 'jobs').write_text(u"0, 'a' 'b c'\n1, 'd'\n")
+    (path / 'cluster.submit').write_text(u"""\
+# comment
+executable = runner.sh
++PreCmd = "pre.sh"
+initial_dir = job_$(job)
+queue job,job_arguments from jobs
+""")
+    props, items = read_submit_file(path / 'cluster.submit')
+    eq_(props['executable'], 'runner.sh')
+    eq_(props['+precmd'], 'pre.sh')
+    eq_(props['initial_dir'], 'job_$(job)')
+    eq_(items, [dict(job='0', job_arguments="'a' 'b c'"),
+                dict(job='1', job_arguments="'d'")])
+
+
+@with_tempfile
+def test_local_backend(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in').write_text(u'input\n')
+    ds.rev_save()
+    names = ('one', 'two')
+    res = ds.htc_prepare(
+        cmd='bash -c "cat in > {name}; echo {name} >> {name}"',
+        inputs=['in'],
+        outputs=['{name}'],
+        jobs=[dict(name=n) for n in names],
+        jobcfg='local',
+        submit=True,
+    )
+    assert_result_count(res, 1, action='htc_submit', status='ok')
+    submission = res[-1]['submission']
+    submission_dir = ut.Path(res[-1]['path'])
+    res = ds.htc_results('wait', submission=submission, timeout=120)
+    assert_result_count(res, 2, status='ok', state='completed',
+                        condor_state='terminated', exit_code=0)
+    for i in range(2):
+        with tarfile.open(
+                str(submission_dir / 'job_{}'.format(i) / 'output')) as tar:
+            eq_(tar.getnames(), ['./' + names[i]])
+    # the phases of each job are timed
+    res = ds.htc_results('list', submission=submission)
+    for r in res:
+        for phase in ('preflight', 'fetch', 'payload', 'postflight', 'pack'):
+            assert_in(phase, r['timing'])
+    eq_(res[0]['timing']['payload']['jobs'], 2)
+    eq_(res[1]['timing']['fetch']['files'], 1)
+    assert_in('inputs', res[0]['prepare_timing'])
+    assert_status('ok', ds.htc_results('merge', submission=submission))
+    for name in names:
+        eq_((ds.pathobj / name).read_text(), u'input\n{}\n'.format(name))
+    assert_repo_status(ds.path)
+    # and kept, along with the merge
+    for i in range(2):
+        ok_((submission_dir / 'timing' / 'job_{}'.format(i)).exists())
+    res = ds.htc_results('list', submission=submission)
+    assert_in('merge_commit', res[0]['timing'])
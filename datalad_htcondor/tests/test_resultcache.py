@@ -0,0 +1,60 @@
+import os
+import time
+
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    with_tempfile,
+    eq_,
+    ok_,
+)
+from datalad_htcondor.resultcache import (
+    ResultCache,
+    get_cache_key,
+)
+
+
+def test_get_cache_key():
+    key = get_cache_key('cmd', '.', ['out'], [('in', 'SHA256-s1--00')])
+    eq_(key, get_cache_key(
+        'cmd', '.', ['out'], [('in', 'SHA256-s1--00')],
+        jobcfg=dict(request_memory=100)))
+    for other in (
+            get_cache_key('cmd2', '.', ['out'], [('in', 'SHA256-s1--00')]),
+            get_cache_key('cmd', '.', ['out'], [('in', 'SHA256-s1--01')]),
+            get_cache_key('cmd', '.', ['out'], [('in', 'SHA256-s1--00')],
+                          container='SHA256-s9--ff'),
+            get_cache_key('cmd', '.', ['out'], [('in', 'SHA256-s1--00')],
+                          jobcfg=dict(shared_fs=True))):
+        ok_(other != key)
+
+
+@with_tempfile(mkdir=True)
+def test_result_cache(path):
+    path = ut.Path(path)
+    cache = ResultCache(path / 'cache', 25)
+    for i in range(3):
+        jdir = path / 'job_{}'.format(i)
+        jdir.mkdir()
+        (jdir / 'output').write_bytes(b'x' * 10)
+    ok_(not cache.get('a', path / 'job_2'))
+    # nothing to keep without an output archive
+    cache.put('none', path)
+    ok_(not (path / 'cache' / 'none').exists())
+
+    cache.put('a', path / 'job_0')
+    cache.put('b', path / 'job_1')
+    # entry 'a' was used last
+    past = time.time() - 100
+    os.utime(str(path / 'cache' / 'b'), (past, past))
+    ok_(cache.get('a', path / 'job_2'))
+    os.unlink(str(path / 'job_2' / 'output'))
+    # exceeds the size limit, the least recently used entry is evicted
+    (path / 'job_2' / 'output').write_bytes(b'y' * 10)
+    cache.put('c', path / 'job_2')
+    eq_(sorted(p.name for p in (path / 'cache').iterdir()), ['a', 'c'])
+
+    jdir = path / 'job_3'
+    jdir.mkdir()
+    ok_(cache.get('c', jdir))
+    eq_((jdir / 'output').read_bytes(), b'y' * 10)
+    ok_(not (jdir / 'output_files').exists())
@@ -1,9 +1,11 @@
-import time
+import os
+import os.path as op
 
 from datalad.api import (
     rev_create as create,
     containers_add,
     htc_prepare,
+    htc_results,
 )
 from datalad_revolution.dataset import RevolutionDataset as Dataset
 import datalad_revolution.utils as ut
@@ -11,9 +13,18 @@ from datalad.tests.utils import (
     assert_result_count,
     with_tempfile,
     eq_,
+    assert_status,
+    assert_false,
+    ok_,
 )
 from datalad.utils import on_windows
-from datalad_htcondor.htcprepare import get_singularity_jobspec
+from datalad.support import json_py
+from datalad_htcondor.htcprepare import (
+    get_singularity_jobspec,
+    get_submissions_dir,
+    is_singularity_image,
+    _has_image_signature,
+)
 
 
 testimg_url = 'shub://datalad/datalad-container:testhelper'
@@ -51,14 +62,18 @@ def test_basic(path):
         submit=True,
     )
     assert res[-1]['action'] == 'htc_submit'
+    # the outcome of the image detection is cached
+    cache = json_py.load(
+        str(get_submissions_dir(ds) / 'singularity_images.json'))
+    eq_(list(cache.values())[0]['image'], True)
     # TODO it is a shame that we cannot pass pathobj through datalad yet
     submission_dir = ut.Path(res[-1]['path'])
     # no input_files spec was written
-    assert not (submission_dir / 'input_files').exists()
+    assert not (submission_dir / 'job_0' / 'input_files').exists()
     # we gotta wait till the results are in
-    while not (submission_dir / 'job_0' / 'logs' / 'err').exists():
-        time.sleep(1)
-    time.sleep(2)
+    assert_status(
+        'ok',
+        ds.htc_results('wait', submission=res[-1]['submission'], job=0))
     assert (submission_dir / 'job_0' / 'output').exists()
 
     # add some content to the dataset and run again
@@ -77,9 +92,66 @@ def test_basic(path):
     # TODO it is a shame that we cannot pass pathobj through datalad yet
     submission_dir = ut.Path(res[-1]['path'])
     # no input_files spec was written
-    assert (submission_dir / 'input_files').exists()
+    assert (submission_dir / 'job_0' / 'input_files').exists()
     # we gotta wait till the results are in
-    while not (submission_dir / 'job_0' / 'logs' / 'err').exists():
-        time.sleep(1)
-    time.sleep(2)
+    assert_status(
+        'ok',
+        ds.htc_results('wait', submission=res[-1]['submission'], job=0))
     assert (submission_dir / 'job_0' / 'output').exists()
+
+
+@with_tempfile(mkdir=True)
+def test_image_signature(path):
+    path = ut.Path(path)
+    for name, head, expected in (
+            ('launcher', b'#!/usr/bin/env run-singularity\n', True),
+            ('squashfs', b'hsqs' + b'\0' * 60, True),
+            ('sif', b'\0' * 32 + b'SIF_MAGIC' + b'\0' * 23, True),
+            ('script', b'#!/bin/sh\necho hello\n', False),
+            ('late', b'\0' * 64 + b'SIF_MAGIC', False),
+            ('empty', b'', False)):
+        (path / name).write_bytes(head)
+        eq_(_has_image_signature(str(path / name)), expected, name)
+    assert_false(_has_image_signature(str(path / 'missing')))
+    # sandbox containers
+    for name, marker in (('sandbox', '.singularity.d'),
+                         ('sandbox2', 'singularity')):
+        (path / name / marker).mkdir(parents=True)
+        ok_(_has_image_signature(str(path / name)))
+    (path / 'plain').mkdir()
+    assert_false(_has_image_signature(str(path / 'plain')))
+
+
+@with_tempfile(mkdir=True)
+def test_image_cache(path):
+    cache = ut.Path(path) / 'cache.json'
+    img = op.join(path, 'img')
+    with open(img, 'wb') as f:
+        f.write(b'not an image')
+    assert_false(is_singularity_image(img, cache=cache))
+    known = json_py.load(str(cache))
+    eq_(list(known), [op.realpath(img)])
+    assert_false(known[op.realpath(img)]['image'])
+
+    def fake_image():
+        # pretend an earlier test found an image, to tell whether
+        # the cached result is used
+        known = json_py.load(str(cache))
+        known[op.realpath(img)]['image'] = True
+        json_py.dump(known, str(cache))
+
+    fake_image()
+    ok_(is_singularity_image(img, cache=cache))
+    # a changed size invalidates the cached result
+    with open(img, 'ab') as f:
+        f.write(b'!')
+    assert_false(is_singularity_image(img, cache=cache))
+    # so does a changed modification time
+    fake_image()
+    ok_(is_singularity_image(img, cache=cache))
+    st = os.stat(img)
+    os.utime(img, (st.st_atime, st.st_mtime - 10))
+    assert_false(is_singularity_image(img, cache=cache))
+    # without a cache, the file is always tested
+    fake_image()
+    assert_false(is_singularity_image(img))
@@ -0,0 +1,93 @@
+from datalad_revolution.dataset import RevolutionDataset as Dataset
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    assert_in,
+    assert_not_in,
+    with_tempfile,
+    eq_,
+)
+from datalad_htcondor.htcprepare import get_submissions_dir
+from datalad_htcondor.stats import (
+    StatsStore,
+    get_signature,
+    propose_requests,
+)
+from datalad_htcondor.userlog import write_event
+
+
+def test_propose_requests():
+    eq_(propose_requests([], 0, 1.5), {})
+    # inputs alone need disk space
+    eq_(propose_requests([], 2048, 1.5), dict(request_disk=3))
+    runs = [
+        dict(memory=100, cpus=0.9, disk=10, input_bytes=2048,
+             output_bytes=100),
+        dict(memory=200, cpus=1.8, disk=None, input_bytes=0,
+             output_bytes=4096),
+    ]
+    eq_(propose_requests(runs, 1024, 2.),
+        dict(request_memory=400, request_cpus=2,
+             # inputs plus the most any run needed on top of its inputs
+             request_disk=2 * (1024 + 8 * 1024) // 1024))
+
+
+@with_tempfile(mkdir=True)
+def test_stats_store(path):
+    path = ut.Path(path)
+    with StatsStore(path) as stats:
+        stats.record('sig', 'sub', 0, 1, memory=10)
+        stats.record('sig', 'sub', 0, 2, memory=20)
+        # the same attempt again
+        stats.record('sig', 'sub', 0, 2, memory=30)
+        stats.record('other', 'sub', 1, 1, memory=40)
+    with StatsStore(path) as stats:
+        eq_(sorted(r['memory'] for r in stats.get_runs('sig')), [10, 30])
+        eq_(len(stats.get_runs('sig', limit=1)), 1)
+        eq_(stats.get_runs('none'), [])
+    eq_(get_signature('cmd'), get_signature(u'cmd'))
+    assert get_signature('cmd') != get_signature('cmd2')
+
+
+@with_tempfile
+def test_resource_requests(path):
+    ds = Dataset(path).rev_create()
+    (ds.pathobj / 'in.txt').write_text(u'x' * 4096)
+    ds.rev_save()
+    cmd = 'bash -c "cat in.txt > out.txt"'
+    res = ds.htc_prepare(cmd=cmd, inputs=['in.txt'])
+    # nothing known yet, but the size of the inputs
+    eq_(res[-1]['resource_requests'], dict(request_disk=5))
+    submit = (ut.Path(res[-1]['path']) / 'cluster.submit').read_text()
+    assert_in(u'request_disk = 5\n', submit)
+    assert_not_in(u'request_memory', submit)
+
+    # the job ran and reported its resource usage
+    jdir = ut.Path(res[-1]['path']) / 'job_0'
+    log = jdir / 'logs' / 'log'
+    write_event(log, 0, 42, 0, 'Job submitted from host: <10.0.0.1:9618>')
+    write_event(log, 6, 42, 0, 'Image size of job updated: 9000',
+                ['300  -  MemoryUsage of job (MB)'])
+    write_event(log, 5, 42, 0, 'Job terminated.', [
+        '(1) Normal termination (return value 0)',
+        'Partitionable Resources :    Usage  Request Allocated',
+        '   Cpus                 :        2         1         2',
+        '   Disk (KB)            :       20         5       100',
+        '   Memory (MB)          :      100         1      2048',
+    ])
+    ds.htc_results('list')
+    with StatsStore(get_submissions_dir(ds)) as stats:
+        runs = stats.get_runs(get_signature(cmd))
+    eq_(len(runs), 1)
+    eq_((runs[0]['memory'], runs[0]['disk'], runs[0]['cpus'],
+         runs[0]['input_bytes']), (300, 20, 2., 4096))
+
+    # the next submission of the command asks for what the job used
+    ds.config.add('datalad.htcondor.jobcfg.default.request-cpus', '1',
+                  where='local')
+    res = ds.htc_prepare(cmd=cmd, inputs=['in.txt'])
+    eq_(res[-1]['resource_requests'],
+        dict(request_memory=375, request_cpus=1,
+             request_disk=(4096 + 16 * 1024) * 5 // 4 // 1024))
+    submit = (ut.Path(res[-1]['path']) / 'cluster.submit').read_text()
+    assert_in(u'request_memory = 375\n', submit)
+    assert_in(u'request_cpus = 1\n', submit)
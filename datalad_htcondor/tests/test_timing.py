@@ -0,0 +1,64 @@
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    with_tempfile,
+    eq_,
+    ok_,
+)
+from datalad_htcondor.timing import (
+    Timer,
+    aggregate,
+    get_phases,
+    percentile,
+    read_timing,
+)
+
+
+def test_get_phases():
+    events = [
+        dict(event='preflight_start', time=10.),
+        dict(event='fetch_start', time=11.),
+        dict(event='fetch_end', time=13., files=2, bytes=100),
+        dict(event='preflight_end', time=14.),
+        dict(event='payload_start', time=14.),
+        # repeated phases add up
+        dict(event='fetch_start', time=20.),
+        dict(event='fetch_end', time=21., files=1, bytes=10),
+    ]
+    phases = get_phases(events)
+    eq_(list(phases), ['fetch', 'preflight'])
+    eq_(phases['fetch'], dict(seconds=3., files=3, bytes=110))
+    # a phase that did not end is not reported
+    eq_(phases['preflight'], dict(seconds=4.))
+
+
+def test_aggregate():
+    eq_(percentile([3, 1, 2], 50), 2)
+    eq_(percentile([1.], 90), 1.)
+    eq_(percentile(range(1, 11), 90), 9)
+    timing = aggregate(
+        [dict(payload=dict(seconds=float(i))) for i in range(1, 11)] +
+        [dict(preflight=dict(seconds=1.))])
+    eq_(timing['payload'], dict(jobs=10, p50=5., p90=9., max=10.))
+    eq_(timing['preflight']['jobs'], 1)
+
+
+@with_tempfile
+def test_timer(path):
+    path = ut.Path(path)
+    eq_(read_timing(path), [])
+    timer = Timer()
+    timer.phase('one')
+    timer.phase('two')
+    timer.stop(files=5)
+    timer.write(path)
+    # nothing is written twice
+    timer.phase('three')
+    timer.stop()
+    timer.write(path)
+    # partial lines are ignored
+    with path.open('a') as f:
+        f.write(u'{"event": "fo')
+    phases = get_phases(read_timing(path))
+    eq_(list(phases), ['one', 'two', 'three'])
+    eq_(phases['two']['files'], 5)
+    ok_(all(p['seconds'] >= 0 for p in phases.values()))
@@ -0,0 +1,86 @@
+import threading
+import time
+
+import datalad_revolution.utils as ut
+from datalad.tests.utils import (
+    with_tempfile,
+    eq_,
+    ok_,
+)
+from datalad_htcondor.userlog import (
+    Watcher,
+    apply_events,
+    get_usage,
+    read_events,
+)
+
+
+submit_event = u"""\
+000 (042.000.000) 11/16 12:00:00 Job submitted from host: <10.0.0.1:9618>
+...
+"""
+
+execute_event = u"""\
+001 (042.000.000) 11/16 12:00:05 Job executing on host: <10.0.0.2:9618>
+...
+"""
+
+terminate_event = u"""\
+005 (042.000.000) 11/16 12:01:00 Job terminated.
+	(1) Normal termination (return value 3)
+		Usr 0 00:00:00, Sys 0 00:00:00  -  Run Remote Usage
+...
+"""
+
+
+@with_tempfile
+def test_read_events(path):
+    log = ut.Path(path)
+    log.write_text(submit_event + execute_event[:30])
+    events, offset = read_events(log)
+    eq_([e['code'] for e in events], [0])
+    eq_(events[0]['cluster'], 42)
+    eq_(apply_events(events), ('submitted', None))
+    # the partial event is left for later
+    eq_(offset, len(submit_event))
+
+    log.write_text(submit_event + execute_event + terminate_event)
+    events, offset = read_events(log, offset)
+    # only the new events
+    eq_([e['code'] for e in events], [1, 5])
+    eq_(apply_events(events, 'submitted'), ('terminated', 3))
+    eq_(offset, log.stat().st_size)
+    eq_(read_events(log, offset), ([], offset))
+
+
+@with_tempfile(mkdir=True)
+def test_watcher(path):
+    path = ut.Path(path)
+    with Watcher([path]) as watcher:
+        t = threading.Timer(
+            0.5, lambda: (path / 'status').write_text(u'completed'))
+        t.start()
+        start = time.time()
+        watcher.wait(30)
+        t.join()
+        # woken up by the change (or a poll after the timeout)
+        ok_((path / 'status').exists())
+        ok_(time.time() - start < 30 or watcher._inotify is None)
+
+
+def test_get_usage():
+    eq_(get_usage([]), {})
+    events = [
+        dict(code=6, lines=['12  -  MemoryUsage of job (MB)',
+                            '11264  -  ResidentSetSize of job (KB)']),
+        dict(code=5, lines=[
+            '(1) Normal termination (return value 0)',
+            'Partitionable Resources :    Usage  Request Allocated',
+            # no usage reported
+            'Cpus                 :                 1         1',
+            'Disk (KB)            :       15        15   8187280',
+            'Memory (MB)          :        3         1      2048',
+        ]),
+    ]
+    # the peak memory usage
+    eq_(get_usage(events), dict(memory=12, disk=15))
@@ -0,0 +1,156 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Timing of the phases of preparation, job execution and merge
+
+Timing records are files with one JSON object per line, each an `event`
+with its `time` (seconds since the epoch). A phase is delimited by a
+`<phase>_start` and a `<phase>_end` event, the end event may report the
+number of `files` and `bytes` the phase processed. The execute side
+writes such events into `stamps/timing` of a job, and `htc-prepare` into
+`timing/prepare` of a submission. Merging the results of a job keeps its
+events in `timing/job_<N>` of the submission, along with those of the
+merge itself, or in `timing/merge` for a merge of many jobs at once.
+"""
+
+__docformat__ = 'restructuredtext'
+
+
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from six import text_type
+
+
+lgr = logging.getLogger('datalad.htcondor.timing')
+
+
+class Timer(object):
+    """Record the start and end of consecutive phases
+
+    Starting a phase ends the one before.
+    """
+    def __init__(self):
+        self.events = []
+        self._current = None
+        self._written = 0
+
+    def phase(self, name):
+        """End the current phase, if any, and start a new one"""
+        self.stop()
+        self.events.append(dict(event=name + '_start', time=time.time()))
+        self._current = name
+
+    def stop(self, **counts):
+        """End the current phase, if any
+
+        Parameters
+        ----------
+        **counts
+          E.g. `files` and `bytes` processed in the phase.
+        """
+        if self._current is None:
+            return
+        self.events.append(dict(
+            counts, event=self._current + '_end', time=time.time()))
+        self._current = None
+
+    def write(self, path):
+        """Append the events that were not written yet to a file"""
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True)
+        with path.open('a') as f:
+            for e in self.events[self._written:]:
+                f.write(text_type(json.dumps(e, sort_keys=True)) + u'\n')
+        self._written = len(self.events)
+
+
+def read_timing(path):
+    """Return the events of a timing record, or an empty list"""
+    events = []
+    try:
+        with path.open() as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # e.g. cut short by an evicted job
+                    lgr.debug('Ignoring invalid timing record in %s: %s',
+                              path, line)
+    except (IOError, OSError):
+        pass
+    return events
+
+
+def get_phases(events):
+    """Return the duration of each phase, in order of appearance
+
+    Phases that occurred multiple times are reported once, with the total
+    duration, files and bytes.
+
+    Returns
+    -------
+    OrderedDict
+      Phase name to a dict with `seconds`, and `files` and `bytes`, if
+      they were reported.
+    """
+    phases = OrderedDict()
+    started = {}
+    for e in events:
+        name = e.get('event', '')
+        if name.endswith('_start'):
+            started[name[:-6]] = e['time']
+        elif name.endswith('_end') and name[:-4] in started:
+            name = name[:-4]
+            props = phases.setdefault(name, dict(seconds=0.))
+            props['seconds'] += e['time'] - started.pop(name)
+            for k in ('files', 'bytes'):
+                if k in e:
+                    props[k] = props.get(k, 0) + e[k]
+    return phases
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values (nearest rank)"""
+    values = sorted(values)
+    rank = int(math.ceil(p / 100. * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def aggregate(timings):
+    """Summarize the phases of many jobs
+
+    Parameters
+    ----------
+    timings : iterable
+      Per job, phases as returned by `get_phases()`.
+
+    Returns
+    -------
+    OrderedDict
+      Phase name to a dict with the number of `jobs` that went through the
+      phase, and the 50th and 90th percentile (`p50`, `p90`) and maximum
+      (`max`) of its duration in seconds.
+    """
+    durations = OrderedDict()
+    for phases in timings:
+        for name, props in phases.items():
+            durations.setdefault(name, []).append(props['seconds'])
+    return OrderedDict(
+        (name, dict(
+            jobs=len(values),
+            p50=percentile(values, 50),
+            p90=percentile(values, 90),
+            max=max(values),
+        ))
+        for name, values in durations.items())
@@ -0,0 +1,291 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""HTCondor job event (user) logs, and waiting for them to change"""
+
+__docformat__ = 'restructuredtext'
+
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import select
+import time
+from six import text_type
+
+
+lgr = logging.getLogger('datalad.htcondor.userlog')
+
+
+# job state indicated by the user log events we care about
+event_states = {
+    0: 'submitted',
+    1: 'running',
+    # executable error
+    2: 'failed',
+    4: 'evicted',
+    5: 'terminated',
+    9: 'aborted',
+    12: 'held',
+    # back in the queue
+    13: 'submitted',
+}
+
+# states a job does not leave without further action
+final_states = ('failed', 'terminated', 'aborted')
+
+# every event ends with a line like this
+_event_end = b'...\n'
+
+_event_header = re.compile(
+    r'^(?P<code>\d{3}) \((?P<cluster>\d+)\.(?P<proc>\d+)\.\d+\) '
+    r'(?P<time>\S+ \S+) (?P<text>.*)$')
+
+_return_value = re.compile(r'\(return value (?P<value>-?\d+)\)')
+
+# resource usage reported by an image size update
+_image_size_usage = re.compile(
+    r'^(?P<value>\d+)\s+-\s+(?P<name>MemoryUsage) of job \(MB\)$')
+
+# a row of the table of partitionable resources of a terminated job:
+# usage (may be missing), request, allocation
+_resource_usage = re.compile(
+    r'^(?P<name>Cpus|Disk|Memory)(?: \((?:KB|MB)\))?\s*:'
+    r'\s*(?P<values>[\d.\s]*)$')
+
+
+def read_events(path, offset=0):
+    """Read the events that were added to a user log since `offset`
+
+    Only complete events are considered, a partially written one is left
+    for the next read.
+
+    Parameters
+    ----------
+    path : Path
+    offset : int
+      Byte offset to start reading at.
+
+    Returns
+    -------
+    (list, int)
+      Events and the offset to continue reading at. Each event is a dict
+      with the event `code`, `cluster`, `proc`, `time` (as reported),
+      the `text` of the header line and any further `lines`.
+    """
+    with path.open('rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(_event_end)
+    if end < 0:
+        return [], offset
+    # skip a trailing partial event
+    data = data[:end + len(_event_end)]
+    events = []
+    for block in data.split(_event_end):
+        lines = block.decode('utf-8', 'replace').splitlines()
+        if not lines:
+            continue
+        match = _event_header.match(lines[0])
+        if not match:
+            lgr.debug('Ignoring unrecognized event in %s: %s',
+                      path, lines[0])
+            continue
+        event = match.groupdict()
+        for k in ('code', 'cluster', 'proc'):
+            event[k] = int(event[k])
+        event['lines'] = [l.strip() for l in lines[1:]]
+        events.append(event)
+    return events, offset + len(data)
+
+
+def apply_events(events, state=None, exit_code=None):
+    """Return the job state and exit code after a series of events
+
+    Parameters
+    ----------
+    events : list
+      As returned by `read_events()`.
+    state : str, optional
+      State before these events.
+    exit_code : int, optional
+      Exit code before these events.
+
+    Returns
+    -------
+    (str, int)
+    """
+    for e in events:
+        state = event_states.get(e['code'], state)
+        if e['code'] == 5:
+            for l in e['lines']:
+                match = _return_value.search(l)
+                if match:
+                    exit_code = int(match.group('value'))
+                    break
+    return state, exit_code
+
+
+def get_usage(events):
+    """Return the peak resource usage of a job, as reported in its log
+
+    Parameters
+    ----------
+    events : list
+      As returned by `read_events()`, for the entire log.
+
+    Returns
+    -------
+    dict
+      With the `memory` (MB), `disk` (KB) and `cpus` a job used at most,
+      for whatever HTCondor reported.
+    """
+    usage = {}
+
+    def _update(name, value):
+        usage[name] = max(usage.get(name, value), value)
+
+    for e in events:
+        if e['code'] == 6:
+            for l in e['lines']:
+                match = _image_size_usage.match(l)
+                if match:
+                    _update('memory', int(match.group('value')))
+        elif e['code'] == 5:
+            for l in e['lines']:
+                match = _resource_usage.match(l)
+                if not match:
+                    continue
+                values = match.group('values').split()
+                # no usage column, just request and allocation
+                if len(values) < 3:
+                    continue
+                name = match.group('name').lower()
+                _update(name, float(values[0]) if name == 'cpus'
+                        else int(float(values[0])))
+    return usage
+
+
+def write_event(path, code, cluster, proc, text, lines=()):
+    """Append an event to a user log, in the format HTCondor writes
+
+    Parameters
+    ----------
+    path : Path
+    code : int
+      Event code, e.g. 5 for a terminated job.
+    cluster, proc : int
+      Job ID.
+    text : str
+      Remainder of the header line, e.g. 'Job terminated.'.
+    lines : iterable, optional
+      Further lines with event details.
+    """
+    event = u'{:03d} ({:03d}.{:03d}.000) {} {}\n{}...\n'.format(
+        code, cluster, proc, time.strftime('%m/%d %H:%M:%S'), text,
+        u''.join(u'\t{}\n'.format(l) for l in lines))
+    # a single write, readers never see half an event header
+    with path.open('a') as f:
+        f.write(event)
+
+
+class _Inotify(object):
+    """Minimal inotify(7) binding, for watching directories for changes"""
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    mask = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        # IN_NONBLOCK | IN_CLOEXEC
+        self.fd = libc.inotify_init1(0o4000 | 0o2000000)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+    def add(self, path):
+        if self._add_watch(
+                self.fd, text_type(path).encode('utf-8'), self.mask) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), text_type(path))
+
+    def wait(self, timeout):
+        """Wait for any event, return whether there was one"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # drain, we do not care about the details
+        while True:
+            try:
+                if not os.read(self.fd, 64 * 1024):
+                    break
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Wait for changes in any of a set of directories
+
+    Uses inotify where available. Without it, or if there are too many
+    directories to watch, waiting is plain polling, i.e. sleeping for
+    the given interval.
+
+    Parameters
+    ----------
+    paths : iterable
+      Directories to watch.
+    """
+    def __init__(self, paths):
+        self._inotify = None
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError) as e:
+            lgr.debug('No inotify, falling back on polling: %s', e)
+            return
+        try:
+            for p in paths:
+                inotify.add(p)
+        except OSError as e:
+            lgr.debug('Cannot watch all directories, falling back on '
+                      'polling: %s', e)
+            inotify.close()
+            return
+        self._inotify = inotify
+
+    def wait(self, timeout):
+        """Wait until something changed or `timeout` seconds have passed
+
+        Changes that cannot be observed (e.g. on a network file system)
+        are only noticed after the timeout, hence it should not be too
+        long.
+        """
+        if self._inotify is None:
+            time.sleep(timeout)
+        else:
+            self._inotify.wait(timeout)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()